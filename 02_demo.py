@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import sciris as sc
 import starsim as ss
+from rsv_states import categorical
 import matplotlib.pyplot as plt
 
 # ===========================================
@@ -21,7 +22,9 @@ def urban_function(n):
     """ Make a function to randomly assign people 
         to urban/rural locations """ 
     return np.random.choice(a=[True, False], p=[0.5, 0.5], size=n)
-urban = ss.BoolState('urban', default=urban_function)
+# stored as one byte per agent (0 = rural, 1 = urban); as a categorical rather
+# than a BoolState, it isn't also counted into a result every step
+urban = categorical('urban', levels=['RURAL', 'URBAN'], dtype=np.uint8, default=urban_function)
 
 # make the people object
 # NB: (1) n_agents needs to be large enough for things
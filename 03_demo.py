@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 import sciris as sc
 import starsim as ss
-import random
+from rsv_states import age_choice, categorical
 import matplotlib.pyplot as plt
 
 # ===============================================================================
@@ -18,21 +18,20 @@ import matplotlib.pyplot as plt
 age_data = pd.read_csv('age.csv')
 
 # create a location state
-def location_fcn(n):
-    """ 
-    Make a function to assign people to locations.
-    This ultimately happens after the sim.init() step because
-    this state is conditional on age. So for now just put a placeholder
-    and you can randomize later with different probabilities.
-    But the locations will be
-    1 - household
-    2 - school
-    3 - community
-    """ 
-    locs = [0]
-    return np.random.choice(locs, size = n)
-    
-location = ss.FloatArr('location', default=location_fcn)
+# This is conditional on age, so it is drawn per age band from a
+# probability table in one vectorized pass during sim.init()
+# (this used to be a per-agent random.choices() loop after sim.init()).
+# The locations will be
+#     1 - household
+#     2 - school
+#     3 - community
+# stored as one byte per agent, with named levels so the selectors below can
+# compare against the names
+location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], codes=[1, 2, 3], default=age_choice(
+    a = [1, 2, 3],
+    p = [[.33, .33, .34],  # age < 19
+         [.20, .10, .70]], # age 19+
+    age_bins = (0, 19, 100)))
 
 # make the people object
 # NB: (1) n_agents needs to be large enough for things
@@ -60,31 +59,31 @@ mps = ss.MixingPools(
     # SOURCE
     # NB: Make these a lambda sim so you can define locations               
     src = {'0-20 - HOUSEHOLD': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 1)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'HOUSEHOLD')).uids,
            '20+  - HOUSEHOLD': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 1)).uids, 
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'HOUSEHOLD')).uids, 
            '0-20 - SCHOOL': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 2)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'SCHOOL')).uids,
            '20+  - SCHOOL': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 2)).uids,
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'SCHOOL')).uids,
            '0-20 - COMMUNITY': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 3)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'COMMUNITY')).uids,
            '20+  - COMMUNITY': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 3)).uids},
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'COMMUNITY')).uids},
     
     # DESTINATION
     dst = {'0-20 - HOUSEHOLD': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 1)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'HOUSEHOLD')).uids,
            '20+  - HOUSEHOLD': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 1)).uids, 
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'HOUSEHOLD')).uids, 
            '0-20 - SCHOOL': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 2)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'SCHOOL')).uids,
            '20+  - SCHOOL': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 2)).uids,
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'SCHOOL')).uids,
            '0-20 - COMMUNITY': 
-           lambda sim: ((sim.people.age < 20) & (sim.people.location == 3)).uids,
+           lambda sim: ((sim.people.age < 20) & (sim.people.location == 'COMMUNITY')).uids,
            '20+  - COMMUNITY': 
-           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 3)).uids},
+           lambda sim: ((sim.people.age >= 20) & (sim.people.location == 'COMMUNITY')).uids},
     
     # CONTACT MATRIX
     # the column is destination, the row is source
@@ -133,15 +132,15 @@ class infections_by_grp(ss.Analyzer):
             mask_age = (age >= min_age) & (age < max_age)
 
             # Household
-            mask_hh = (mask_age) & (location == 1)
+            mask_hh = (mask_age) & (location == 'HOUSEHOLD')
             self.hist[min_age]['hh'].append(disease.infected[mask_hh].sum())
 
             # Community
-            mask_com = (mask_age) & (location == 2)
+            mask_com = (mask_age) & (location == 'COMMUNITY')
             self.hist[min_age]['com'].append(disease.infected[mask_com].sum())
 
             # School
-            mask_sch = (mask_age) & (location == 3)
+            mask_sch = (mask_age) & (location == 'SCHOOL')
             self.hist[min_age]['sch'].append(disease.infected[mask_sch].sum())
             
         return
@@ -200,27 +199,6 @@ sim.init()
 # now you can see that people is initialized
 sim.people.to_df()
 
-# now you can set conditional location state based on age
-# In [1]: import random
-# In [2]: random.choices(
-# ...:     population=[['a','b'], ['b','a'], ['c','b']],
-# ...:     weights=[0.2, 0.2, 0.6],
-# ...:     k=10
-# ...: )
-# and remember that these are the locations
-#     1 - household
-#     2 - school
-#     3 - community
-for i in range(int(n_agents)):
-    if sim.people.age[i] < 19:
-        sim.people.location[i] = \
-            random.choices([1, 2, 3], [.33, .33, .33], k=1)[0]
-    else:
-        sim.people.location[i] = \
-            random.choices([1, 2, 3], [.20, .10, .70], k=1)[0]
-
-sim.people.to_df()
-
 #
 sim.run()
 
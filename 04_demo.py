@@ -1,9 +1,9 @@
 import numpy as np
 import pandas as pd
-import sciris as sc
 import starsim as ss
-import random
-import matplotlib.pyplot as plt
+from rsv_states import age_choice, categorical
+from rsv_groups import group_index
+from rsv_analyzers import infections_by_stratum
 
 # ===============================================================================
 # ///////////////////////////////////////////////////////////////////////////////
@@ -18,21 +18,18 @@ import matplotlib.pyplot as plt
 age_data = pd.read_csv('age.csv')
 
 # create a location state
-def location_fcn(n):
-    """ 
-    Make a function to assign people to locations.
-    This ultimately happens after the sim.init() step because
-    this state is conditional on age. So for now just put a placeholder
-    and you can randomize later with different probabilities.
-    But the locations will be
-    0 - household
-    1 - school
-    2 - community
-    """ 
-    locs = [-1]
-    return np.random.choice(locs, size = n)
-    
-location = ss.FloatArr('location', default=location_fcn)
+# This is conditional on age, so it is drawn per age band from a
+# probability table in one vectorized pass during sim.init()
+# (this used to be a per-agent random.choices() loop after sim.init()).
+# The locations will be
+#     0 - household
+#     1 - school
+#     2 - community
+location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default=age_choice(
+    a = [0, 1, 2],
+    p = [[1.0, 0.0, 0.0],  # age < 19  [.33, .33, .34]
+         [0.0, 0.0, 1.0]], # age 19+   [.20, .10, .70]
+    age_bins = (0, 19, 100)))
 
 # make the people object
 # NB: (1) n_agents needs to be large enough for things
@@ -56,25 +53,15 @@ ppl = ss.People(n_agents=n_agents,
 # ///////////////////////////////////////////////////////////////////////////////
 # ===============================================================================
 
-# first define the base function
-# which defines people by age group and by location
-def in_grp(simobj, age_min, age_max, check_location):
-    return ((simobj.people.age >= age_min) & (simobj.people.age < age_max) &
-            (simobj.people.location == check_location)).uids
-
-# then create the two dictionaries
+# The groups are age band x location. Rather than one in_grp() lambda per
+# group that rescans the whole population on every timestep, a group_index
+# connector keeps the uids of every group and only moves agents whose age band
+# or location changed. Its selectors() are the src/dst lambdas, in the same
+# order as before (location-major: 0-20 - HOUSEHOLD, 20-100 - HOUSEHOLD, ...)
 age_breaks = [0, 20, 100] 
 locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
-base_dict = {}
-for loc_i, loc in enumerate(locations):
-    for age_i in range(1, len(age_breaks)):
-        age_min = age_breaks[age_i-1]
-        age_max = age_breaks[age_i]
-        nm = f'{age_min}-{age_max} - {loc}'
-        # need to pass these things in as function arguments
-        # if you define their defaults it works
-        base_dict[nm] = lambda xsim, li=loc_i, ai=age_min, ax=age_max: \
-            in_grp(xsim, ai, ax, li)
+grp_index = group_index(age_bins=age_breaks, locations=locations)
+base_dict = grp_index.selectors()
 
 # Now read in the contact matrix
 # the column is destination, the row is source
@@ -82,8 +69,8 @@ for loc_i, loc in enumerate(locations):
 # A     [0, 0]
 # B     [1, 0] 
 # means coming from B -> A, so only A increases
-n_contacts_data = pd.read_csv('contact_matrix.csv', header=None)
-
+# (contact_matrix.csv has 20 five-year bands, not the 2 used here, so
+# these pools use a flat matrix; see rsv_contacts.load_contacts() for it)
 n_contacts_data = [[1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
          [1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
          [1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
@@ -120,77 +107,10 @@ mps = ss.MixingPools(
 # Analyzer
 # ///////////////////////////////////////////////////////////////////////////////
 # ===============================================================================
-class infections_by_grp(ss.Analyzer):
-    """ Count infections by age and location"""
-    def __init__(self, age_bins=(0, 20, 100)):
-        super().__init__()
-        self.age_bins = age_bins
-        self.mins = age_bins[:-1]
-        self.maxes = age_bins[1:]
-        self.hist = {
-            min_age: {'hh': [], 'sch': [], 'com': []}
-            for min_age in self.mins
-        }
-        return
-
-    def init_pre(self, sim):
-        super().init_pre(sim)
-        self.infections = np.zeros(len(self.sim.people.age))
-        return
-
-    def step(self):
-        age = self.sim.people.age
-        location = self.sim.people.location
-        disease = self.sim.diseases[0]
-        for min_age, max_age in zip(self.mins, self.maxes):
-            mask_age = (age >= min_age) & (age < max_age)
-
-            # Household
-            mask_hh = (mask_age) & (location == 0)
-            self.hist[min_age]['hh'].append(disease.infected[mask_hh].sum())
-
-            # School
-            mask_com = (mask_age) & (location == 1)
-            self.hist[min_age]['sch'].append(disease.infected[mask_com].sum())
-
-            # Community
-            mask_sch = (mask_age) & (location == 2)
-            self.hist[min_age]['com'].append(disease.infected[mask_sch].sum())
-            
-        return
-
-    def plot(self):
-        plt.figure()
-        x = self.sim.t.tvec
-        for min_age, max_age in zip(self.mins, self.maxes):
-            # Household line
-            plt.plot(
-                x,
-                self.hist[min_age]['hh'],
-                linestyle='solid',
-                label=f'Age {min_age}-{max_age} household'
-            )
-            # Community line (dashed)
-            plt.plot(
-                x,
-                self.hist[min_age]['com'],
-                linestyle='dashed',
-                label=f'Age {min_age}-{max_age} community'
-            )
-            # School line
-            plt.plot(
-                x,
-                self.hist[min_age]['sch'],
-                linestyle='dotted',
-                label=f'Age {min_age}-{max_age} school'
-            )
-        plt.legend(frameon=False)
-        plt.xlabel('Model time')
-        plt.ylabel('Individuals infected')
-        plt.ylim(bottom=0)
-        sc.boxoff()
-        plt.show()
-        return
+# infections_by_grp used to build a mask for every age bin and location on
+# every step; infections_by_stratum does one bincount over the infected agents
+# and stores the counts in a preallocated (n_steps x n_strata) array
+grp_counts = infections_by_stratum(age_bins=age_breaks, locations=locations)
 
 
 # ===============================================================================
@@ -201,8 +121,9 @@ class infections_by_grp(ss.Analyzer):
 sim = ss.Sim(
     diseases = 'sir',
     networks = mps,
+    connectors = grp_index,
     people   = ppl,
-    analyzers = infections_by_grp(),
+    analyzers = grp_counts,
     start = 2000,
     stop = 2010,
     dt = 0.1)
@@ -213,23 +134,7 @@ sim.init()
 # now you can see that people is initialized
 sim.people.to_df()
 
-# now you can set conditional location state based on age
-# random.choices(locations, weights,k)
-# and remember that these are the locations
-#     0 - household
-#     1 - school
-#     2 - community
-for i in range(int(n_agents)):
-    if sim.people.age[i] < 19:
-        sim.people.location[i] = \
-              random.choices([0, 1, 2], [1.0, 0.0, 0.0], k=1)[0] # [.33, .33, .33]
-    else:
-        sim.people.location[i] = \
-              random.choices([0, 1, 2], [0.0, 0.0, 1.0], k=1)[0] # [.20, .10, .70]
-
-sim.people.to_df()
-
 #
 sim.run()
 
-sim.analyzers.infections_by_grp.plot()
+sim.analyzers.infections_by_stratum.plot()
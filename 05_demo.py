@@ -2,8 +2,11 @@ import numpy as np
 import pandas as pd
 import sciris as sc
 import starsim as ss
-import random
-import matplotlib.pyplot as plt
+from rsv_states import age_choice, categorical
+from rsv_groups import group_index
+from rsv_analyzers import infections_by_stratum
+from rsv_snapshot import sim_snapshot
+from rsv_calibration import calibration, reseed
 
 def make_sim():
     # ===============================================================================
@@ -19,21 +22,18 @@ def make_sim():
     age_data = pd.read_csv('age.csv')
     
     # create a location state
-    def location_fcn(n):
-        """ 
-        Make a function to assign people to locations.
-        This ultimately happens after the sim.init() step because
-        this state is conditional on age. So for now just put a placeholder
-        and you can randomize later with different probabilities.
-        But the locations will be
-        0 - household
-        1 - school
-        2 - community
-        """ 
-        locs = [-1]
-        return np.random.choice(locs, size = n)
-        
-    location = ss.FloatArr('location', default=location_fcn)
+    # This is conditional on age, so it is drawn per age band from a
+    # probability table in one vectorized pass during sim.init()
+    # (this used to be a per-agent random.choices() loop after sim.init()).
+    # The locations will be
+    #     0 - household
+    #     1 - school
+    #     2 - community
+    location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default=age_choice(
+        a = [0, 1, 2],
+        p = [[1.0, 0.0, 0.0],  # age < 19  [.33, .33, .34]
+             [0.0, 0.0, 1.0]], # age 19+   [.20, .10, .70]
+        age_bins = (0, 19, 100)))
     
     # make the people object
     # NB: (1) n_agents needs to be large enough for things
@@ -57,35 +57,25 @@ def make_sim():
     # ///////////////////////////////////////////////////////////////////////////////
     # ===============================================================================
     
-    # first define the base function
-    # which defines people by age group and by location
+    # The groups are age band x location. Rather than one in_grp() lambda per
+    # group that rescans the whole population on every timestep, a group_index
+    # connector keeps the uids of every group and only moves agents whose age band
+    # or location changed. Its selectors() are the src/dst lambdas, in the same
+    # order as before (location-major: 0-20 - HOUSEHOLD, 20-100 - HOUSEHOLD, ...)
     # TODO: add a within-family
-    def in_grp(simobj, age_min, age_max, check_location):
-        return ((simobj.people.age >= age_min) & (simobj.people.age < age_max) &
-                (simobj.people.location == check_location)).uids
-    
-    # then create the two dictionaries
     age_breaks = [0, 20, 100] 
     locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
-    base_dict = {}
-    for loc_i, loc in enumerate(locations):
-        for age_i in range(1, len(age_breaks)):
-            age_min = age_breaks[age_i-1]
-            age_max = age_breaks[age_i]
-            nm = f'{age_min}-{age_max} - {loc}'
-            # need to pass these things in as function arguments
-            # if you define their defaults it works
-            base_dict[nm] = lambda xsim, li=loc_i, ai=age_min, ax=age_max: \
-                in_grp(xsim, ai, ax, li)
-    
+    grp_index = group_index(age_bins=age_breaks, locations=locations)
+    base_dict = grp_index.selectors()
+
     # Now read in the contact matrix
     # the column is destination, the row is source
     # dest: A  B
     #      [0, 0]
     #      [1, 0] 
     # means coming from B -> A, so only A increases
-    n_contacts_data = pd.read_csv('contact_matrix.csv', header=None)
-    
+    # (contact_matrix.csv has 20 five-year bands, not the 2 used here, so
+    # these pools use a flat matrix; see rsv_contacts.load_contacts() for it)
     n_contacts_data = [[1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
              [1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
              [1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
@@ -122,79 +112,12 @@ def make_sim():
     # Analyzer
     # ///////////////////////////////////////////////////////////////////////////////
     # ===============================================================================
-    class infections_by_grp(ss.Analyzer):
-        """ Count infections by age and location"""
-        def __init__(self, age_bins=(0, 20, 100)):
-            super().__init__()
-            self.age_bins = age_bins
-            self.mins = age_bins[:-1]
-            self.maxes = age_bins[1:]
-            self.hist = {
-                min_age: {'hh': [], 'sch': [], 'com': []}
-                for min_age in self.mins
-            }
-            return
-    
-        def init_pre(self, sim):
-            super().init_pre(sim)
-            self.infections = np.zeros(len(self.sim.people.age))
-            return
-    
-        def step(self):
-            age = self.sim.people.age
-            location = self.sim.people.location
-            disease = self.sim.diseases[0]
-            for min_age, max_age in zip(self.mins, self.maxes):
-                mask_age = (age >= min_age) & (age < max_age)
-    
-                # Household
-                mask_hh = (mask_age) & (location == 0)
-                self.hist[min_age]['hh'].append(disease.infected[mask_hh].sum())
-    
-                # School
-                mask_com = (mask_age) & (location == 1)
-                self.hist[min_age]['sch'].append(disease.infected[mask_com].sum())
-    
-                # Community
-                mask_sch = (mask_age) & (location == 2)
-                self.hist[min_age]['com'].append(disease.infected[mask_sch].sum())
-                
-            return
-    
-        def plot(self):
-            plt.figure()
-            x = self.sim.t.tvec
-            for min_age, max_age in zip(self.mins, self.maxes):
-                # Household line
-                plt.plot(
-                    x,
-                    self.hist[min_age]['hh'],
-                    linestyle='solid',
-                    label=f'Age {min_age}-{max_age} household'
-                )
-                # Community line (dashed)
-                plt.plot(
-                    x,
-                    self.hist[min_age]['com'],
-                    linestyle='dashed',
-                    label=f'Age {min_age}-{max_age} community'
-                )
-                # School line
-                plt.plot(
-                    x,
-                    self.hist[min_age]['sch'],
-                    linestyle='dotted',
-                    label=f'Age {min_age}-{max_age} school'
-                )
-            plt.legend(frameon=False)
-            plt.xlabel('Model time')
-            plt.ylabel('Individuals infected')
-            plt.ylim(bottom=0)
-            sc.boxoff()
-            plt.show()
-            return
-    
-    
+    # infections_by_grp used to build a mask for every age bin and location on
+    # every step; infections_by_stratum does one bincount over the infected agents
+    # and stores the counts in a preallocated (n_steps x n_strata) array
+    grp_counts = infections_by_stratum(age_bins=age_breaks, locations=locations)
+
+
     # ===============================================================================
     # ///////////////////////////////////////////////////////////////////////////////
     # Run
@@ -203,8 +126,9 @@ def make_sim():
     sim = ss.Sim(
         diseases = 'sir',
         networks = mps,
+        connectors = grp_index,
         people   = ppl,
-        analyzers = infections_by_grp(),
+        analyzers = grp_counts,
         start = 2000,
         stop = 2010,
         dt = 0.1)
@@ -215,20 +139,6 @@ def make_sim():
     # now you can see that people is initialized
     sim.people.to_df()
     
-    # now you can set conditional location state based on age
-    # random.choices(locations, weights,k)
-    # and remember that these are the locations
-    #     0 - household
-    #     1 - school
-    #     2 - community
-    for i in range(int(n_agents)):
-        if sim.people.age[i] < 19:
-            sim.people.location[i] = \
-                  random.choices([0, 1, 2], [1.0, 0.0, 0.0], k=1)[0] # [.33, .33, .33]
-        else:
-            sim.people.location[i] = \
-                  random.choices([0, 1, 2], [0.0, 0.0, 1.0], k=1)[0] # [.20, .10, .70]
-    
     # and now return
     return sim
 
@@ -264,7 +174,8 @@ def build_sim(sim, calib_pars, n_reps=1, **kwargs):
 
     for k, pars in calib_pars.items(): # Loop over the calibration parameters
         if k == 'rand_seed':
-            sim.pars.rand_seed = v
+            # the sim is already initialized, so remake its random number streams
+            reseed(sim, pars)
             continue
 
         # Each item in calib_pars is a dictionary with keys like 'low', 'high',
@@ -307,17 +218,28 @@ def build_sim(sim, calib_pars, n_reps=1, **kwargs):
 sc.heading('Beginning calibration')
 
 # Make the sim and data
+# build and initialize the people once, and save them to a snapshot, so that
+# each trial starts from a cheap copy-on-write clone rather than a deep copy
 sim = make_sim()
+snapshot = sim_snapshot.save(sim, 'base_sim.snap')
 
 # Make the calibration
-calib = ss.Calibration(
+calib = calibration(
     calib_pars = calib_pars,
-    sim = sim,
+    snapshot = snapshot,
     build_fn = build_sim,
-    build_kw = dict(n_reps=3), # Run 3 replicates for each parameter set
+    n_reps = 3, # Run 3 replicates for each parameter set, each as its own task in the process pool
     reseed = True, # If true, a different random seed will be provided to each configuration
     total_trials = 100, # Use more for a real calibration
-    n_workers = 1, # None indicates to use all available CPUs
+    n_workers = None, # None indicates to use all available CPUs
+    db_name = '05_demo_calibration.db', # Rerunning continues the study in here
+    # If the parameters only act after a burn-in (e.g. an intervention from
+    # 2005), run the burn-in once and calibrate from there instead, with
+    # snapshot = sim_snapshot.checkpoint(make_sim(), until=2005, filename='burnin.snap')
+    # To stop poor trials early, give an eval_fn that works part way through a
+    # run, e.g. lambda sim: sim.analyzers.infections_by_stratum.mismatch(data),
+    # and report it to optuna's median pruner at 4 points in each run with:
+    # checkpoints = 4,
     die = True,
     debug = False, # Run in serial if True
     verbose = 0
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import starsim as ss
+from rsv_states import age_choice, categorical
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_analyzers import infections_by_stratum
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# AGE MATRIX -> People object
+#
+# same as 04_demo, with the location drawn conditional on age
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+# import the age matrix
+age_data = pd.read_csv('age.csv')
+
+# create a location state
+#     0 - household
+#     1 - school
+#     2 - community
+location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default=age_choice(
+    a = [0, 1, 2],
+    p = [[.33, .33, .34],  # age < 19
+         [.20, .10, .70]], # age 19+
+    age_bins = (0, 19, 100)))
+
+# make the people object
+n_agents = 1e5
+ppl = ss.People(n_agents=n_agents,
+                age_data=age_data,
+                extra_states=location)
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# FULL CONTACT MATRIX
+#
+# contact_matrix.csv is 60x60: 20 five-year age bands x 3 locations, in
+# blocks by location (household, school, community), see make_contact_matrices.R
+# the row is source, the column is destination
+#
+# As MixingPools this would be 60x60 = 3600 pools, so instead use
+# contact_matrix_mixing, which does one bincount for the prevalence in every
+# group and one matrix-vector product for the force of infection per step
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+age_breaks = np.linspace(0, 100, 21)
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+
+n_contacts = read_matrix('contact_matrix.csv')
+
+# scale it so represents the number of individuals contacting in each ?
+n_contacts = np.multiply(n_contacts, 10)
+
+cmm = contact_matrix_mixing(
+
+    # Options for this are: 'sir', 'sis', ...
+    diseases = 'sir',
+
+    # overall transmission via the contact matrix
+    beta = 0.1,
+
+    # CONTACT MATRIX
+    contacts = n_contacts,
+    age_bins = age_breaks,
+    locations = locations,
+)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Analyzer
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=locations)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Run
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+sim = ss.Sim(
+    diseases = 'sir',
+    networks = cmm,
+    people   = ppl,
+    analyzers = grp_counts,
+    start = 2000,
+    stop = 2010,
+    dt = 0.1)
+
+sim.run()
+
+sim.analyzers.infections_by_stratum.plot()
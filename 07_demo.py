@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import starsim as ss
+from rsv_states import categorical
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_schedule import activity_schedule
+from rsv_analyzers import infections_by_stratum
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# AGE MATRIX -> People object
+#
+# the location is now set by the time-activity schedule below, so it starts
+# as a placeholder
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+# import the age matrix
+age_data = pd.read_csv('age.csv')
+
+# create a location state
+#     0 - household
+#     1 - school
+#     2 - community
+location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default='HOUSEHOLD')
+
+# make the people object
+n_agents = 1e5
+ppl = ss.People(n_agents=n_agents,
+                age_data=age_data,
+                extra_states=location)
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# TIME OF DAY
+#
+# from the 12.15 notes: kids get sick at school then go home and get their
+# parents sick, so location has to change within the day.
+# Each person gets a time-activity pattern, and each day is split into
+# sub-steps (night, morning, afternoon, evening); the rows are patterns and
+# the columns are the location at each sub-step
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+schedule = activity_schedule(
+    patterns = [[0, 0, 0, 0],  # home all day
+                [0, 1, 1, 0],  # school
+                [0, 2, 2, 0],  # community (work)
+                [0, 1, 2, 0]], # school then community
+
+    # fraction of the day in each sub-step
+    durations = [.40, .20, .20, .20],
+
+    # probability of each pattern, by age group (<5, 5-18, 19-64, 65+)
+    pattern_probs = [[.80, .00, .20, .00],
+                     [.05, .60, .05, .30],
+                     [.20, .00, .80, .00],
+                     [.60, .00, .40, .00]],
+    age_bins = [0, 5, 19, 65, 100],
+)
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# FULL CONTACT MATRIX
+#
+# same as 06_demo, but the transmission adds up the sub-steps of the day
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+n_contacts = read_matrix('contact_matrix.csv')
+n_contacts = np.multiply(n_contacts, 10)
+
+cmm = contact_matrix_mixing(
+    diseases = 'sir',
+    beta = 0.1,
+    contacts = n_contacts,
+    age_bins = np.linspace(0, 100, 21),
+    locations = locations,
+    schedule = 'activity_schedule',
+)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Analyzer
+#
+# by the end of the day everyone is home, so count by time-activity pattern
+# rather than by location
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+grp_counts = infections_by_stratum(
+    age_bins = [0, 19, 100],
+    locations = ['HOME', 'SCHOOL', 'COMMUNITY', 'SCHOOL+COMMUNITY'],
+    state = 'activity_schedule.pattern')
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Run
+#
+# NB: daily timestep now, since the sub-steps are within a day
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+sim = ss.Sim(
+    diseases = 'sir',
+    networks = cmm,
+    connectors = schedule,
+    people   = ppl,
+    analyzers = grp_counts,
+    start = '2000-01-01',
+    dur = ss.days(365),
+    dt = ss.days(1))
+
+sim.run()
+
+sim.analyzers.infections_by_stratum.plot()
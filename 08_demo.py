@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import optuna as op
+from rsv_states import age_choice, categorical
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_ode import metapop_ode
+from rsv_calibration import calibration, reseed, screen
+import matplotlib.pyplot as plt
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# MULTI-FIDELITY CALIBRATION
+#
+# The same sim as 06_demo (60 age band x location groups, full contact matrix).
+# The deterministic metapopulation ODE over the same groups, contact matrix
+# and beta runs ten years in milliseconds, so it screens thousands of values of
+# beta first, and only the promising range goes to the agent-based calibration
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+age_data = pd.read_csv('age.csv')
+age_breaks = np.linspace(0, 100, 21)
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+n_contacts = read_matrix('contact_matrix.csv') * 10
+
+
+def make_sim(beta=0.5):
+    location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default=age_choice(
+        a = [0, 1, 2],
+        p = [[.33, .33, .34],  # age < 19
+             [.20, .10, .70]], # age 19+
+        age_bins = (0, 19, 100)))
+    ppl = ss.People(n_agents=2e4, age_data=age_data, extra_states=location)
+    cmm = contact_matrix_mixing(diseases='sir', beta=beta, contacts=n_contacts,
+                                age_bins=age_breaks, locations=locations)
+    sim = ss.Sim(diseases='sir', networks=cmm, people=ppl, start=2000, stop=2010, dt=0.1, verbose=0)
+    sim.init()
+    return sim
+
+
+def build_sim(sim, calib_pars, **kwargs):
+    for k, pars in calib_pars.items():
+        if k == 'rand_seed':
+            reseed(sim, pars)
+        elif k == 'beta':
+            sim.networks.contact_matrix_mixing.pars.beta = pars['value']
+        elif '[' in k:
+            # An entry of the route's beta_matrix or beta_factors, e.g. 'beta[0-5->20-25]';
+            # calib_pars for these come from sim.networks.contact_matrix_mixing.beta_pars()
+            sim.networks.contact_matrix_mixing.set_beta(k, pars['value'])
+        else:
+            raise NotImplementedError(f'Parameter {k} not recognized')
+    return sim
+
+
+# Some made-up data: the number infected over time in a run with beta = 0.5 (R0 of about 2.4)
+truth = make_sim(beta=0.5)
+truth.run()
+data = truth.results.sir.n_infected.values
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Screen with the ODE
+#
+# NB: from_sim() converts the route and disease betas to a rate per day, so the
+# ODE's beta is the sim's beta times a constant
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+sim = make_sim()
+ode = metapop_ode.from_sim(sim)
+scale = ode.beta / sim.networks.contact_matrix_mixing.pars.beta
+days = sim.t.dt.days * (sim.t.npts - 1)
+
+def ode_fit(pars):
+    res = ode.run(days=days, dt=sim.t.dt.days, beta=pars['beta']*scale)
+    return np.mean((res.I.sum(axis=1) - data)**2)
+
+calib_pars = dict(
+    beta = dict(low=0.01, high=10.0, guess=1.0, suggest_type='suggest_float', log=True)
+)
+
+sc.heading('Screening with the ODE')
+T = sc.timer()
+# keep the best 2%, and widen their range by half on each side, since the ODE
+# is only an approximation of the agent-based model
+narrowed, screened = screen(ode_fit, calib_pars, n_samples=2000, keep=0.02, margin=0.5, seed=1)
+print(f'{len(screened)} parameter sets in {T.toc(output=True):.1f} s; beta narrowed to '
+      f'{narrowed["beta"]["low"]:.3f}-{narrowed["beta"]["high"]:.3f}')
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Agent-based calibration over the narrowed range
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def eval_fn(sim):
+    return float(np.mean((sim.results.sir.n_infected.values - data)**2))
+
+op.logging.set_verbosity(op.logging.WARNING)
+calib = calibration(
+    sim = sim,
+    calib_pars = narrowed,
+    build_fn = build_sim,
+    eval_fn = eval_fn,
+    total_trials = 20,
+    n_workers = None,
+    db_name = '08_demo_calibration.db',
+    keep_db = False,
+    die = True,
+    verbose = 0,
+)
+
+sc.heading('Agent-based calibration')
+calib.calibrate()
+print('Best beta:', calib.best_pars['beta'], '(the data used 0.5)')
+
+plt.figure()
+plt.plot(screened.beta, screened.fit, '.', alpha=0.3, label='ODE screen')
+plt.axvspan(narrowed['beta']['low'], narrowed['beta']['high'], alpha=0.2, label='Range passed on')
+plt.xscale('log')
+plt.yscale('log')
+plt.xlabel('beta')
+plt.ylabel('Mismatch')
+plt.legend(frameon=False)
+sc.boxoff()
+plt.show()
@@ -0,0 +1,68 @@
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice, categorical
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_analyzers import infections_by_stratum
+from rsv_sweep import sweep, read_sweep
+import matplotlib.pyplot as plt
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# PARAMETER SWEEP
+#
+# The same sim as 06_demo, but with beta, a scaling of the contact matrix and
+# the location probabilities of under-19s as arguments of make_sim(), so that
+# a sweep can run every combination. Every run goes into sweep.rsvc; if this
+# script is stopped, running it again only does the runs that are missing.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+age_data = pd.read_csv('age.csv')
+age_breaks = [0, 20, 100]
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+contacts = read_matrix('contact_matrix.csv') * 10
+
+
+def make_sim(beta, contact_scale, p_young):
+    location = categorical('location', levels=locations, default=age_choice(
+        a = [0, 1, 2],
+        p = [p_young,          # age < 19
+             [.20, .10, .70]], # age 19+
+        age_bins = (0, 19, 100)))
+    ppl = ss.People(n_agents=2e4, age_data=age_data, extra_states=location)
+    cmm = contact_matrix_mixing(diseases='sir', beta=beta, contacts=contacts*contact_scale, locations=locations)
+    grp_counts = infections_by_stratum(age_bins=age_breaks, locations=locations)
+    sim = ss.Sim(diseases='sir', networks=cmm, people=ppl, analyzers=grp_counts, start=2000, stop=2010, dt=0.1, verbose=0)
+    return sim
+
+
+grid = dict(
+    beta = [0.05, 0.1, 0.2],
+    contact_scale = [0.5, 1.0],
+    p_young = [[.33, .33, .34], [.20, .10, .70]],
+)
+
+sc.heading('Running the sweep')
+sw = sweep(make_sim, grid, filename='sweep.rsvc', n_reps=3, n_workers=None)
+sw.run()
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# Aggregate
+#
+# read_sweep() only decompresses the runs that match, and keeps only the
+# columns asked for
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+df = read_sweep('sweep.rsvc', columns=['year', '0-20 - SCHOOL'], contact_scale=1.0)
+mean = df.groupby(['beta', 'p_young', 'year'])['0-20 - SCHOOL'].mean()
+
+plt.figure()
+for (beta, p_young), curve in mean.groupby(level=['beta', 'p_young']):
+    plt.plot(curve.index.get_level_values('year'), curve.values, label=f'beta={beta}, under-19s {p_young}')
+plt.xlabel('Year')
+plt.ylabel('Infected, 0-20 at school (mean of 3 runs)')
+plt.legend(frameon=False, fontsize='small')
+sc.boxoff()
+plt.show()
@@ -0,0 +1,71 @@
+"""
+Benchmark calibration throughput (replicates per second) with 1, 2, 4 and 8
+workers, each cloning its sims from a shared sim_snapshot
+
+Run with e.g.
+    python bench_calibration.py
+
+NB: worker counts above the number of cores are skipped
+"""
+import os
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+from rsv_networks import contact_matrix_mixing
+from rsv_snapshot import sim_snapshot
+from rsv_calibration import calibration, reseed
+
+age_data = pd.read_csv('age.csv')
+snap_file = 'bench_calibration.snap'
+db_name = 'bench_calibration.db'
+n_agents = 1e5
+n_trials = 16
+n_reps = 2
+
+
+def make_sim():
+    location = ss.FloatArr('location', default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    cmm = contact_matrix_mixing(diseases='sir', beta=0.01)
+    sim = ss.Sim(people=ppl, diseases='sir', networks=cmm, start='2000-01-01', dur=ss.days(180),
+                 dt=ss.days(1), verbose=0)
+    sim.init()
+    return sim
+
+
+def build_sim(sim, calib_pars, **kwargs):
+    for k, pars in calib_pars.items():
+        if k == 'rand_seed':
+            reseed(sim, pars)
+        elif k == 'beta':
+            sim.diseases.sir.pars.beta = ss.perday(pars['value'])
+    return sim
+
+
+def eval_fn(sim):
+    return float(sim.results.sir.cum_infections[-1])
+
+
+if __name__ == '__main__':
+    snap = sim_snapshot.save(make_sim(), snap_file)
+    calib_pars = dict(beta=dict(low=0.01, high=0.5, log=True))
+    rows = []
+    for n_workers in [1, 2, 4, 8]:
+        if n_workers > os.cpu_count():
+            continue
+        if os.path.exists(db_name):
+            os.remove(db_name)
+        calib = calibration(snapshot=snap, calib_pars=calib_pars, build_fn=build_sim, eval_fn=eval_fn,
+                            n_reps=n_reps, total_trials=n_trials, n_workers=n_workers, db_name=db_name,
+                            keep_db=False, die=True, verbose=0)
+        T = sc.timer()
+        calib.calibrate()
+        elapsed = T.toc(output=True)
+        rows.append(dict(n_workers=n_workers, seconds=elapsed, reps_per_s=n_trials*n_reps/elapsed))
+    os.remove(snap_file)
+    df = pd.DataFrame(rows)
+    df['speedup'] = df.reps_per_s/df.reps_per_s[0]
+    print(f'{os.cpu_count()} cores, {int(n_agents):,} agents, {n_trials} trials x {n_reps} replicates')
+    print(df.to_string(index=False))
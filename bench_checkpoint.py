@@ -0,0 +1,83 @@
+"""
+Benchmark running scenarios that share a burn-in: each from the start, versus
+branching them all from one burn-in checkpoint
+
+Run with e.g.
+    python bench_checkpoint.py
+"""
+import os
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice, categorical
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_analyzers import infections_by_stratum
+from rsv_snapshot import sim_snapshot, run_branches
+
+age_data = pd.read_csv('age.csv')
+filename = 'bench_checkpoint.snap'
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+burn_in = 2008 # Scenarios differ over the last two of ten years
+betas = [0.05, 0.1, 0.2, 0.4]
+
+
+def make_sim(n_agents):
+    """ The sim from 06_demo """
+    location = categorical('location', levels=locations, default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    cmm = contact_matrix_mixing(diseases='sir', beta=0.1, contacts=read_matrix('contact_matrix.csv')*10)
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=locations)
+    sim = ss.Sim(diseases='sir', networks=cmm, people=ppl, analyzers=grp_counts,
+                 start=2000, stop=2010, dt=0.1, verbose=0)
+    return sim
+
+
+def build(sim, beta):
+    """ Change beta from where the sim is """
+    sim.networks.contact_matrix_mixing.pars.beta = beta
+    return sim
+
+
+def from_start(n_agents):
+    """ Run every scenario from the start, changing beta at the end of the burn-in """
+    out = {}
+    for beta in betas:
+        sim = make_sim(n_agents)
+        sim.init()
+        sim.run(until=burn_in)
+        sim = build(sim, beta)
+        sim.run()
+        out[beta] = sim.results.sir.cum_infections[-1]
+    return out
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e4, 1e5]:
+        n_agents = int(n_agents)
+        T = sc.timer()
+        start = from_start(n_agents)
+        t_start = T.toc(output=True)
+
+        T = sc.timer()
+        snap = sim_snapshot.checkpoint(make_sim(n_agents), until=burn_in, filename=filename)
+        t_burn = T.toc(output=True)
+        T = sc.timer()
+        branched = run_branches(snap, {beta: dict(beta=beta) for beta in betas}, build_fn=build, n_workers=1,
+                                eval_fn=lambda sim: sim.results.sir.cum_infections[-1])
+        t_branch = T.toc(output=True)
+        rows.append(dict(
+            n_agents = n_agents,
+            n_scenarios = len(betas),
+            from_start_s = t_start,
+            burn_in_s = t_burn,
+            branches_s = t_branch,
+            speedup = t_start / (t_burn + t_branch),
+            checkpoint_MB = snap.nbytes/1e6,
+            same_results = start == branched,
+        ))
+    os.remove(filename)
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
@@ -0,0 +1,78 @@
+"""
+Benchmark the RSV person function: the NumPy fallback vs the numba prange
+kernel on 1, 2, 4 and 8 threads, for 1e6 agents
+
+Run with e.g.
+    python bench_disease.py
+
+NB: threads beyond the number of cores will not speed anything up
+"""
+import os
+os.environ.setdefault('NUMBA_NUM_THREADS', str(max(8, os.cpu_count()))) # Must be set before numba is imported
+import numpy as np
+import pandas as pd
+import sciris as sc
+import numba as nb
+from rsv_disease import update_numpy, update_numba
+
+n_agents = int(1e6)
+n_reps = 20
+
+
+def make_args(n):
+    """ The struct-of-arrays state, partway through an epidemic """
+    rng = np.random.default_rng(1)
+    status = rng.choice(4, size=n, p=[.6, .1, .2, .1]) # susceptible, exposed, infectious, recovered
+    ti = 10.0
+    args = dict(
+        uids = np.arange(n),
+        rands = rng.random(n),
+        ti = ti,
+        dt = 1.0,
+        r_infect = 0.1,
+        home = 0,
+        susceptible = status == 0,
+        exposed = status == 1,
+        infected = (status == 1) | (status == 2),
+        lower = np.zeros(n, dtype=bool),
+        recovered = status == 3,
+        ti_infectious = ti + rng.integers(-3, 4, size=n).astype(float),
+        ti_lower = np.where(rng.random(n) < 0.2, ti + rng.integers(-3, 4, size=n), np.nan),
+        ti_recovered = ti + rng.integers(0, 8, size=n).astype(float),
+        load = rng.exponential(1, size=n),
+        rel_sus = np.ones(n),
+        pattern = rng.integers(0, 4, size=n),
+        usual_pattern = np.zeros(n, dtype=np.int64),
+        new = np.zeros(n, dtype=bool),
+    )
+    return args
+
+
+def time_it(fn, n_threads=None):
+    if n_threads is not None:
+        nb.set_num_threads(n_threads)
+    fn(**make_args(n_agents)) # Warm up (and compile)
+    total = 0
+    for i in range(n_reps):
+        args = make_args(n_agents)
+        T = sc.timer()
+        fn(**args)
+        total += T.toc(output=True)
+    return total/n_reps
+
+
+if __name__ == '__main__':
+    # Check that the two give the same result
+    a = make_args(10_000)
+    b = make_args(10_000)
+    update_numpy(**a)
+    update_numba(**b)
+    assert all(np.array_equal(a[k], b[k], equal_nan=True) for k in a), 'NumPy and numba results differ'
+
+    rows = [dict(version='numpy', threads=1, ms=time_it(update_numpy)*1e3)]
+    for n_threads in [1, 2, 4, 8]:
+        rows.append(dict(version='numba', threads=n_threads, ms=time_it(update_numba, n_threads)*1e3))
+    df = pd.DataFrame(rows)
+    df['speedup'] = df.ms[0]/df.ms
+    print(f'{n_agents:,} agents, {os.cpu_count()} cores')
+    print(df.to_string(index=False))
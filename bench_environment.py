@@ -0,0 +1,108 @@
+"""
+Benchmark the viral reservoir: a Python loop over spaces (as in NewDirections.md)
+vs the vectorized RK4 vs the numba kernel vs the exact update, checked against
+the exact solution, and the RK4 sub-steps needed for a long (0.1 year) step
+
+Run with e.g.
+    python bench_environment.py
+"""
+import numpy as np
+import pandas as pd
+import sciris as sc
+from rsv_environment import rk4_step, exact_step, n_rk4_steps, _rk4_kernel
+
+n_people_per_space = 3
+volume = 50.0
+decay = 1.0
+emission = 10.0
+h = 0.1
+n_steps = 10
+
+
+def loop_step(conc, space, infectious, h):
+    """ One step of the original loop: for each space, count the sick, then RK4 """
+    n_spaces = len(conc)
+    for si in range(n_spaces):
+        source = emission * np.sum(infectious[space == si])
+        c = conc[si]
+        k1 = source/volume - decay*c
+        k2 = source/volume - decay*(c + 0.5*h*k1)
+        k3 = source/volume - decay*(c + 0.5*h*k2)
+        k4 = source/volume - decay*(c + h*k3)
+        conc[si] = c + h/6*(k1 + 2*k2 + 2*k3 + k4)
+    return conc
+
+
+def vector_step(conc, space, infectious, h, kernel=None):
+    """ One step with a bincount for the sources and RK4 over all spaces at once """
+    source = np.bincount(space, weights=emission*infectious, minlength=len(conc))
+    if kernel is None:
+        rk4_step(conc, source, volume, decay, h)
+    else:
+        n = len(conc)
+        kernel(conc, source, np.full(n, volume), np.full(n, decay), h, 1)
+    return conc
+
+
+def exact_vector_step(conc, space, infectious, h):
+    """ One step with a bincount for the sources and the exact update over all spaces """
+    source = np.bincount(space, weights=emission*infectious, minlength=len(conc))
+    exact_step(conc, source, volume, decay, h)
+    return conc
+
+
+def setup(n_spaces):
+    rng = np.random.default_rng(1)
+    space = np.repeat(np.arange(n_spaces), n_people_per_space)
+    infectious = (rng.random(len(space)) < 0.1).astype(float)
+    return space, infectious
+
+
+def time_it(fn, n_spaces, reps):
+    space, infectious = setup(n_spaces)
+    conc = np.zeros(n_spaces)
+    fn(conc.copy(), space, infectious, h) # Warm up (and compile)
+    T = sc.timer()
+    for i in range(reps):
+        fn(conc, space, infectious, h)
+    return T.toc(output=True)/reps, conc
+
+
+if __name__ == '__main__':
+
+    # Check against the exact solution C(t) = S/(V*k) * (1 - exp(-k*t))
+    space, infectious = setup(1000)
+    conc = np.zeros(1000)
+    for i in range(n_steps):
+        vector_step(conc, space, infectious, h)
+    source = emission * np.bincount(space, weights=infectious, minlength=1000)
+    exact = source/(volume*decay) * (1 - np.exp(-decay*h*n_steps))
+    print(f'max relative error vs exact: {np.abs(conc - exact).max()/exact.max():.2e}')
+
+    # A 0.1 year step: a single RK4 step diverges, auto sub-steps and the exact update don't
+    long_h = 36.5
+    exact = source/(volume*decay) * (1 - np.exp(-decay*long_h))
+    one = rk4_step(np.zeros(1000), source, volume, decay, long_h, 1)
+    n_sub = n_rk4_steps(decay, long_h)
+    sub = rk4_step(np.zeros(1000), source, volume, decay, long_h/n_sub, n_sub)
+    ex = exact_step(np.zeros(1000), source, volume, decay, long_h)
+    for label, c in [('1 RK4 step', one), (f'{n_sub} RK4 steps', sub), ('exact', ex)]:
+        print(f'dt={long_h} days, {label}: max relative error {np.abs(c - exact).max()/exact.max():.2e}')
+
+    rows = []
+    for n_spaces in [1e3, 1e4, 1e5, 1e6]:
+        n_spaces = int(n_spaces)
+        row = dict(n_spaces=n_spaces)
+        if n_spaces <= 1e4:
+            row['loop_ms'] = time_it(loop_step, n_spaces, 1)[0]*1e3
+        t_vec, c_vec = time_it(vector_step, n_spaces, 20)
+        row['vector_ms'] = t_vec*1e3
+        row['exact_ms'] = time_it(exact_vector_step, n_spaces, 20)[0]*1e3
+        if _rk4_kernel is not None:
+            numba_step = lambda *args: vector_step(*args, kernel=_rk4_kernel)
+            t_nb, c_nb = time_it(numba_step, n_spaces, 20)
+            row['numba_ms'] = t_nb*1e3
+            assert np.allclose(c_vec, c_nb)
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
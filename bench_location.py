@@ -0,0 +1,59 @@
+"""
+Benchmark the age-conditional location assignment:
+the old per-agent random.choices() loop vs the vectorized age_choice() default
+
+Run with e.g.
+    python bench_location.py
+"""
+import random
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+
+age_data = pd.read_csv('age.csv')
+locs = [0, 1, 2]
+probs = [[.33, .33, .34],  # age < 19
+         [.20, .10, .70]]  # age 19+
+
+
+def make_sim(n_agents, default):
+    """ Make and initialize a minimal sim with a location state """
+    location = ss.FloatArr('location', default=default)
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    sim = ss.Sim(people=ppl, diseases='sir', networks='random', verbose=0)
+    return sim
+
+
+def run_loop(n_agents):
+    """ The original approach: placeholder state, then loop over agents after sim.init() """
+    sim = make_sim(n_agents, default=-1)
+    sim.init()
+    T = sc.timer()
+    for i in range(int(n_agents)):
+        if sim.people.age[i] < 19:
+            sim.people.location[i] = random.choices(locs, probs[0], k=1)[0]
+        else:
+            sim.people.location[i] = random.choices(locs, probs[1], k=1)[0]
+    return T.toc(output=True)
+
+
+def run_vectorized(n_agents):
+    """ The new approach: the state is drawn for everyone in one pass """
+    sim = make_sim(n_agents, default=age_choice(a=locs, p=probs, age_bins=(0, 19, 100)))
+    sim.init()
+    dist = sim.people.location.default
+    T = sc.timer()
+    dist.jump() # Draw again, so only the assignment itself is timed
+    sim.people.location[:] = dist.rvs(sim.people.auids)
+    return T.toc(output=True)
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e3, 1e4, 1e5]:
+        t_loop = run_loop(n_agents)
+        t_vec = run_vectorized(n_agents)
+        rows.append(dict(n_agents=int(n_agents), loop_s=t_loop, vectorized_s=t_vec, speedup=t_loop/t_vec))
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
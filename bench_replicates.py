@@ -0,0 +1,53 @@
+"""
+Benchmark running n_reps stochastic replicates as a MultiSim of separate sims
+versus as one sim with a replicates connector
+
+Run with e.g.
+    python bench_replicates.py
+"""
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+from rsv_networks import contact_matrix_mixing
+from rsv_analyzers import infections_by_stratum
+from rsv_replicates import replicates
+
+age_data = pd.read_csv('age.csv')
+n_reps = 8
+
+
+def make_sim(n_agents, n_reps=1, rand_seed=1):
+    location = ss.FloatArr('location', default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents*n_reps, age_data=age_data, extra_states=location)
+    rep_kw = dict(replicates='replicates') if n_reps > 1 else {}
+    cmm = contact_matrix_mixing(diseases='sir', beta=0.01, **rep_kw)
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], **rep_kw)
+    connectors = replicates(n_reps=n_reps) if n_reps > 1 else None
+    sim = ss.Sim(people=ppl, diseases='sir', networks=cmm, connectors=connectors, analyzers=grp_counts,
+                 start='2000-01-01', dur=ss.days(180), dt=ss.days(1), rand_seed=rand_seed, verbose=0)
+    return sim
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e3, 1e4, 1e5]:
+        n_agents = int(n_agents)
+        T = sc.timer()
+        msim = ss.MultiSim([make_sim(n_agents, rand_seed=i) for i in range(n_reps)], parallel=False)
+        msim.run()
+        t_multi = T.toc(output=True)
+        peak_multi = np.mean([s.analyzers[0].counts.sum(axis=1).max() for s in msim.sims])
+
+        T = sc.timer()
+        sim = make_sim(n_agents, n_reps)
+        sim.run()
+        t_reps = T.toc(output=True)
+        peak_reps = sim.analyzers[0].rep_counts.sum(axis=2).max(axis=0).mean()
+
+        rows.append(dict(n_agents=n_agents, n_reps=n_reps, multisim_s=t_multi, replicates_s=t_reps,
+                         speedup=t_multi/t_reps, multisim_peak=peak_multi, replicates_peak=peak_reps))
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
@@ -0,0 +1,70 @@
+"""
+Benchmark the time-of-day activity schedule: cost of a daily step with
+contact_matrix_mixing alone, vs with 4 and 6 sub-steps per day
+
+Run with e.g.
+    python bench_schedule.py
+"""
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+from rsv_networks import contact_matrix_mixing
+from rsv_schedule import activity_schedule
+
+age_data = pd.read_csv('age.csv')
+n_days = 60
+
+# 6 sub-steps: night, early morning, morning, afternoon, early evening, evening
+patterns_6 = [[0, 0, 0, 0, 0, 0],
+              [0, 0, 1, 1, 0, 0],
+              [0, 0, 2, 2, 2, 0],
+              [0, 0, 1, 2, 0, 0]]
+
+
+def make_sim(n_agents, n_sub=None):
+    """ Make a daily-timestep sim, optionally with a schedule of n_sub sub-steps """
+    location = ss.FloatArr('location', default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    if n_sub is None:
+        sched = None
+    elif n_sub == 4:
+        sched = activity_schedule()
+    elif n_sub == 6:
+        sched = activity_schedule(patterns=patterns_6)
+    cmm = contact_matrix_mixing(diseases='sir', beta=0.01, schedule=sched.name if sched else None)
+    sim = ss.Sim(people=ppl, diseases='sir', networks=cmm, connectors=sched,
+                 start='2000-01-01', dur=ss.days(n_days), dt=ss.days(1), verbose=0)
+    return sim
+
+
+def time_run(n_agents, n_sub=None):
+    sim = make_sim(n_agents, n_sub)
+    sim.init()
+    T = sc.timer()
+    sim.run()
+    return T.toc(output=True)/n_days
+
+
+def time_apply(n_agents):
+    """ Cost of a single sub-step location swap """
+    sim = make_sim(n_agents, n_sub=4)
+    sim.init()
+    sched = sim.connectors.activity_schedule
+    T = sc.timer()
+    for i in range(100):
+        sched.apply(i % sched.n_sub)
+    return T.toc(output=True)/100
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e5, 1e6]:
+        t_daily = time_run(n_agents)
+        t_4 = time_run(n_agents, 4)
+        t_6 = time_run(n_agents, 6)
+        rows.append(dict(n_agents=int(n_agents), daily_ms=t_daily*1e3, sub4_ms=t_4*1e3, sub6_ms=t_6*1e3,
+                         ratio4=t_4/t_daily, ratio6=t_6/t_daily, apply_ms=time_apply(n_agents)*1e3))
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
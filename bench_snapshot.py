@@ -0,0 +1,72 @@
+"""
+Benchmark the time to get a calibration trial's sim ready to run: rebuilding
+it (as make_sim() did), deep copying the initialized sim (as ss.Calibration
+does), or cloning a sim_snapshot
+
+Run with e.g.
+    python bench_snapshot.py
+"""
+import os
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+from rsv_groups import group_index
+from rsv_analyzers import infections_by_stratum
+from rsv_snapshot import sim_snapshot
+
+age_data = pd.read_csv('age.csv')
+filename = 'bench_snapshot.snap'
+n_reps = 5
+
+
+def make_sim(n_agents):
+    """ The sim from 05_demo """
+    location = ss.FloatArr('location', default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    age_breaks = [0, 20, 100]
+    locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+    grp_index = group_index(age_bins=age_breaks, locations=locations)
+    base_dict = grp_index.selectors()
+    mps = ss.MixingPools(diseases='sir', beta=1.2, src=base_dict, dst=base_dict, n_contacts=np.full((6, 6), 10.0))
+    grp_counts = infections_by_stratum(age_bins=age_breaks, locations=locations)
+    sim = ss.Sim(diseases='sir', networks=mps, connectors=grp_index, people=ppl, analyzers=grp_counts,
+                 start=2000, stop=2010, dt=0.1, verbose=0)
+    sim.init()
+    return sim
+
+
+def time_get(fn):
+    """ Mean time to get a sim ready for its first step, and the time of that step """
+    times = []
+    for i in range(n_reps):
+        T = sc.timer()
+        sim = fn()
+        times.append(T.toc(output=True))
+    T = sc.timer()
+    sim.run_one_step()
+    return np.mean(times), T.toc(output=True)
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e5, 3e5]:
+        base = make_sim(n_agents)
+        T = sc.timer()
+        snap = sim_snapshot.save(base, filename)
+        t_save = T.toc(output=True)
+        t_clone, t_step = time_get(snap.clone)
+        rows.append(dict(
+            n_agents = int(n_agents),
+            rebuild_s = time_get(lambda: make_sim(n_agents))[0],
+            deepcopy_s = time_get(lambda: sc.dcp(base))[0],
+            clone_s = t_clone,
+            first_step_s = t_step,
+            save_s = t_save,
+            snapshot_MB = snap.nbytes/1e6,
+        ))
+    os.remove(filename)
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
@@ -0,0 +1,235 @@
+"""
+Benchmark suite: time each phase of the demo configurations, and record their
+memory use, while sweeping the number of agents from 1e3 to 1e7
+
+Each (configuration, n_agents) runs in its own process, so its peak memory is
+its own and a run that runs out of memory doesn't stop the rest. Rows are
+appended to the CSV as they finish, along with the git commit and starsim
+version, so results from different versions can be compared.
+
+Run with e.g.
+    python bench_suite.py
+    python bench_suite.py --configs group_index contact_matrix --sizes 1e5 1e6 --years 2
+"""
+import os
+import sys
+import json
+import types
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import psutil
+from memory_profiler import memory_usage
+from rsv_states import age_choice
+from rsv_groups import group_index
+from rsv_networks import contact_matrix_mixing
+from rsv_contacts import read_matrix
+from rsv_analyzers import infections_by_stratum
+
+age_data = pd.read_csv('age.csv')
+locs = [0, 1, 2]
+probs = [[.33, .33, .34],  # age < 19
+         [.20, .10, .70]]  # age 19+
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CONFIGURATIONS
+#
+# Each returns the unbuilt sim, plus a function that (re)assigns the state the
+# demo assigns after sim.init() (location or urban), or None. The initial
+# location draw is part of init; assign_location() times a second draw over
+# the already initialized people, so it is reported as reassign_s.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def age_pools(n_agents, years):
+    """ 01_demo: two age pools """
+    ppl = ss.People(n_agents=n_agents, age_data=age_data)
+    mps = ss.MixingPools(diseases='sir', beta=1.2,
+                         src={'0-20': lambda sim: (sim.people.age < 20).uids, '20+': lambda sim: (sim.people.age >= 20).uids},
+                         dst={'0-20': lambda sim: (sim.people.age < 20).uids, '20+': lambda sim: (sim.people.age >= 20).uids},
+                         n_contacts=np.multiply([[1.0, 10.0], [1.0, 1.0]], 10))
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=['ALL'], codes=[1], state='alive')
+    sim = ss.Sim(diseases='sir', networks=mps, people=ppl, analyzers=grp_counts, start=2000, stop=2000+years, dt=0.1, verbose=0)
+    return sim, None
+
+
+def urban_pools(n_agents, years):
+    """ 02_demo: age x urban/rural pools, with urban set from age after init """
+    urban = ss.BoolState('urban')
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=urban)
+    def in_grp(young, is_urban):
+        return lambda sim: (((sim.people.age < 20) == young) & (sim.people.urban == is_urban)).uids
+    pools = {f'{a} - {u}': in_grp(young, is_urban) for a, young in [('0-20', True), ('20+', False)]
+             for u, is_urban in [('URBAN', True), ('RURAL', False)]}
+    n_contacts = np.multiply([[1, 1, 1, 1], [10, 1, 1, 1], [1, 1, 1, 1], [1, 1, 1, 1]], 10.0)
+    mps = ss.MixingPools(diseases='sir', beta=1.2, src=pools, dst=pools, n_contacts=n_contacts)
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=['RURAL', 'URBAN'], state='urban')
+    sim = ss.Sim(diseases='sir', networks=mps, people=ppl, analyzers=grp_counts, start=2000, stop=2000+years, dt=0.1, verbose=0)
+
+    def assign(sim):
+        sim.people.urban[:] = sim.people.age[sim.people.auids] > 19
+        return
+    return sim, assign
+
+
+def location_pools(n_agents, years, grp=False):
+    """ 03_demo: age x location pools with lambdas, or 04/05_demo: with a group_index (if grp) """
+    location = ss.FloatArr('location', default=age_choice(a=locs, p=probs, age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    if grp:
+        connectors = group_index(age_bins=[0, 20, 100], locations=locations)
+        pools = connectors.selectors()
+    else:
+        connectors = None
+        def in_grp(young, loc):
+            return lambda sim: (((sim.people.age < 20) == young) & (sim.people.location == loc)).uids
+        pools = {f'{a} - {name}': in_grp(young, li) for li, name in enumerate(locations)
+                 for a, young in [('0-20', True), ('20+', False)]}
+    mps = ss.MixingPools(diseases='sir', beta=1.2, src=pools, dst=pools, n_contacts=np.full((6, 6), 10.0))
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=locations)
+    sim = ss.Sim(diseases='sir', networks=mps, connectors=connectors, people=ppl, analyzers=grp_counts,
+                 start=2000, stop=2000+years, dt=0.1, verbose=0)
+    return sim, assign_location
+
+
+def group_index_pools(n_agents, years):
+    """ 04/05_demo: age x location pools from a group_index """
+    return location_pools(n_agents, years, grp=True)
+
+
+def contact_matrix(n_agents, years):
+    """ 06_demo: the full 60x60 contact matrix """
+    location = ss.FloatArr('location', default=age_choice(a=locs, p=probs, age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    cmm = contact_matrix_mixing(diseases='sir', beta=0.1, contacts=read_matrix('contact_matrix.csv')*10,
+                                age_bins=np.linspace(0, 100, 21), locations=locations)
+    grp_counts = infections_by_stratum(age_bins=[0, 20, 100], locations=locations)
+    sim = ss.Sim(diseases='sir', networks=cmm, people=ppl, analyzers=grp_counts, start=2000, stop=2000+years, dt=0.1, verbose=0)
+    return sim, assign_location
+
+
+def assign_location(sim):
+    """ Draw the location again for everyone, as the demos' age-conditional assignment does """
+    dist = sim.people.location.default
+    dist.jump()
+    sim.people.location[:] = dist.rvs(sim.people.auids)
+    return
+
+
+configs = dict(
+    age_pools = age_pools,
+    urban_pools = urban_pools,
+    location_pools = location_pools,
+    group_index = group_index_pools,
+    contact_matrix = contact_matrix,
+)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# ONE RUN (in a child process)
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def run_config(config, n_agents, years):
+    """ Build, init and run one configuration, timing each phase """
+    proc = psutil.Process()
+    row = dict()
+    T = sc.timer()
+    sim, assign = configs[config](n_agents, years)
+    row['build_s'] = T.toc(output=True)
+
+    # Time the analyzer separately from the rest of the run
+    analyzer = sim.pars.analyzers[0] if isinstance(sim.pars.analyzers, list) else sim.pars.analyzers
+    orig_step = analyzer.step
+    analyzer_time = [0.0]
+    def step(self): # Named step, since the sim's loop looks modules' steps up by name
+        t0 = sc.tic()
+        orig_step()
+        analyzer_time[0] += sc.toc(t0, output=True)
+        return
+    analyzer.step = types.MethodType(step, analyzer)
+
+    T = sc.timer()
+    sim.init()
+    row['init_s'] = T.toc(output=True)
+    row['init_rss_MB'] = proc.memory_info().rss/1e6
+
+    T = sc.timer()
+    if assign is not None:
+        assign(sim) # Urban from age (02_demo), or a re-draw of every location (the first draw is in init_s)
+    row['reassign_s'] = T.toc(output=True)
+
+    T = sc.timer()
+    sim.run()
+    elapsed = T.toc(output=True)
+    row['analyzer_s'] = analyzer_time[0]
+    row['run_s'] = elapsed - analyzer_time[0]
+    row['n_steps'] = sim.t.npts
+    row['rss_MB'] = proc.memory_info().rss/1e6
+    return row
+
+
+def child(config, n_agents, years):
+    """ Run one configuration, and print its row as JSON """
+    peak, row = memory_usage((run_config, (config, n_agents, years)), interval=0.05, max_usage=True, retval=True)
+    row['peak_rss_MB'] = peak * 1.048576 # MiB -> MB
+    print(json.dumps(row))
+    return
+
+
+info_columns = ['commit', 'starsim', 'python', 'cpus', 'mem_GB']
+columns = info_columns + ['config', 'n_agents', 'years', 'build_s', 'init_s', 'init_rss_MB', 'reassign_s',
+                          'analyzer_s', 'run_s', 'n_steps', 'rss_MB', 'peak_rss_MB', 'error'] # Every row has all of these, in this order
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--configs', nargs='+', default=list(configs.keys()), choices=list(configs.keys()))
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--years', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds before a run is abandoned')
+    parser.add_argument('--out', default='bench_suite.csv')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        config, n_agents, years = args.child
+        return child(config, int(float(n_agents)), float(years))
+
+    info = dict(commit=git_commit(), starsim=ss.__version__, python=sys.version.split()[0],
+                cpus=os.cpu_count(), mem_GB=round(psutil.virtual_memory().total/1e9, 1))
+    for config in args.configs:
+        for n_agents in args.sizes:
+            row = dict(info, config=config, n_agents=int(n_agents), years=args.years)
+            cmd = [sys.executable, __file__, '--child', config, str(n_agents), str(args.years)]
+            try:
+                out = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout)
+                if out.returncode == 0:
+                    row.update(json.loads(out.stdout.strip().splitlines()[-1]))
+                elif out.returncode == -9:
+                    row['error'] = 'out of memory'
+                else:
+                    lines = out.stderr.strip().splitlines()
+                    row['error'] = lines[-1] if lines else f'exited with code {out.returncode}'
+            except subprocess.TimeoutExpired:
+                row['error'] = f'timed out after {args.timeout:n} s'
+            df = pd.DataFrame([row]).reindex(columns=columns) # So failed and successful rows line up under one header
+            df.to_csv(args.out, mode='a', header=not os.path.exists(args.out), index=False)
+            print(df.to_string(index=False, header=True))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark the per-step cost of transmission within hundreds of thousands of
+venues (venue_mixing) versus six age x location mixing pools (04_demo)
+
+Run with e.g.
+    python bench_venues.py
+"""
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice, categorical
+from rsv_groups import group_index
+from rsv_population import venues
+from rsv_networks import venue_mixing
+
+age_data = pd.read_csv('age.csv')
+locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+
+
+def make_sim(n_agents, route):
+    location = categorical('location', levels=locations, default=age_choice(
+        a=[0, 1, 2], p=[[.33, .33, .34], [.20, .10, .70]], age_bins=(0, 19, 100)))
+    ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+    if route == 'venues':
+        connectors = venues()
+        networks = venue_mixing(diseases='sir', beta=1.0, contacts=dict(house=3, school=10, work=5, community=1))
+    else:
+        connectors = group_index(age_bins=[0, 20, 100], locations=locations)
+        networks = ss.MixingPools(diseases='sir', beta=1.2, src=connectors.selectors(), dst=connectors.selectors(),
+                                  n_contacts=np.full((6, 6), 10.0))
+    sim = ss.Sim(people=ppl, diseases='sir', networks=networks, connectors=connectors,
+                 start='2000-01-01', dur=ss.days(60), dt=ss.days(1), rand_seed=1, verbose=0)
+    return sim
+
+
+if __name__ == '__main__':
+    rows = []
+    for n_agents in [1e4, 1e5, 1e6]:
+        n_agents = int(n_agents)
+        for route in ['pools', 'venues']:
+            sim = make_sim(n_agents, route)
+            sim.init()
+            net = sim.networks[0]
+            T = sc.timer()
+            sim.run()
+            elapsed = T.toc(output=True)
+            row = dict(n_agents=n_agents, route=route, run_s=elapsed, ms_per_step=elapsed/sim.t.npts*1e3,
+                       cum_infections=sim.results.sir.cum_infections[-1])
+            if route == 'venues':
+                row.update(n_venues=len(net), memberships=net.M.nnz)
+            rows.append(row)
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
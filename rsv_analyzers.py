@@ -0,0 +1,442 @@
+"""
+Analyzers for the RSV demos
+"""
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import matplotlib.pyplot as plt
+from rsv_groups import group_names, group_keys
+from rsv_results import column_store, column_writer, read_results
+
+__all__ = ['infections_by_stratum', 'streamed_infections', 'transmission_log']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# STRATIFIED INFECTION COUNTS
+#
+# infections_by_grp builds a new mask for every age bin and every location and
+# appends Python ints to a dict of lists. This does the same thing with one
+# stratum key per infected agent and a single bincount per step, written into
+# a preallocated (n_steps x n_strata) array.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class infections_by_stratum(ss.Analyzer):
+    """
+    Count infections by age band and location (or any other categorical state)
+
+    Strata are ordered location-major, like group_index, and the counts are in
+    self.counts with shape (n_steps, n_strata). With replicates, the counts of
+    each replicate are in self.rep_counts (n_steps, n_reps, n_strata), and
+    self.counts is their mean.
+
+    Args:
+        age_bins (array): age band edges, e.g. (0, 20, 100)
+        locations (list): names of the categories of the state
+        codes (array): the value of the state for each category (default 0, 1, 2, ...)
+        state (str): the name of the people state to stratify by, e.g. 'location' or 'activity_schedule.pattern'
+        disease (str): the disease to count (default: the first one)
+        attr (str): the disease state to count (default 'infected')
+        replicates (str): if given, the name of a replicates connector to count each replicate separately
+    """
+    def __init__(self, age_bins=(0, 20, 100), locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'),
+                 codes=None, state='location', disease=None, attr='infected', replicates=None, **kwargs):
+        super().__init__(**kwargs)
+        self.age_bins = np.asarray(age_bins, dtype=float)
+        self.locations = list(locations)
+        self.codes = np.arange(len(self.locations)) if codes is None else np.asarray(codes)
+        self.state = state
+        self.disease = disease
+        self.attr = attr
+        self.replicates = replicates
+        self.strata = group_names(self.age_bins, self.locations)
+        self.n_strata = len(self.strata)
+        self.counts = None
+        self.rep_counts = None
+        self.n_done = 0 # The number of steps counted so far
+        return
+
+    def init_post(self):
+        super().init_post()
+        if self.replicates is None:
+            self.counts = np.zeros((self.t.npts, self.n_strata), dtype=np.int64)
+        else:
+            n_reps = self.sim.connectors[self.replicates].n_reps
+            self.rep_counts = np.zeros((self.t.npts, n_reps, self.n_strata), dtype=np.int64)
+            self.counts = np.zeros((self.t.npts, self.n_strata))
+        return
+
+    def count(self):
+        """ The counts of this step, with shape (n_reps, n_strata) (one row without replicates) """
+        disease = self.sim.diseases[self.disease] if self.disease else self.sim.diseases[0]
+        uids = getattr(disease, self.attr).uids
+        ppl = self.sim.people
+        loc = ppl.states[self.state].raw[uids]
+        key = group_keys(ppl.age.raw[uids], loc, self.age_bins, self.codes)
+        n_reps = 1
+        if self.replicates is not None:
+            reps = self.sim.connectors[self.replicates]
+            rep = reps.replicate.raw[uids].astype(np.int64)
+            key = np.where((key >= 0) & (rep >= 0), rep*self.n_strata + key, -1)
+            n_reps = reps.n_reps
+        counts = np.bincount(key[key >= 0], minlength=n_reps*self.n_strata)
+        return counts.reshape(n_reps, self.n_strata)
+
+    def step(self):
+        counts = self.count()
+        if self.replicates is None:
+            self.counts[self.ti] = counts[0]
+        else:
+            self.rep_counts[self.ti] = counts
+            self.counts[self.ti] = counts.mean(axis=0)
+        self.n_done = self.ti + 1
+        return
+
+    def get_counts(self):
+        """ The counts of the steps run so far (the mean over replicates, if any) """
+        return self.counts[:self.n_done]
+
+    def mismatch(self, expected):
+        """
+        Mean squared difference between the counts so far and the expected counts
+
+        Only the steps run so far are compared, so this can be used part way
+        through a run (e.g. to prune calibration trials).
+
+        Args:
+            expected (array/dataframe): (n_steps x n_strata) expected counts, or a dataframe with a column for
+                each stratum (like to_df()); NaN entries are skipped
+        """
+        if isinstance(expected, pd.DataFrame):
+            expected = expected[self.strata].values
+        counts = self.get_counts()
+        expected = np.asarray(expected, dtype=float)[:len(counts)]
+        diff = counts[:len(expected)] - expected
+        return float(np.nanmean(diff**2)) if np.isfinite(diff).any() else np.nan
+
+    def to_df(self):
+        """ Return the counts as a dataframe, one row per timestep and one column per stratum """
+        df = pd.DataFrame(self.counts, columns=self.strata)
+        df.insert(0, 'year', self.t.yearvec)
+        return df
+
+    def save(self, filename):
+        """ Save the counts to an .npz or .parquet file """
+        filename = sc.path(filename)
+        if filename.suffix == '.npz':
+            reps = dict(rep_counts=self.rep_counts) if self.rep_counts is not None else {}
+            np.savez_compressed(filename, counts=self.counts, year=self.t.yearvec, strata=np.array(self.strata), **reps)
+        elif filename.suffix == '.parquet':
+            self.to_df().to_parquet(filename)
+        else:
+            raise ValueError(f'Can only save to .npz or .parquet, not "{filename.suffix}"')
+        return filename
+
+    def plot(self):
+        plt.figure()
+        counts = self.get_counts()
+        x = self.sim.t.tvec[:len(counts)]
+        styles = ['solid', 'dashed', 'dotted', 'dashdot']
+        for si, name in enumerate(self.strata):
+            li = si // (len(self.age_bins) - 1)
+            plt.plot(x, counts[:, si], linestyle=styles[li % len(styles)], label=f'Age {name.lower()}')
+        plt.legend(frameon=False)
+        plt.xlabel('Model time')
+        plt.ylabel('Individuals infected')
+        plt.ylim(bottom=0)
+        sc.boxoff()
+        plt.show()
+        return
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# STREAMED COUNTS
+#
+# infections_by_stratum holds (n_steps x n_reps x n_strata) counts in memory
+# until the run ends. For long horizons, many replicates, or to watch a
+# calibration or sweep as it goes, write each step's counts to a compressed
+# columnar file instead, a chunk of steps at a time (see rsv_results).
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class streamed_infections(infections_by_stratum):
+    """
+    Count infections by stratum like infections_by_stratum, but write them to a file as the run goes
+
+    Each step adds one row per replicate (one row without replicates), with
+    columns ti, year, rep (with replicates) and one per stratum, and every
+    chunk_size steps the rows are compressed and appended to the file. Memory
+    use is one chunk, whatever the horizon or number of replicates, and
+    read_results(filename) gives the counts so far at any point during the run.
+
+    The filename can include {label} and {rand_seed}, filled in from the sim
+    when the first step is written, so that each trial or run of a sweep gets
+    its own file, e.g. 'results/infections_{rand_seed}.rsvc'.
+
+    Args:
+        filename (str/path): the file to write
+        chunk_size (int): the number of steps per chunk
+        level (int): the zstd compression level
+        **kwargs: as for infections_by_stratum
+
+    **Example**:
+
+        counts = streamed_infections(filename='infections.rsvc', age_bins=[0, 20, 100], locations=locations)
+        sim = ss.Sim(..., analyzers=counts)
+        sim.run()
+        df = read_results('infections.rsvc') # Also works during the run
+    """
+    def __init__(self, filename='infections.rsvc', chunk_size=100, level=3, **kwargs):
+        super().__init__(**kwargs)
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.level = level
+        self.writer = None
+        return
+
+    def init_post(self):
+        ss.Analyzer.init_post(self) # No in-memory counts
+        self.n_reps = 1 if self.replicates is None else self.sim.connectors[self.replicates].n_reps
+        columns = dict(ti=np.int32, year=np.float64)
+        if self.replicates is not None:
+            columns['rep'] = np.int16
+        columns.update({stratum: np.int32 for stratum in self.strata})
+        meta = dict(strata=self.strata, age_bins=self.age_bins.tolist(), locations=self.locations, n_reps=self.n_reps)
+        self.writer = column_writer(self.filename, columns, chunk_size=self.chunk_size*self.n_reps, level=self.level, meta=meta)
+        return
+
+    def step(self):
+        writer = self.writer
+        if writer.n_written == 0 and writer.n_buffered == 0 and writer.filename == sc.path(self.filename): # The sim is now built, so fill in the filename (unless it was forked)
+            writer.filename = sc.path(str(self.filename).format(label=self.sim.label, rand_seed=self.sim.pars.rand_seed))
+        counts = self.count()
+        cols = {stratum: counts[:, si] for si, stratum in enumerate(self.strata)}
+        if self.replicates is not None:
+            cols['rep'] = np.arange(self.n_reps)
+        writer.append(ti=self.ti, year=self.t.yearvec[self.ti], **cols)
+        self.n_done = self.ti + 1
+        return
+
+    def finalize(self):
+        super().finalize()
+        self.writer.close()
+        return
+
+    def to_df(self):
+        """ Read back the rows written so far, one per step (and replicate) """
+        self.writer.flush()
+        return read_results(self.writer.filename)
+
+    def get_counts(self):
+        """ The counts of the steps run so far (the mean over replicates, if any), read back from the file """
+        df = self.to_df()
+        counts = df[self.strata].values.reshape(-1, self.n_reps, self.n_strata)
+        return counts.mean(axis=1) if self.n_reps > 1 else counts[:, 0]
+
+    def save(self, filename=None):
+        """ The counts are already in the file, so just flush any buffered rows and return its name """
+        self.writer.flush()
+        return self.writer.filename
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# TRANSMISSION EVENT LOG
+#
+# The 12.15 question (kids get sick at school, then infect their parents at
+# home) needs who infected whom, and where. starsim's ss.infection_log keeps a
+# networkx graph, with a Python call per edge. Instead, each infection is one
+# row of a few typed columns (timestep, source, target, locations and age
+# bands), appended in bulk per step into preallocated chunk buffers, and the
+# queries afterwards are bincounts over those columns.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class _log_hook:
+    """ Stands in for a disease's infection_log, which starsim calls with each step's new infections """
+    def __init__(self, log, disease):
+        self.log = log
+        self.disease = disease
+        return
+
+    def add_entries(self, uids, sources, now):
+        self.log.record(self.disease, uids, sources)
+        return
+
+    def add_data(self, uids, **kwargs):
+        """ Nothing to do: starsim uses this to annotate entries (e.g. NCD deaths), which the log doesn't keep """
+        return
+
+
+class transmission_log(ss.Analyzer):
+    """
+    Record every infection: timestep, source and target uids, their locations and age bands
+
+    Routes that only know which group was infected (like contact_matrix_mixing)
+    are asked to attribute_sources(); where a source can't be attributed (e.g.
+    ss.MixingPools, or the initial infections), it is -1, as are its location
+    and band. The location is where the target was when infected: with an
+    activity schedule, routes that attribute sources also report the location
+    of the sub-step each infection happened in (and of its source); otherwise
+    it is the location at the end of the step.
+
+    Rows are kept in memory in chunks, or, if a filename is given, compressed
+    and appended to it a chunk at a time (see rsv_results), so that memory stays
+    flat and the log can be read during the run.
+
+    Args:
+        age_bins (array): age band edges, e.g. (0, 20, 100)
+        locations (list): names of the categories of the state
+        codes (array): the value of the state for each category (default 0, 1, 2, ...)
+        state (str): the name of the people state holding the location
+        filename (str/path): if given, write the log to this file instead of keeping it in memory
+        chunk_size (int): the number of events per chunk
+
+    **Example**:
+
+        log = transmission_log(age_bins=[0, 20, 100], locations=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'])
+        sim = ss.Sim(..., networks=contact_matrix_mixing(...), analyzers=log)
+        sim.run()
+        log.count(['source_location', 'location']) # e.g. school -> household infections
+        log.who_infected_whom('band')
+    """
+    columns = dict(ti=np.int32, source=np.int64, target=np.int64, source_location=np.int8,
+                   location=np.int8, source_band=np.int8, band=np.int8)
+
+    def __init__(self, age_bins=(0, 20, 100), locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'), codes=None,
+                 state='location', filename=None, chunk_size=100_000, **kwargs):
+        super().__init__(**kwargs)
+        self.age_bins = np.asarray(age_bins, dtype=float)
+        self.locations = list(locations)
+        self.codes = np.arange(len(self.locations)) if codes is None else np.asarray(codes)
+        self.bands = [f'{lo:n}-{hi:n}' for lo, hi in zip(self.age_bins[:-1], self.age_bins[1:])]
+        self.state = state
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.store = None
+        return
+
+    def init_pre(self, sim):
+        """ Hook into the diseases before their init_post(), so the initial infections are logged too """
+        super().init_pre(sim)
+        meta = dict(age_bins=self.age_bins.tolist(), locations=self.locations)
+        if self.filename is None:
+            self.store = column_store(self.columns, chunk_size=self.chunk_size)
+        else:
+            self.store = column_writer(self.filename, self.columns, chunk_size=self.chunk_size, meta=meta)
+        for disease in sim.diseases.values():
+            disease.infection_log = _log_hook(self, disease)
+        return
+
+    def bands_and_locations(self, uids, loc=None):
+        """ The age band and location index of each agent (-1 if none), from their current location unless given """
+        ppl = self.sim.people
+        band = np.searchsorted(self.age_bins, ppl.age.raw[uids], side='right') - 1
+        band[(band < 0) | (band >= len(self.bands))] = -1
+        if loc is None:
+            loc = ppl.states[self.state].raw[uids]
+        li = np.searchsorted(self.codes, loc)
+        li[li >= len(self.codes)] = 0
+        li = np.where(self.codes[li] == loc, li, -1)
+        return band, li
+
+    def record(self, disease, uids, sources):
+        """ Append this step's infections """
+        targets = ss.uids(uids)
+        if len(targets) == 0:
+            return
+        if sources is None:
+            src = np.full(len(targets), -1, dtype=np.int64)
+        else:
+            sources = np.broadcast_to(np.asarray(sources, dtype=float), targets.shape) # A scalar -1 for the seeds
+            src = np.where(np.isnan(sources) | (sources < 0), -1, sources).astype(np.int64)
+
+        # Ask the routes that can to attribute the sources starsim doesn't know, and where the infections happened
+        state = self.sim.people.states[self.state].raw
+        where = state[targets].astype(np.int64)
+        src_where = np.full(len(src), -1, dtype=np.int64)
+        for route in self.sim.networks.values():
+            missing = np.nonzero(src < 0)[0]
+            if not len(missing):
+                break
+            if hasattr(route, 'attribute_sources') and disease.name in getattr(route, 'last', {}):
+                theirs = missing[np.isin(targets[missing], route.last[disease.name][0])]
+                src[theirs], tloc, sloc = route.attribute_sources(disease, targets[theirs], return_locations=True)
+                if route.pars.state == self.state:
+                    where[theirs] = np.where(tloc >= 0, tloc, where[theirs])
+                    src_where[theirs] = sloc
+
+        band, loc = self.bands_and_locations(targets, where)
+        has_src = src >= 0
+        src_band = np.full(len(src), -1)
+        src_loc = np.full(len(src), -1)
+        known = src_where >= 0 # Where the route said the source was, else where they are now
+        src_where[has_src & ~known] = state[src[has_src & ~known]]
+        src_band[has_src], src_loc[has_src] = self.bands_and_locations(src[has_src], src_where[has_src])
+        self.store.append(ti=self.sim.ti, source=src, target=targets, source_location=src_loc,
+                          location=loc, source_band=src_band, band=band)
+        return
+
+    def step(self):
+        """ Nothing to do: infections are recorded as they happen """
+        return
+
+    def finalize(self):
+        super().finalize()
+        if self.filename is not None:
+            self.store.close()
+        return
+
+    def arrays(self):
+        """ Every event so far, as one array per column """
+        return self.store.arrays()
+
+    def to_df(self):
+        """ Every event, with the locations and age bands by name """
+        df = pd.DataFrame(self.arrays())
+        df.insert(1, 'year', self.t.yearvec[df.ti.values])
+        for col, names in [('source_location', self.locations), ('location', self.locations),
+                           ('source_band', self.bands), ('band', self.bands)]:
+            df[col] = pd.Categorical.from_codes(df[col].values, categories=names) # -1 is NaN
+        return df
+
+    def count(self, by='location'):
+        """
+        Count the events by one or more of the columns, e.g. ['source_location', 'location']
+
+        Returns:
+            A series indexed by the (named) values of the columns, including
+            those with no events; unattributed sources (-1) are left out
+        """
+        by = sc.tolist(by)
+        cols = self.arrays()
+        sizes = [self.size_of(col) for col in by]
+        key = np.zeros(len(cols['ti']), dtype=np.int64)
+        valid = np.ones(len(key), dtype=bool)
+        for col, size in zip(by, sizes):
+            vals = cols[col].astype(np.int64)
+            valid &= vals >= 0
+            key = key*size + vals
+        counts = np.bincount(key[valid], minlength=int(np.prod(sizes)))
+        index = pd.MultiIndex.from_product([self.labels_of(col) for col in by], names=by)
+        return pd.Series(counts, index=index if len(by) > 1 else index.get_level_values(0), name='infections')
+
+    def size_of(self, col):
+        if col in ('location', 'source_location'):
+            return len(self.locations)
+        elif col in ('band', 'source_band'):
+            return len(self.bands)
+        elif col == 'ti':
+            return self.t.npts
+        raise ValueError(f'Can only count by the location, band or ti columns, not "{col}"')
+
+    def labels_of(self, col):
+        if col in ('location', 'source_location'):
+            return self.locations
+        elif col in ('band', 'source_band'):
+            return self.bands
+        return np.arange(self.t.npts)
+
+    def who_infected_whom(self, by='location'):
+        """ The number of infections from each source (rows) to each target (columns) location or age band """
+        return self.count([f'source_{by}', by]).unstack()
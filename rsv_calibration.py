@@ -0,0 +1,427 @@
+"""
+Calibration helpers for the RSV demos
+"""
+import gc
+import warnings
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import optuna as op
+from scipy.stats import qmc
+from rsv_snapshot import sim_snapshot, reseed
+
+__all__ = ['calibration', 'reseed', 'screen']
+
+
+def screen(fit_fn, calib_pars, n_samples=1000, keep=0.05, margin=0.0, seed=None):
+    """
+    Screen many parameter sets with a cheap model, and narrow calib_pars to the best of them
+
+    The parameter sets are a Latin hypercube over the ranges in calib_pars
+    (log-uniform where log=True). The narrowed calib_pars span the best `keep`
+    fraction of them, with the best as the guess, ready for the agent-based
+    calibration. Since the cheap model is only an approximation, the range can
+    be widened by a margin on each side.
+
+    Args:
+        fit_fn (func): called as fit_fn(pars), with a dict of parameter values; lower is better
+        calib_pars (dict): the calibration parameters, as for ss.Calibration
+        n_samples (int): the number of parameter sets to try
+        keep (float): the fraction of them to keep
+        margin (float): widen the range of the kept sets by this fraction of its width on each side (on a log scale if log=True)
+        seed (int): the random seed for the sampling
+
+    Returns:
+        (narrowed calib_pars, dataframe of every parameter set and its fit, best first)
+
+    **Example**:
+
+        ode = metapop_ode.from_sim(sim)
+        fit = lambda pars: np.mean((ode.run(days, beta=pars['beta']).I.sum(axis=1) - data)**2)
+        calib_pars, df = screen(fit, calib_pars, n_samples=2000)
+        calib = calibration(sim, calib_pars=calib_pars, ...)
+    """
+    names = list(calib_pars.keys())
+    u = qmc.LatinHypercube(d=len(names), seed=seed).random(n_samples)
+    samples = {}
+    for i, name in enumerate(names):
+        spec = calib_pars[name]
+        lo, hi = spec['low'], spec['high']
+        if spec.get('log', False):
+            vals = np.exp(np.log(lo) + u[:, i]*(np.log(hi) - np.log(lo)))
+        else:
+            vals = lo + u[:, i]*(hi - lo)
+        if spec.get('suggest_type', 'suggest_float') == 'suggest_int':
+            vals = np.round(vals).astype(int)
+        samples[name] = vals
+
+    df = pd.DataFrame(samples)
+    df['fit'] = [fit_fn({name: df[name].iloc[j] for name in names}) for j in range(n_samples)]
+    df = df.sort_values('fit', ignore_index=True)
+
+    best = df.iloc[:max(int(np.ceil(keep*n_samples)), 1)]
+    narrowed = sc.dcp(calib_pars)
+    for name in names:
+        spec = calib_pars[name]
+        log = spec.get('log', False)
+        tr, inv = (np.log, np.exp) if log else (lambda x: x, lambda x: x)
+        lo, hi = tr(best[name].min()), tr(best[name].max())
+        lo, hi = lo - margin*(hi - lo), hi + margin*(hi - lo)
+        lo, hi = max(inv(lo), spec['low']), min(inv(hi), spec['high'])
+        if spec.get('suggest_type', 'suggest_float') == 'suggest_int':
+            lo, hi = int(np.floor(lo)), int(np.ceil(hi))
+        else:
+            lo, hi = float(lo), float(hi)
+        narrowed[name].update(low=lo, high=hi, guess=best[name].iloc[0].item())
+    return narrowed, df
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CALIBRATION FROM A SNAPSHOT
+#
+# ss.Calibration deep copies the base sim at the start of every trial, and its
+# workers each run whole trials, so the replicates of a trial (a serial
+# MultiSim in 05_demo) can't be spread out. Here, the main process asks optuna
+# for trials and sends every (trial, replicate) to a process pool; each task
+# clones the sim from a sim_snapshot, whose file is mapped by every worker, so
+# the base population sits in the shared page cache once and is never pickled.
+# The study is kept in SQLite, so a killed calibration picks up where it left off.
+#
+# With checkpoints, each replicate pauses at a few points in its run and records
+# an intermediate fit on the trial in the database; once every replicate has
+# reached a checkpoint, their mean is reported, and the study's pruner (median
+# by default) can stop a trial that is already doing badly. The pruner thus sees
+# the same replicate-averaged signal as the final fit, not whichever seed got
+# there first.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+_worker_calib = None # The calibration, in each worker process
+
+
+def _init_worker(calib):
+    global _worker_calib
+    _worker_calib = calib
+    return
+
+
+def _run_task(calib_pars, rep, trial_id=None):
+    """ Run one replicate of one trial in a worker, and return its fit """
+    trial = _worker_calib.load_trial(trial_id) if trial_id is not None else None
+    return _worker_calib.run_rep(calib_pars, rep, trial)
+
+
+class calibration(ss.Calibration):
+    """
+    ss.Calibration, with trials and their replicates run across a process pool,
+    each starting from a clone of a sim_snapshot
+
+    The fit of a trial is the mean of the fits of its n_reps replicates; the
+    replicates differ in their rand_seed (the trial's seed + the replicate).
+    Unlike ss.Calibration, the study database is kept and continued by default:
+    calling calibrate() again (e.g. after the process was killed) only runs the
+    trials still needed to reach total_trials, and re-runs any that were cut off.
+
+    With checkpoints, every replicate evaluates checkpoint_fn(sim) part way
+    through its run, the mean over the replicates is reported to the pruner at
+    each checkpoint, and the whole trial is pruned (and its sims freed) as soon
+    as the pruner says so. Run serially, the replicates of a trial advance in
+    lockstep; across a pool, each replicate records its fit on the trial and
+    the last to reach a checkpoint reports the mean. checkpoint_fn must work on
+    a partly run sim, e.g. using infections_by_stratum.mismatch(); it defaults
+    to eval_fn.
+
+    Args:
+        sim (ss.Sim): the base sim; optional if a snapshot is given
+        snapshot (sim_snapshot/str): the snapshot (or its filename) to clone each trial's sim from
+        n_reps (int): the number of replicates per trial
+        checkpoints (int/list): the number of evenly spaced checkpoints, or the time indices to check at (default: no pruning)
+        checkpoint_fn (func): the intermediate fit, called as checkpoint_fn(sim, **eval_kw)
+        pruner (op.pruners.BasePruner): the optuna pruner (default: op.pruners.MedianPruner() with checkpoints)
+        kwargs (dict): passed to ss.Calibration, e.g. n_workers, total_trials, db_name
+
+    **Example**:
+
+        snap = sim_snapshot.save(make_sim(), 'base.snap')
+        calib = calibration(snapshot=snap, calib_pars=calib_pars, build_fn=build_sim, n_reps=3)
+        calib.calibrate()
+
+        # Prune at 5 points, comparing the first part of the run to the data
+        fit = lambda sim: sim.analyzers.infections_by_stratum.mismatch(data)
+        calib = calibration(snapshot=snap, calib_pars=calib_pars, build_fn=build_sim, eval_fn=fit, checkpoints=5)
+    """
+    def __init__(self, sim=None, calib_pars=None, snapshot=None, n_reps=1, total_trials=None,
+                 continue_db=True, keep_db=True, checkpoints=None, checkpoint_fn=None, pruner=None, **kwargs):
+        if snapshot is not None and not isinstance(snapshot, sim_snapshot):
+            snapshot = sim_snapshot(snapshot)
+        if sim is None:
+            if snapshot is None:
+                raise ValueError('Please supply a sim or a snapshot')
+            sim = snapshot.clone()
+        if total_trials is None:
+            total_trials = 100
+        super().__init__(sim=sim, calib_pars=calib_pars, total_trials=total_trials, continue_db=continue_db,
+                         keep_db=keep_db, **kwargs)
+        self.snapshot = snapshot
+        self.n_reps = n_reps
+        self.total_trials = total_trials
+        self.checkpoints = checkpoints
+        self.checkpoint_fn = checkpoint_fn
+        if pruner is None and checkpoints is not None:
+            pruner = op.pruners.MedianPruner()
+        self.pruner = pruner
+        self._study = None # The study as seen by this process, for reporting to the pruner
+        return
+
+    def __getstate__(self):
+        """ With a snapshot, the workers clone their own sims, so don't send them the base sim """
+        state = self.__dict__.copy()
+        state['_study'] = None
+        if self.snapshot is not None:
+            state['sim'] = None
+        return state
+
+    def load_trial(self, trial_id):
+        """ A running trial from the study database, so that a worker can report to the pruner """
+        if self._study is None:
+            self._study = op.load_study(storage=self.run_args.storage, study_name=self.run_args.study_name,
+                                        pruner=self.pruner)
+        return op.trial.Trial(self._study, trial_id)
+
+    def checkpoint_steps(self, sim):
+        """ The time indices to report at: the given ones, or n evenly spaced ones """
+        npts = sim.t.npts
+        if np.isscalar(self.checkpoints):
+            steps = np.linspace(sim.ti, npts-1, int(self.checkpoints)+2)[1:-1].round()
+        else:
+            steps = np.asarray(self.checkpoints)
+        steps = np.unique(steps.astype(int))
+        return steps[(steps > sim.ti) & (steps < npts-1)] # Not before where the sim starts (e.g. from a checkpoint); the last step is the final fit
+
+    def copy_sim(self):
+        """ A fresh copy of the base sim, from the snapshot if there is one """
+        if self.snapshot is not None:
+            return self.snapshot.clone()
+        return sc.dcp(self.sim)
+
+    def report(self, trial, step, rep, fit):
+        """
+        Record one replicate's fit at a checkpoint, and report the mean to the
+        trial once every replicate has reached it
+        """
+        if self.n_reps == 1:
+            trial.report(fit, step=step)
+            return
+        trial.set_user_attr(f'checkpoint_{step}_{rep}', float(fit))
+        attrs = trial.storage.get_trial_user_attrs(trial._trial_id) # Fresh from the database, with the other replicates' fits
+        fits = [attrs.get(f'checkpoint_{step}_{r}') for r in range(self.n_reps)]
+        if all(f is not None for f in fits):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # Two replicates finishing together may both report the (same) mean
+                trial.report(float(np.mean(fits)), step=step)
+        return
+
+    def run_sim(self, calib_pars=None, label=None, trial=None, rep=0):
+        """ Create and run a simulation, recording replicate rep's fit on the trial at the checkpoints (if any) """
+        sim = self.copy_sim()
+        if label: sim.label = label
+
+        sim = self.build_fn(sim, calib_pars=calib_pars, **self.build_kw)
+
+        try:
+            if trial is not None and self.checkpoints is not None and isinstance(sim, ss.Sim):
+                if not sim.initialized:
+                    sim.init()
+                fit_fn = self.checkpoint_fn if self.checkpoint_fn is not None else self.eval_fn
+                for step in self.checkpoint_steps(sim):
+                    sim.run(until=sim.t.timevec[step])
+                    self.report(trial, step, rep, fit_fn(sim, **self.eval_kw))
+                    if trial.should_prune():
+                        sim = None
+                        gc.collect() # The sim is full of reference cycles, so free it now rather than later
+                        raise op.TrialPruned(f'Trial {trial.number} pruned at step {step}')
+            sim.run() # Run the simulation (or MultiSim)
+            return sim
+        except op.TrialPruned:
+            raise
+        except Exception as E:
+            if self.die:
+                raise E
+            else:
+                print(f'Encountered error running sim!\nParameters:\n{calib_pars}\nTraceback:\n{sc.traceback()}')
+                return None
+
+    def rep_pars(self, calib_pars, rep):
+        """ The parameters of one replicate: the trial's, with the rand_seed offset by the replicate """
+        calib_pars = sc.dcp(calib_pars)
+        if 'rand_seed' in calib_pars:
+            calib_pars['rand_seed'] += rep
+        return calib_pars
+
+    def run_rep(self, calib_pars, rep, trial=None):
+        """ Run one replicate of a trial, and return its fit (None if it failed; raises op.TrialPruned if pruned) """
+        sim = self.run_sim(self.rep_pars(calib_pars, rep), trial=trial, rep=rep)
+        if sim is None:
+            return None
+        return self.eval_fn(sim, **self.eval_kw)
+
+    def run_lockstep(self, calib_pars, trial):
+        """
+        Run the replicates of a trial side by side, reporting the mean of their
+        checkpoint fits at each checkpoint; returns their final fits (None for
+        any that failed), or raises op.TrialPruned if pruned
+        """
+        sims = []
+        try:
+            for rep in range(self.n_reps):
+                sim = self.build_fn(self.copy_sim(), calib_pars=self.rep_pars(calib_pars, rep), **self.build_kw)
+                if not isinstance(sim, ss.Sim): # E.g. a MultiSim, which can't be paused
+                    return [self.run_rep(calib_pars, rep) for rep in range(self.n_reps)]
+                if not sim.initialized:
+                    sim.init()
+                sims.append(sim)
+            fit_fn = self.checkpoint_fn if self.checkpoint_fn is not None else self.eval_fn
+            for step in self.checkpoint_steps(sims[0]):
+                for sim in sims:
+                    sim.run(until=sim.t.timevec[step])
+                trial.report(float(np.mean([fit_fn(sim, **self.eval_kw) for sim in sims])), step=step)
+                if trial.should_prune():
+                    sims = None
+                    gc.collect()
+                    raise op.TrialPruned(f'Trial {trial.number} pruned at step {step}')
+            fits = []
+            for sim in sims:
+                sim.run()
+                fits.append(self.eval_fn(sim, **self.eval_kw))
+            return fits
+        except op.TrialPruned:
+            raise
+        except Exception as E:
+            if self.die:
+                raise E
+            else:
+                print(f'Encountered error running sim!\nParameters:\n{calib_pars}\nTraceback:\n{sc.traceback()}')
+                return [None]*self.n_reps
+
+    def resume(self, study):
+        """ Fail any trials left running by a killed calibration, and queue them to run again """
+        for trial in study.get_trials(deepcopy=False, states=[op.trial.TrialState.RUNNING]):
+            study.tell(trial.number, state=op.trial.TrialState.FAIL)
+            study.enqueue_trial(trial.params)
+        done = study.get_trials(deepcopy=False, states=[op.trial.TrialState.COMPLETE, op.trial.TrialState.PRUNED])
+        return len(done)
+
+    def ask(self, study):
+        """ Start a trial, returning it and its parameters (or None if it was pruned) """
+        trial = study.ask()
+        pars = self._sample_from_trial(self.calib_pars, trial) if self.calib_pars is not None else dict()
+        if self.reseed:
+            pars['rand_seed'] = trial.suggest_int('rand_seed', 0, 1_000_000)
+        if self.prune_fn is not None and self.prune_fn(pars):
+            study.tell(trial, state=op.trial.TrialState.PRUNED)
+            return trial, None
+        return trial, pars
+
+    def tell(self, study, trial, fits):
+        """ Finish a trial with the mean fit of its replicates """
+        if any(fit is None for fit in fits):
+            study.tell(trial, state=op.trial.TrialState.FAIL)
+        else:
+            study.tell(trial, float(np.mean(fits)))
+        return
+
+    def run_trials(self, study, n_trials):
+        """ Run n_trials trials, with their replicates spread over the workers """
+        n_workers = 1 if self.run_args.debug else self.run_args.n_workers
+        pruning = self.checkpoints is not None
+        if n_workers == 1:
+            for i in range(n_trials):
+                trial, pars = self.ask(study)
+                if pars is None:
+                    continue
+                try:
+                    if pruning:
+                        fits = self.run_lockstep(pars, trial)
+                    else:
+                        fits = [self.run_rep(pars, rep) for rep in range(self.n_reps)]
+                except op.TrialPruned:
+                    study.tell(trial, state=op.trial.TrialState.PRUNED)
+                    continue
+                self.tell(study, trial, fits)
+            return
+
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context('fork' if 'fork' in methods else None) # Fork, so the demos' build functions don't need to be importable
+        fits = {}
+        trials = {}
+        pending = {}
+        n_asked = 0
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_worker, initargs=(self,)) as pool:
+            while n_asked < n_trials or pending:
+                while n_asked < n_trials and len(pending) < 2*n_workers: # Keep the workers busy
+                    trial, pars = self.ask(study)
+                    n_asked += 1
+                    if pars is None:
+                        continue
+                    trials[trial.number] = trial
+                    fits[trial.number] = []
+                    trial_id = trial._trial_id if pruning else None
+                    for rep in range(self.n_reps):
+                        pending[pool.submit(_run_task, pars, rep, trial_id)] = (trial.number, rep)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    number, rep = pending.pop(future)
+                    if number not in trials: # Already pruned
+                        continue
+                    try:
+                        fit = future.result()
+                    except op.TrialPruned:
+                        study.tell(trials.pop(number), state=op.trial.TrialState.PRUNED)
+                        fits.pop(number)
+                        for other, (num, _) in list(pending.items()): # Drop the trial's other replicates if they haven't started
+                            if num == number and other.cancel():
+                                pending.pop(other)
+                        continue
+                    except Exception:
+                        if self.die:
+                            raise
+                        print(f'Encountered error running trial {number}:\n{sc.traceback()}')
+                        fit = None
+                    fits[number].append(fit)
+                    if len(fits[number]) == self.n_reps:
+                        self.tell(study, trials.pop(number), fits.pop(number))
+        return
+
+    def calibrate(self, calib_pars=None, **kwargs):
+        """
+        Perform calibration, continuing the study in the database if there is one
+
+        Args:
+            calib_pars (dict): if supplied, overwrite stored calib_pars
+            kwargs (dict): if supplied, overwrite stored run_args (n_workers, etc.)
+        """
+        if calib_pars is not None:
+            self.calib_pars = calib_pars
+        self.run_args.update(kwargs)
+
+        t0 = sc.tic()
+        self.study = self.make_study()
+        study = op.load_study(storage=self.run_args.storage, study_name=self.run_args.study_name,
+                              sampler=self.run_args.sampler, pruner=self.pruner)
+        n_done = self.resume(study)
+        if self.verbose: print(f'{n_done} of {self.total_trials} trials already done')
+        self.run_trials(study, max(self.total_trials - n_done, 0))
+        self.best_pars = sc.objdict(study.best_params)
+        self.elapsed = sc.toc(t0, output=True)
+        self.parse_study(study)
+
+        if self.verbose: print('Best pars:', self.best_pars)
+
+        self.calibrated = True
+        if not self.run_args.keep_db:
+            self.remove_db()
+        return self
@@ -0,0 +1,263 @@
+"""
+Location x age x age contact data, read from CSV or xlsx once and cached as a memory-mapped binary
+"""
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+import sciris as sc
+
+__all__ = ['contact_tensor', 'load_contacts', 'read_matrix', 'band_sizes']
+
+cache_version = 1 # Bump to invalidate every cache file, e.g. if parsing changes
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CACHED PARSING
+#
+# Every make_sim() (and so every calibration trial that rebuilds its sim) used
+# to parse contact_matrix.csv with pandas. Instead, parse each file once and
+# save the array as .npy next to it, named by a hash of the file's bytes and
+# of how it was parsed: later loads hash the file (far cheaper than parsing
+# it, especially an xlsx) and map the .npy read-only. Editing the file or
+# asking for different locations or age bins gives a new hash, so a stale
+# cache is never used.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def _cached(filename, parse, cache_dir=None, **key):
+    """ parse(filename) the first time for this content and key, then a read-only map of the saved result """
+    filename = sc.path(filename)
+    h = hashlib.sha256(filename.read_bytes())
+    h.update(json.dumps(dict(key, version=cache_version), sort_keys=True, default=str).encode())
+    cache_dir = filename.parent / '.contacts_cache' if cache_dir is None else sc.path(cache_dir)
+    path = cache_dir / f'{filename.stem}_{h.hexdigest()[:16]}.npy'
+    if not path.exists():
+        arr = np.ascontiguousarray(parse(filename), dtype=np.float64)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.stem}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, path) # Whole or not at all, if builds in other processes are doing the same
+    return np.load(path, mmap_mode='r')
+
+
+def _numeric(df):
+    """ The numbers in a sheet, dropping any row or column of labels """
+    df = df.apply(pd.to_numeric, errors='coerce')
+    df = df.dropna(how='all').dropna(axis=1, how='all')
+    if df.isna().values.any():
+        raise ValueError(f'The contact matrix has {df.isna().values.sum()} missing or non-numeric entries')
+    return df.values
+
+
+def _read_flat(filename):
+    """ A 2-D matrix from a CSV file, or from the first sheet of an xlsx file """
+    if filename.suffix in ('.xlsx', '.xls'):
+        return _numeric(pd.read_excel(filename, sheet_name=0, header=None))
+    return _numeric(pd.read_csv(filename, header=None))
+
+
+def read_matrix(filename, cache=True, cache_dir=None):
+    """
+    Read a contact matrix (e.g. the 60x60 contact_matrix.csv) from CSV or xlsx, parsing it only once
+
+    Args:
+        filename (str/path): the CSV or xlsx file
+        cache (bool): map the parsed matrix from the cache (made the first time)
+        cache_dir (str/path): where to cache it (default: .contacts_cache next to the file)
+
+    Returns:
+        The matrix, as a read-only float64 array
+    """
+    if not cache:
+        return _read_flat(sc.path(filename))
+    return _cached(filename, _read_flat, cache_dir=cache_dir, kind='matrix')
+
+
+def band_sizes(age_data, age_bins):
+    """
+    The population of each age band, from age data like age.csv (columns age and value)
+
+    Ages at or above the last edge are counted in the last band.
+    """
+    age_data = pd.read_csv(age_data) if isinstance(age_data, str) else age_data
+    age_bins = np.asarray(age_bins, dtype=float)
+    band = np.clip(np.searchsorted(age_bins, age_data['age'].values, side='right') - 1, 0, len(age_bins)-2)
+    return np.bincount(band, weights=age_data['value'].values.astype(float), minlength=len(age_bins)-1)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CONTACT TENSOR
+#
+# contact_matrix.csv holds three 20x20 age matrices (household, school,
+# community) on the diagonal of a 60x60 block matrix, and is zero elsewhere.
+# Kept as a (location x age x age) array, the data is a ninth of the size, and
+# each location's matrix can be checked and edited on its own.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class contact_tensor:
+    """
+    Contacts within each location between age bands, as a (location x source age x destination age) array
+
+    Follows the convention of contact_matrix_mixing: data[l, i, j] is the number
+    of contacts that a person in age band j has with people in age band i at
+    location l. So if the data are reciprocal, the total contacts between two
+    bands are the same counted from either side: data[l, i, j] * N_j ==
+    data[l, j, i] * N_i, for band populations N.
+
+    Args:
+        data (array): the (n_locations x n_bands x n_bands) contacts
+        locations (list): the names of the locations
+        age_bins (array): the age band edges
+
+    **Example**:
+
+        ct = load_contacts('contact_matrix.csv') # Or an xlsx with a sheet per location
+        ct.check_reciprocity('age.csv')
+        cmm = contact_matrix_mixing(diseases='sir', contacts=ct.to_matrix()*10)
+    """
+    def __init__(self, data, locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'), age_bins=np.linspace(0, 100, 21)):
+        self.data = np.asarray(data, dtype=np.float64)
+        self.locations = list(locations)
+        self.age_bins = np.asarray(age_bins, dtype=float)
+        self.bands = [f'{lo:n}-{hi:n}' for lo, hi in zip(self.age_bins[:-1], self.age_bins[1:])]
+        expected = (len(self.locations), len(self.bands), len(self.bands))
+        if self.data.shape != expected:
+            raise ValueError(f'The contacts must be (locations x age bands x age bands) = {expected}, not {self.data.shape}')
+        if (self.data < 0).any():
+            raise ValueError('Contacts can\'t be negative')
+        return
+
+    def __repr__(self):
+        return f'<contact_tensor {len(self.locations)} locations x {len(self.bands)} x {len(self.bands)} age bands>'
+
+    def __getitem__(self, location):
+        """ The (age x age) matrix of one location, by name """
+        return self.data[self.locations.index(location)]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def to_matrix(self):
+        """ The location-major block-diagonal (n_groups x n_groups) matrix, as used by contact_matrix_mixing """
+        n_loc, n = len(self.locations), len(self.bands)
+        out = np.zeros((n_loc, n, n_loc, n))
+        li = np.arange(n_loc)
+        out[li, :, li, :] = self.data
+        return out.reshape(n_loc*n, n_loc*n)
+
+    @classmethod
+    def from_matrix(cls, matrix, locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'), age_bins=np.linspace(0, 100, 21)):
+        """ Take the diagonal blocks of a location-major block matrix (contacts between locations aren't allowed) """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        n_loc, n = len(locations), len(age_bins) - 1
+        if matrix.shape != (n_loc*n, n_loc*n):
+            raise ValueError(f'The matrix must be ({n_loc*n} x {n_loc*n}) for {n_loc} locations and {n} age bands, not {matrix.shape}')
+        blocks = matrix.reshape(n_loc, n, n_loc, n)
+        li = np.arange(n_loc)
+        data = blocks[li, :, li, :]
+        off = np.abs(blocks).sum() - np.abs(data).sum()
+        if off > 0:
+            raise ValueError(f'The matrix has contacts between locations (total {off:g}), which a location x age x age tensor can\'t hold')
+        return cls(data, locations=locations, age_bins=age_bins)
+
+    def reciprocity(self, age_data):
+        """
+        The relative difference between the contacts of each pair of bands counted from either side
+
+        Returns:
+            A (location x age x age) array of |C[i,j]*N_j - C[j,i]*N_i| / mean of the two,
+            NaN where a band has no population or there are no contacts either way
+        """
+        N = band_sizes(age_data, self.age_bins)
+        total = self.data * N[None, None, :] # Contacts between bands i and j, counted from j
+        other = total.swapaxes(1, 2) # ... and counted from i
+        mean = (total + other) / 2
+        valid = (mean > 0) & (N[None, :, None] > 0) & (N[None, None, :] > 0)
+        return np.divide(np.abs(total - other), mean, out=np.full(total.shape, np.nan), where=valid)
+
+    def check_reciprocity(self, age_data, rtol=0.1, die=False):
+        """
+        Check the contacts are reciprocal for the population in age_data, to within rtol
+
+        Returns:
+            A dataframe of the pairs (each once) that aren't, worst first; empty if all are
+
+        Raises:
+            ValueError if die is True and any pairs aren't reciprocal (otherwise a warning)
+        """
+        rel = self.reciprocity(age_data)
+        l, i, j = np.nonzero(np.triu(np.nan_to_num(rel) > rtol))
+        df = pd.DataFrame(dict(location=np.array(self.locations)[l], band_i=np.array(self.bands)[i],
+                               band_j=np.array(self.bands)[j], rel_diff=rel[l, i, j]))
+        df = df.sort_values('rel_diff', ascending=False, ignore_index=True)
+        if len(df):
+            worst = df.iloc[0]
+            msg = (f'{len(df)} pairs of age bands have contacts that differ by more than {rtol:.0%} counted from either side, '
+                   f'worst {worst.band_i} and {worst.band_j} at {worst.location} ({worst.rel_diff:.0%}); see symmetrized()')
+            if die:
+                raise ValueError(msg)
+            warnings.warn(msg, stacklevel=2)
+        return df
+
+    def symmetrized(self, age_data):
+        """
+        Make the contacts reciprocal for the population in age_data
+
+        The total contacts of each pair of bands become the mean of the two
+        sides, and are then divided by each band's population. Bands with no
+        population are left as they are.
+        """
+        N = band_sizes(age_data, self.age_bins)
+        total = self.data * N[None, None, :]
+        mean = (total + total.swapaxes(1, 2)) / 2
+        data = np.divide(mean, N[None, None, :], out=self.data.copy(), where=(N[None, :, None] > 0) & (N[None, None, :] > 0))
+        return contact_tensor(data, locations=self.locations, age_bins=self.age_bins)
+
+
+def _read_tensor(filename, locations, n_bands):
+    """ A (location x age x age) array from an xlsx with one sheet per location, or a block matrix in CSV or xlsx """
+    if filename.suffix in ('.xlsx', '.xls'):
+        sheets = pd.read_excel(filename, sheet_name=None, header=None)
+        if all(loc in sheets for loc in locations):
+            return np.stack([_numeric(sheets[loc]) for loc in locations])
+    matrix = _read_flat(filename)
+    age_bins = np.arange(n_bands + 1) # Only the number of bands matters here
+    return contact_tensor.from_matrix(matrix, locations=locations, age_bins=age_bins).data
+
+
+def load_contacts(filename, locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'), age_bins=np.linspace(0, 100, 21),
+                  cache=True, cache_dir=None):
+    """
+    Read location x age x age contact data from CSV or xlsx, parsing each file only once
+
+    The file is either an xlsx with one (age x age) sheet per location, named
+    by the locations, or a location-major block-diagonal matrix like
+    contact_matrix.csv (in a CSV, or the first sheet of an xlsx). Rows or
+    columns of labels are ignored.
+
+    Args:
+        filename (str/path): the CSV or xlsx file
+        locations (list): the names of the locations (and of the sheets)
+        age_bins (array): the age band edges
+        cache (bool): map the parsed data from the cache (made the first time)
+        cache_dir (str/path): where to cache it (default: .contacts_cache next to the file)
+
+    **Example**:
+
+        ct = load_contacts('contacts.xlsx', locations=['HOUSEHOLD', 'SCHOOL', 'WORK', 'COMMUNITY'])
+        print(ct['SCHOOL']) # The school matrix
+    """
+    locations = list(locations)
+    n_bands = len(age_bins) - 1
+    parse = lambda fn: _read_tensor(fn, locations, n_bands)
+    if cache:
+        data = _cached(filename, parse, cache_dir=cache_dir, kind='tensor', locations=locations, n_bands=n_bands)
+    else:
+        data = parse(sc.path(filename))
+    return contact_tensor(data, locations=locations, age_bins=age_bins)
@@ -0,0 +1,287 @@
+"""
+RSV natural history, driven by the inhaled viral load
+"""
+import numpy as np
+import starsim as ss
+from rsv_states import dose_window
+
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+_ = None
+
+__all__ = ['rsv', 'person_update']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# THE PERSON FUNCTION
+#
+# From NewDirections.md, for every person: (1) progress the disease state,
+# (2) check the inhaled load, (3) if it is enough, enter the incubation period,
+# and change the time-activity pattern (e.g. stay home when sick). Each person
+# is independent, so with numba this is one prange loop over the struct-of-arrays
+# state (the .raw arrays of the disease); update_numpy does the same with masks.
+# The random numbers are drawn beforehand by starsim, so both give the same result.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def update_numpy(uids, rands, ti, dt, r_infect, home, susceptible, exposed, infected, lower,
+                 recovered, ti_infectious, ti_lower, ti_recovered, load, rel_sus, pattern,
+                 usual_pattern, new):
+    """ Update every person in uids with array operations (the fallback for person_update) """
+    ex = exposed[uids]
+    inf = infected[uids]
+    low = lower[uids]
+
+    # (1) Natural history: exposed -> infectious -> lower respiratory -> recovered
+    onset = ex & (ti_infectious[uids] <= ti)
+    ex &= ~onset
+    to_lower = inf & ~low & (ti_lower[uids] <= ti)
+    low |= to_lower
+    recover = inf & ~ex & (ti_recovered[uids] <= ti)
+    was_lower = low & recover
+    inf &= ~recover
+    low &= ~recover
+
+    # (5) Time-activity: stay home with a lower respiratory infection
+    if home >= 0:
+        u = uids[to_lower]
+        usual_pattern[u] = pattern[u]
+        pattern[u] = home
+        u = uids[was_lower]
+        pattern[u] = usual_pattern[u]
+
+    # (2-3) Enough inhaled load to be infected?
+    sus = susceptible[uids]
+    p = -np.expm1(-r_infect * rel_sus[uids] * load[uids] * dt)
+    infect = sus & (rands < p)
+    u = uids[infect]
+    susceptible[u] = False
+    ex |= infect
+    inf |= infect
+    load[u] = 0
+    new[uids] = infect
+
+    exposed[uids] = ex
+    infected[uids] = inf
+    lower[uids] = low
+    recovered[uids[recover]] = True
+    return new
+
+
+if nb is not None:
+    @nb.njit(cache=True, parallel=True)
+    def update_numba(uids, rands, ti, dt, r_infect, home, susceptible, exposed, infected, lower,
+                     recovered, ti_infectious, ti_lower, ti_recovered, load, rel_sus, pattern,
+                     usual_pattern, new):
+        """ Update every person in uids, one at a time, in parallel """
+        for j in nb.prange(len(uids)):
+            i = uids[j]
+            new[i] = False
+
+            # (1) Natural history: exposed -> infectious -> lower respiratory -> recovered
+            if exposed[i] and ti_infectious[i] <= ti:
+                exposed[i] = False
+            if infected[i] and not lower[i] and ti_lower[i] <= ti:
+                lower[i] = True
+                if home >= 0: # (5) Time-activity: stay home
+                    usual_pattern[i] = pattern[i]
+                    pattern[i] = home
+            if infected[i] and not exposed[i] and ti_recovered[i] <= ti:
+                if lower[i] and home >= 0:
+                    pattern[i] = usual_pattern[i]
+                infected[i] = False
+                lower[i] = False
+                recovered[i] = True
+
+            # (2-3) Enough inhaled load to be infected?
+            elif susceptible[i]:
+                p = -np.expm1(-r_infect * rel_sus[i] * load[i] * dt)
+                if rands[j] < p:
+                    susceptible[i] = False
+                    exposed[i] = True
+                    infected[i] = True
+                    load[i] = 0
+                    new[i] = True
+        return new
+else:
+    update_numba = None
+
+
+def person_update(*args, use_numba=True):
+    """ Run the person function with numba if it is installed (and use_numba), else with NumPy """
+    if use_numba and update_numba is not None:
+        return update_numba(*args)
+    return update_numpy(*args)
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# RSV
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class rsv(ss.Infection):
+    """
+    RSV with infection from the inhaled viral load, rather than from contacts
+
+    Each step, every agent inhales the average concentration in their space from
+    a viral_reservoir connector (at their breathing rate), which adds to their
+    load; the load is cleared at a fixed rate, or, with a window, is the dose
+    inhaled over the last `window` steps (e.g. with a schedule with
+    sim_substeps=True, the last few hours). A susceptible agent is infected with
+
+        p = 1 - exp(-r_infect * rel_sus * load * dt)
+
+    and then goes exposed -> infectious -> (lower respiratory ->) recovered. With
+    a schedule, agents stay home (home_pattern) while they have a lower
+    respiratory infection. The infectious (and shedding) agents are infected & ~exposed.
+
+    Args:
+        reservoir (str): the name of the viral_reservoir connector
+        schedule (str): the name of the activity_schedule connector, if any
+        home_pattern (int): the time-activity pattern of agents who stay home
+        breathing_rate (float): m^3 inhaled per day
+        clearance (float): the rate the inhaled load is cleared, per day
+        window (int): if given, the load is the dose over this many steps, instead of using clearance
+        dose_dtype (dtype): the dtype of the dose history when using a window
+        r_infect (float): infectivity per unit load per day
+        dur_exp (`ss.Dist`): the incubation period
+        dur_inf (`ss.Dist`): how long people are infectious for
+        p_lower (`ss.bernoulli`): the probability of a lower respiratory infection
+        dur_lower (`ss.Dist`): the time from onset to a lower respiratory infection
+        use_numba (bool): use the compiled parallel kernel, if numba is installed
+    """
+    def __init__(self, pars=None, reservoir=_, schedule=_, home_pattern=_, breathing_rate=_,
+                 clearance=_, window=_, dose_dtype=_, r_infect=_, init_prev=_, dur_exp=_,
+                 dur_inf=_, p_lower=_, dur_lower=_, use_numba=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            reservoir = 'viral_reservoir',
+            schedule = None,
+            home_pattern = 0,
+            breathing_rate = 15.0,
+            clearance = 1.0,
+            window = None,
+            dose_dtype = np.float32,
+            r_infect = 0.1,
+            init_prev = ss.bernoulli(p=0.01),
+            dur_exp = ss.lognorm_ex(mean=ss.days(4)),
+            dur_inf = ss.lognorm_ex(mean=ss.days(8)),
+            p_lower = ss.bernoulli(p=0.2),
+            dur_lower = ss.lognorm_ex(mean=ss.days(3)),
+            use_numba = True,
+        )
+        self.update_pars(pars, **kwargs)
+
+        self.define_states(
+            ss.BoolState('exposed', label='Exposed'),
+            ss.BoolState('lower', label='Lower respiratory infection'),
+            ss.BoolState('recovered', label='Recovered'),
+            ss.FloatArr('ti_infectious', label='Time of onset'),
+            ss.FloatArr('ti_lower', label='Time of lower respiratory infection'),
+            ss.FloatArr('ti_recovered', label='Time of recovery'),
+            ss.FloatArr('load', default=0.0, label='Inhaled load'),
+            ss.IntArr('usual_pattern', default=0, label='Time-activity pattern when well'),
+        )
+        self.rand_infect = ss.random(name='rand_infect')
+        self.new = None # Scratch flags for the agents infected this step
+        self.doses = None # The dose_window, if using a window
+        self.inhaled = None # Scratch array for the dose this step
+        return
+
+    @property
+    def infectious(self):
+        return self.infected & ~self.exposed
+
+    def init_pre(self, sim):
+        # Transmission is via the reservoir, not the networks, so beta is not needed
+        ss.Disease.init_pre(self, sim)
+        return
+
+    def init_post(self):
+        if self.pars.window is not None:
+            n = len(self.load.raw)
+            self.doses = dose_window(n, window=self.pars.window, dtype=self.pars.dose_dtype)
+            self.inhaled = np.zeros(n)
+        super().init_post()
+        return
+
+    def step_state(self):
+        """ Everything happens in the person function in step() """
+        return
+
+    def inhale(self, uids):
+        """ Add what was inhaled from the reservoir to the load, and clear some or drop the oldest """
+        p = self.pars
+        dt = self.t.dt.days
+        load = self.load.raw
+        inhaled = 0
+        if p.reservoir is not None:
+            reservoir = self.sim.connectors[p.reservoir]
+            inhaled = p.breathing_rate * dt * reservoir.exposure(uids)
+
+        if self.doses is None:
+            load[uids] *= np.exp(-p.clearance * dt)
+            load[uids] += inhaled
+        else:
+            n = len(load)
+            if len(self.inhaled) < n:
+                self.doses.grow(n)
+                self.inhaled = np.zeros(n)
+            self.inhaled[:] = 0
+            self.inhaled[uids] = inhaled
+            self.doses.add(self.inhaled)
+            load[uids] = self.doses.sum[uids]
+        return
+
+    def step(self):
+        p = self.pars
+        uids = self.sim.people.auids
+        self.inhale(uids)
+        rands = self.rand_infect.rvs(uids)
+        if self.new is None or len(self.new) < len(self.susceptible.raw):
+            self.new = np.zeros(len(self.susceptible.raw), dtype=bool)
+
+        if p.schedule is not None:
+            pattern = self.sim.connectors[p.schedule].pattern.raw
+            home = p.home_pattern
+        else:
+            pattern = self.usual_pattern.raw # Unused
+            home = -1
+
+        args = (uids, rands, float(self.ti), self.t.dt.days, p.r_infect, home, self.susceptible.raw,
+                self.exposed.raw, self.infected.raw, self.lower.raw, self.recovered.raw,
+                self.ti_infectious.raw, self.ti_lower.raw, self.ti_recovered.raw, self.load.raw,
+                self.rel_sus.raw, pattern, self.usual_pattern.raw, self.new)
+        new = person_update(*args, use_numba=p.use_numba)
+        new_cases = uids[new[uids]]
+        if len(new_cases):
+            self.set_prognoses(new_cases)
+        return new_cases
+
+    def set_prognoses(self, uids, sources=None):
+        """ Enter the incubation period and sample the course of the infection """
+        super().set_prognoses(uids, sources)
+        p = self.pars
+        ti = self.ti
+        self.susceptible[uids] = False
+        self.exposed[uids] = True
+        self.infected[uids] = True
+        self.ti_infected[uids] = ti
+        if self.doses is not None:
+            self.doses.reset(uids)
+        self.ti_infectious[uids] = ti + p.dur_exp.rvs(uids)
+        self.ti_recovered[uids] = self.ti_infectious[uids] + p.dur_inf.rvs(uids)
+        lower = p.p_lower.filter(uids)
+        self.ti_lower[lower] = np.minimum(self.ti_infectious[lower] + p.dur_lower.rvs(lower), self.ti_recovered[lower])
+        return
+
+    def step_die(self, uids):
+        self.susceptible[uids] = False
+        self.exposed[uids] = False
+        self.infected[uids] = False
+        self.lower[uids] = False
+        self.recovered[uids] = False
+        return
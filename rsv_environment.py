@@ -0,0 +1,238 @@
+"""
+Environmental reservoir: viral concentration in every space, from the people in it
+"""
+import numpy as np
+import starsim as ss
+
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+_ = None
+
+__all__ = ['viral_reservoir', 'exact_step', 'rk4_step']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# VIRAL RESERVOIR
+#
+# NewDirections.md has a loop over every space: (1) the source flux from the
+# sick people in the room, with a decay sink, (2) Runge-Kutta to the end-of-step
+# concentration, (3) people inhale the average of the start and end. With 1e5+
+# households a Python loop over spaces is not feasible, so all the
+# concentrations live in one array, the source flux of every space is a single
+# bincount over the infectious occupants, and every space is advanced at once.
+# The source is constant within a step, so the ODE has an exact solution, which
+# is the default: RK4 is only stable while decay*h < ~2.8, so with a decay of
+# 1/day it diverges for any step longer than a few days (e.g. dt=0.1 years).
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+# Largest decay*h for which RK4 on dC/dt = -k*C is stable (|R(-z)| <= 1 for z <= ~2.785)
+rk4_stable = 2.78
+
+
+def exact_step(conc, source, volume, decay, h):
+    """
+    Advance dC/dt = source/volume - decay*C exactly by h, for every space at once
+
+    With the source constant over the step, C(h) = C0*exp(-k*h) + S/(V*k)*(1 - exp(-k*h)),
+    which is stable for any step size (and reduces to C0 + S/V*h where k = 0).
+
+    Args:
+        conc (array): the concentration in each space (modified in place)
+        source (array): the emission into each space per unit time
+        volume (array/float): the volume of each space
+        decay (array/float): the decay rate, per unit time
+        h (float): the step size
+    """
+    decay = np.asarray(decay, dtype=float)
+    growth = -np.expm1(-decay*h) # 1 - exp(-k*h), accurate for small k*h
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = np.where(decay > 0, growth/decay, h) # (1 - exp(-k*h))/k, -> h as k -> 0
+    conc *= 1 - growth
+    conc += source / volume * gain
+    return conc
+
+
+def n_rk4_steps(decay, dt):
+    """ The fewest RK4 steps per dt with decay*h <= 2, safely inside the stability limit """
+    k = float(np.max(decay)) if np.size(decay) else 0.0
+    return max(1, int(np.ceil(k*dt/2)))
+
+
+def rk4_step(conc, source, volume, decay, h, n_steps=1):
+    """
+    Advance dC/dt = source/volume - decay*C by n_steps RK4 steps of size h, for every space at once
+
+    Args:
+        conc (array): the concentration in each space (modified in place)
+        source (array): the emission into each space per unit time
+        volume (array/float): the volume of each space
+        decay (array/float): the decay rate, per unit time
+        h (float): the step size
+        n_steps (int): number of RK4 steps
+    """
+    inflow = source / volume
+    for i in range(n_steps):
+        k1 = inflow - decay*conc
+        k2 = inflow - decay*(conc + 0.5*h*k1)
+        k3 = inflow - decay*(conc + 0.5*h*k2)
+        k4 = inflow - decay*(conc + h*k3)
+        conc += h/6*(k1 + 2*k2 + 2*k3 + k4)
+    return conc
+
+
+if nb is not None:
+    @nb.njit(cache=True, parallel=True)
+    def _rk4_kernel(conc, source, volume, decay, h, n_steps):
+        """ As rk4_step, one space at a time; volume and decay are per-space arrays """
+        for s in nb.prange(len(conc)):
+            c = conc[s]
+            inflow = source[s] / volume[s]
+            k = decay[s]
+            for i in range(n_steps):
+                k1 = inflow - k*c
+                k2 = inflow - k*(c + 0.5*h*k1)
+                k3 = inflow - k*(c + 0.5*h*k2)
+                k4 = inflow - k*(c + h*k3)
+                c += h/6*(k1 + 2*k2 + 2*k3 + k4)
+            conc[s] = c
+        return conc
+else:
+    _rk4_kernel = None
+
+
+class viral_reservoir(ss.Connector):
+    """
+    Viral concentration in every space, shed by the infectious agents in it
+
+    Each step, the concentration C in every space follows
+
+        dC/dt = sum(emission * rel_trans of infectious occupants) / volume - decay * C
+
+    which, with the source held constant over the step, is advanced with its
+    exact solution (method='exact', stable for any dt), or with RK4 sub-steps
+    (method='rk4'). The concentration at the start and end of
+    the step are in self.conc_start and self.conc, and their average, which is
+    what people inhale over the step, is in self.conc_mean (see exposure()).
+
+    Args:
+        disease (str): the disease that is shed (default: the first one)
+        state (str): the name of the people state holding the space of each agent
+        n_spaces (int): the number of spaces (default: the largest space in the state + 1, grown as needed)
+        volume (float/array): the volume of each space, m^3
+        emission (float): the virus shed per infectious agent per day (e.g. quanta/day)
+        decay (float/array): the decay rate of the virus in each space, per day
+        method (str): 'exact' (default) or 'rk4'
+        n_rk4 (int): with method='rk4', the number of RK4 steps per sim step (default: enough for decay*h <= 2; an error is raised if decay*h exceeds the RK4 stability limit)
+        use_numba (bool): with method='rk4', use the compiled kernel (requires numba)
+    """
+    def __init__(self, pars=None, disease=_, state=_, n_spaces=_, volume=_, emission=_,
+                 decay=_, method=_, n_rk4=_, use_numba=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            disease = None,
+            state = 'location',
+            n_spaces = None,
+            volume = 50.0,
+            emission = 10.0,
+            decay = 1.0,
+            method = 'exact',
+            n_rk4 = None,
+            use_numba = False,
+        )
+        self.update_pars(pars, **kwargs)
+        if self.pars.method not in ('exact', 'rk4'):
+            raise ValueError(f"method must be 'exact' or 'rk4', not '{self.pars.method}'")
+        if self.pars.use_numba and nb is None:
+            raise ImportError('use_numba=True requires numba, please install it (pip install numba)')
+        self.conc = None # The concentration in each space at the end of the step
+        self.conc_start = None # ... and at the start
+        self.conc_mean = None # The average of the two
+        return
+
+    @property
+    def n_spaces(self):
+        return len(self.conc)
+
+    def init_post(self):
+        super().init_post()
+        n_spaces = self.pars.n_spaces
+        if n_spaces is None:
+            space = self.sim.people.states[self.pars.state].values
+            n_spaces = int(space.max()) + 1 if len(space) else 0
+        self.resize(n_spaces)
+        return
+
+    def resize(self, n_spaces):
+        """ Set the number of spaces, keeping the concentration of existing ones """
+        conc = np.zeros(n_spaces)
+        if self.conc is not None:
+            n = min(n_spaces, len(self.conc))
+            conc[:n] = self.conc[:n]
+        self.conc = conc
+        self.conc_start = conc.copy()
+        self.conc_mean = conc.copy()
+        return
+
+    def spaces(self, uids):
+        """ The space of each agent, or -1 if it is not in one """
+        space = self.sim.people.states[self.pars.state].raw[uids].astype(np.int64)
+        space[(space < 0) | (space >= self.n_spaces)] = -1
+        return space
+
+    def compute_source(self):
+        """ The emission into each space, with one bincount over the infectious agents """
+        disease = self.sim.diseases[self.pars.disease] if self.pars.disease else self.sim.diseases[0]
+        uids = disease.infectious.uids
+        space = self.sim.people.states[self.pars.state].raw[uids].astype(np.int64)
+        if self.pars.n_spaces is None and len(space) and space.max() >= self.n_spaces:
+            self.resize(int(space.max()) + 1)
+        ok = (space >= 0) & (space < self.n_spaces)
+        weights = self.pars.emission * disease.rel_trans.raw[uids[ok]]
+        return np.bincount(space[ok], weights=weights, minlength=self.n_spaces)
+
+    def advance(self, dt):
+        """ Advance every space by dt days; a schedule can call this once per sub-step """
+        p = self.pars
+        source = self.compute_source()
+        self.conc_start[:] = self.conc
+        if p.method == 'exact':
+            exact_step(self.conc, source, p.volume, p.decay, dt)
+        else:
+            n_rk4 = self.rk4_steps(dt)
+            h = dt / n_rk4
+            if p.use_numba:
+                n = self.n_spaces
+                volume = np.broadcast_to(np.asarray(p.volume, dtype=float), n)
+                decay = np.broadcast_to(np.asarray(p.decay, dtype=float), n)
+                _rk4_kernel(self.conc, source, volume, decay, h, n_rk4)
+            else:
+                rk4_step(self.conc, source, p.volume, p.decay, h, n_rk4)
+        np.add(self.conc_start, self.conc, out=self.conc_mean)
+        self.conc_mean *= 0.5
+        return
+
+    def rk4_steps(self, dt):
+        """ The number of RK4 steps for dt: n_rk4 if set (checked for stability), else the fewest stable """
+        n_rk4 = self.pars.n_rk4
+        if n_rk4 is None:
+            return n_rk4_steps(self.pars.decay, dt)
+        kh = float(np.max(self.pars.decay)) * dt / n_rk4
+        if kh > rk4_stable:
+            errormsg = f'RK4 is unstable with decay*h = {kh:.3g} > {rk4_stable} (dt={dt:g} days, n_rk4={n_rk4}); use n_rk4 >= {n_rk4_steps(self.pars.decay, dt)}, or n_rk4=None or method="exact"'
+            raise ValueError(errormsg)
+        return n_rk4
+
+    def step(self):
+        self.advance(self.t.dt.days)
+        return
+
+    def exposure(self, uids=None):
+        """ The average concentration over the step in the space of each agent (0 if not in one) """
+        if uids is None:
+            uids = self.sim.people.auids
+        space = self.spaces(uids)
+        return np.append(self.conc_mean, 0)[space]
@@ -0,0 +1,276 @@
+"""
+Cached age band x location group membership for the mixing pools
+"""
+import numpy as np
+import starsim as ss
+
+__all__ = ['group_names', 'group_keys', 'group_index']
+
+
+def group_names(age_bins, locations):
+    """ Names of the location-major groups, e.g. '0-20 - HOUSEHOLD' """
+    return [f'{age_bins[ai]:n}-{age_bins[ai+1]:n} - {loc}'
+            for loc in locations for ai in range(len(age_bins)-1)]
+
+
+def group_keys(age, loc, age_bins, codes, alive=None):
+    """
+    Compute a location-major group key (location index * n_bands + age band) for
+    each agent, or -1 if the agent is in no group
+
+    Args:
+        age (array): agent ages
+        loc (array): agent locations, one of codes
+        age_bins (array): age band edges; ages outside them are in no group
+        codes (array): sorted location codes
+        alive (array): optional boolean array; agents who are not alive are in no group
+    """
+    n_bands = len(age_bins) - 1
+    band = np.searchsorted(age_bins, age, side='right') - 1
+    li = np.searchsorted(codes, loc)
+    li[li >= len(codes)] = 0 # Guard the lookup below; these are caught by valid
+    valid = (band >= 0) & (band < n_bands) & (codes[li] == loc)
+    if alive is not None:
+        valid &= alive
+    key = np.where(valid, li*n_bands + band, -1).astype(np.int32)
+    return key
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# GROUP INDEX
+#
+# The in_grp() lambdas in 04/05_demo.py recompute three full-population
+# comparisons plus a .uids extraction for every src and every dst pool on every
+# timestep. Instead, keep one group key per agent and one uid array per group,
+# and only re-key the agents whose group can have changed: those whose age has
+# reached the next band edge (each agent's crossing step is queued when they
+# are keyed, so nobody's age is looked at in between), new agents, and the
+# agents that location writers report as moved. The per-step cost is then in
+# the number of changes, not the population.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class group_index(ss.Connector):
+    """
+    Keep the uids of every (age band, location) group up to date
+
+    Groups are ordered location-major (all age bands for the first location,
+    then all age bands for the second, ...) to match base_dict and the block
+    layout of contact_matrix.csv. Agents outside the age bins, with a location
+    that isn't one of the codes, or who have died aren't in any group.
+
+    Each step, only these agents are re-keyed: those whose age band edge is
+    due (queued by the step it will be crossed), agents added since the last
+    step, and the dead (looked for only when the number alive has dropped).
+    Whatever changes the location after initialization must report the agents
+    it moved with moved(uids), as location_markov(grp_index=...) and
+    activity_schedule do; if something writes the location without doing so,
+    use rescan=True, which re-keys every agent every step.
+
+    Args:
+        age_bins (array): age band edges, e.g. (0, 20, 100)
+        locations (list): location names, e.g. ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+        codes (array): the value of the location state for each location (default 0, 1, 2, ...)
+        state (str): the name of the people state holding the location
+        rescan (bool): re-key every agent every step, rather than only those whose group may have changed
+
+    **Example**:
+
+        gi = group_index(age_bins=[0, 20, 100], locations=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'])
+        mps = ss.MixingPools(src=gi.selectors(), dst=gi.selectors(), ...)
+        sim = ss.Sim(connectors=gi, networks=mps, ...)
+    """
+    def __init__(self, age_bins=(0, 20, 100), locations=('HOUSEHOLD', 'SCHOOL', 'COMMUNITY'),
+                 codes=None, state='location', rescan=False, **kwargs):
+        super().__init__(**kwargs)
+        self.age_bins = np.asarray(age_bins, dtype=float)
+        self.locations = list(locations)
+        self.codes = np.arange(len(self.locations)) if codes is None else np.asarray(codes)
+        self.state = state
+        self.rescan = rescan
+        self.n_bands = len(self.age_bins) - 1
+        self.n_groups = self.n_bands * len(self.locations)
+        self.names = group_names(self.age_bins, self.locations)
+        self.key = None # Group of each agent (by uid), -1 if in no group
+        self.members = None # One ss.uids array per group, a view of the first count[g] entries of its buffer
+        self._buf = None # Per group, its uids followed by spare room to add more
+        self._count = None # Per group, the number of uids in its buffer
+        self._pos = None # The position of each agent in their group's buffer (-1 if in no group)
+        self._flag = None # Scratch array for removing agents from a group without sorting
+        self.due = {} # The uids whose age reaches their next band edge at each step, by step
+        self.n_uids = 0 # Agents keyed so far
+        self.n_alive = 0 # Agents alive as of the last step, to know when to look for the dead
+        return
+
+    def selectors(self):
+        """
+        Return a dict of lambdas for use as MixingPools src/dst
+
+        NB: they look the index up via the sim rather than holding a reference
+        to self, so they still work after the sim has been copied (e.g. in calibration)
+        """
+        name = self.name
+        return {nm: (lambda sim, name=name, gi=gi: sim.connectors[name].members[gi])
+                for gi, nm in enumerate(self.names)}
+
+    def __getitem__(self, key):
+        """ Get the uids of a group, by name or by position """
+        if isinstance(key, str):
+            key = self.names.index(key)
+        return self.members[key]
+
+    @property
+    def counts(self):
+        """ Number of agents in each group """
+        return np.array([len(m) for m in self.members])
+
+    def compute_keys(self):
+        """ Compute the group key of every agent in one vectorized pass """
+        ppl = self.sim.people
+        loc = getattr(ppl, self.state).raw
+        return group_keys(ppl.age.raw, loc, self.age_bins, self.codes, alive=ppl.alive.raw)
+
+    def init_post(self):
+        """ Build the full index once, with a single sort """
+        super().init_post()
+        ppl = self.sim.people
+        self.key = self.compute_keys()
+        valid = np.nonzero(self.key >= 0)[0]
+        order = valid[np.argsort(self.key[valid], kind='stable')]
+        bounds = np.searchsorted(self.key[order], np.arange(self.n_groups+1))
+        order = ss.uids(order)
+        self._buf, self._count = [], np.diff(bounds)
+        self._pos = np.full(len(self.key), -1, dtype=np.int64)
+        for g in range(self.n_groups):
+            buf = np.empty(max(2*self._count[g], 16), dtype=order.dtype)
+            buf[:self._count[g]] = order[bounds[g]:bounds[g+1]]
+            self._buf.append(buf)
+            self._pos[order[bounds[g]:bounds[g+1]]] = np.arange(self._count[g])
+        self.members = [self.view(g) for g in range(self.n_groups)]
+        self._flag = np.zeros(len(self.key), dtype=bool)
+        self.n_uids = ppl.n_uids
+        self.n_alive = len(ppl.auids)
+        self.due = {}
+        self.queue(np.arange(self.n_uids))
+        return
+
+    def queue(self, uids):
+        """ Queue each living agent for re-keying at the step their age reaches the next band edge """
+        ppl = self.sim.people
+        uids = uids[ppl.alive.raw[uids]]
+        age = ppl.age.raw[uids]
+        edge = np.searchsorted(self.age_bins, age, side='right')
+        has = edge < len(self.age_bins) # Beyond the last edge, their band never changes again
+        uids = uids[has]
+        gap = self.age_bins[edge[has]] - age[has]
+        due = self.ti + np.maximum(np.floor(gap / self.t.dt.years), 1).astype(np.int64) # Never late; if early, they are queued again
+        order = np.argsort(due, kind='stable')
+        due, uids = due[order], uids[order]
+        steps, starts = np.unique(due, return_index=True)
+        for step, chunk in zip(steps, np.split(uids, starts[1:])):
+            self.due.setdefault(int(step), []).append(chunk)
+        return
+
+    def resize(self):
+        """ Make room in the keys for agents added since the last step """
+        n = len(self.sim.people.age.raw)
+        if n > len(self.key):
+            self._pos = np.concatenate([self._pos, np.full(n-len(self.key), -1, dtype=np.int64)])
+            self.key = np.concatenate([self.key, np.full(n-len(self.key), -1, dtype=np.int32)])
+            self._flag = np.zeros(n, dtype=bool)
+        return
+
+    def rekey(self, uids):
+        """ Recompute the keys of these agents, and move those whose group changed """
+        ppl = self.sim.people
+        new = group_keys(ppl.age.raw[uids], getattr(ppl, self.state).raw[uids], self.age_bins, self.codes,
+                         alive=ppl.alive.raw[uids])
+        old = self.key[uids]
+        changed = np.nonzero(new != old)[0]
+        if len(changed):
+            self.update(uids[changed], old[changed], new[changed])
+            self.key[uids[changed]] = new[changed]
+        return
+
+    def moved(self, uids):
+        """ Move these agents (e.g. whose location was just changed) to their new groups """
+        uids = np.asarray(uids)
+        uids = uids[uids < self.n_uids] # Agents added since the index last stepped are keyed by its own step()
+        if len(uids):
+            self.rekey(uids)
+        return
+
+    def step(self):
+        """ Move only the agents whose age band, location, or alive status changed """
+        ppl = self.sim.people
+        self.resize()
+        if self.rescan:
+            uids = np.arange(ppl.n_uids)
+            self.rekey(uids)
+            self.n_uids = ppl.n_uids
+            return
+
+        # Agents whose age band edge is due, re-queued for their next one
+        chunks = self.due.pop(self.ti, [])
+        if chunks:
+            uids = np.concatenate(chunks)
+            self.rekey(uids)
+            self.queue(uids)
+
+        # New agents
+        n_new = ppl.n_uids - self.n_uids
+        if n_new > 0:
+            uids = np.arange(self.n_uids, ppl.n_uids)
+            self.n_uids = ppl.n_uids
+            self.rekey(uids)
+            self.queue(uids)
+
+        # The dead, only looked for if fewer are alive than expected
+        n_alive = len(ppl.auids)
+        if n_alive < self.n_alive + max(n_new, 0):
+            dead = np.nonzero((self.key >= 0) & ~ppl.alive.raw[:len(self.key)])[0]
+            if len(dead):
+                self.rekey(dead)
+        self.n_alive = n_alive
+        return
+
+    def view(self, g):
+        """ The uids of group g, as a view of its buffer """
+        return self._buf[g][:self._count[g]].view(ss.uids)
+
+    def update(self, uids, old_keys, new_keys):
+        """
+        Remove agents from their old groups and add them to their new ones
+
+        Leavers' slots are filled from the end of the group's buffer, so both
+        are in the number of agents moved, not the size of the group.
+        """
+        flag = self._flag
+        pos = self._pos
+        for g in np.unique(old_keys[old_keys >= 0]):
+            leaving = uids[old_keys == g]
+            buf, n, k = self._buf[g], self._count[g], len(leaving)
+            flag[leaving] = True
+            holes = pos[leaving]
+            holes = holes[holes < n-k] # Slots before the tail, to fill from it
+            tail = buf[n-k:n]
+            fillers = tail[~flag[tail]]
+            buf[holes] = fillers
+            pos[fillers] = holes
+            pos[leaving] = -1
+            flag[leaving] = False
+            self._count[g] = n - k
+            self.members[g] = self.view(g)
+
+        for g in np.unique(new_keys[new_keys >= 0]):
+            joining = uids[new_keys == g]
+            n, k = self._count[g], len(joining)
+            if n + k > len(self._buf[g]): # Out of room: double the buffer
+                buf = np.empty(max(2*(n + k), 16), dtype=self._buf[g].dtype)
+                buf[:n] = self._buf[g][:n]
+                self._buf[g] = buf
+            self._buf[g][n:n+k] = joining
+            pos[joining] = np.arange(n, n+k)
+            self._count[g] = n + k
+            self.members[g] = self.view(g)
+        return
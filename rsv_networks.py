@@ -0,0 +1,590 @@
+"""
+Transmission routes for the RSV demos
+"""
+import numpy as np
+from pathlib import Path
+import sciris as sc
+import starsim as ss
+import scipy.sparse as sp
+from rsv_groups import group_names, group_keys
+from rsv_contacts import read_matrix
+
+_ = None
+
+__all__ = ['contact_matrix_mixing', 'venue_mixing']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CONTACT MATRIX MIXING
+#
+# Expressing the 60x60 contact_matrix.csv as ss.MixingPools would mean 3600
+# pools, each with its own uid lookups and random draws. Instead, compute the
+# infectious prevalence of every group with one bincount, the force of
+# infection on every group with one matrix-vector product, and draw infections
+# for all susceptible agents at once. The per-step cost is then a few passes
+# over the population, whatever the number of groups.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class contact_matrix_mixing(ss.Route):
+    """
+    Well-mixed transmission between age band x location groups, driven by a full contact matrix
+
+    The groups are location-major (see group_index), and the contact matrix
+    follows the same convention as the demos: the row is the source and the
+    column is the destination. Each step, the probability that a susceptible
+    agent in group j is infected is
+
+        1 - exp(-beta * disease_beta * rel_sus * sum_i(contacts[i,j] * prev_i))
+
+    where prev_i is the mean rel_trans of group i (i.e. the infectious prevalence).
+    Unlike ss.MixingPools, the number of contacts is the same for everyone in a group.
+
+    With a beta_matrix and/or beta_factors, contacts[i,j] is multiplied by the
+    relative transmission from group i to group j (e.g. kid -> adult versus
+    adult -> kid), so beta is then the transmission of a pair with relative
+    beta 1. Either can be given per age band (and then applies to every pair of
+    locations) or per group, and can be changed between runs, e.g. by
+    set_beta() in a calibration's build_sim.
+
+    Args:
+        diseases (str): the diseases that transmit via this route
+        beta (float): overall transmission via this route
+        contacts (array/str): the (n_groups x n_groups) contact matrix, or a CSV file to read it from
+        age_bins (array): age band edges; the default is the 20 five-year bands of contact_matrix.csv
+        locations (list): location names
+        codes (array): the value of the location state for each location (default 0, 1, 2, ...)
+        state (str): the name of the people state holding the location
+        grp_index (str): if given, reuse the group keys of this group_index connector instead of recomputing them
+        schedule (str): if given, the name of an activity_schedule connector; transmission is then
+            the sum of the hazards over its sub-steps, with agents moved between locations in each
+        replicates (str): if given, the name of a replicates connector; each replicate then only mixes with itself
+        beta_matrix (array): the relative transmission from each source (row) to each destination (column),
+            either (n_bands x n_bands) or (n_groups x n_groups)
+        beta_factors (tuple): a low-rank relative transmission (src, dst), each (n_bands x rank) or
+            (n_groups x rank), so that the matrix is src @ dst.T (multiplied by beta_matrix if both are given)
+
+    **Example**:
+
+        cmm = contact_matrix_mixing(diseases='sir', beta=0.1, contacts='contact_matrix.csv')
+        sim = ss.Sim(diseases='sir', networks=cmm, people=ppl)
+
+        # Twice the transmission from kids (0-20) to adults as from adults to kids
+        cmm = contact_matrix_mixing(diseases='sir', beta=0.1, contacts=n_contacts, age_bins=[0, 20, 100],
+                                    beta_matrix=[[1.0, 2.0], [1.0, 1.0]])
+    """
+    def __init__(self, pars=None, diseases=_, beta=_, contacts=_, age_bins=_, locations=_,
+                 codes=_, state=_, grp_index=_, schedule=_, replicates=_, beta_matrix=_, beta_factors=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            diseases = None,
+            beta = 1.0,
+            contacts = 'contact_matrix.csv',
+            age_bins = np.linspace(0, 100, 21),
+            locations = ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'],
+            codes = None,
+            state = 'location',
+            grp_index = None,
+            schedule = None,
+            replicates = None,
+            beta_matrix = None,
+            beta_factors = None,
+        )
+        self.update_pars(pars, **kwargs)
+        self.validate_pars()
+        self.diseases = None
+        self.key = None # Group of each agent (by uid), -1 if in no group
+        self.weights = None # contacts times the relative beta, as used on this step
+        self.n_reps = 1 # The keys run over n_reps x n_groups
+        self.prenatal = False # Does not make sense for well-mixed groups
+        self.postnatal = False
+        self.p_acquire = ss.bernoulli(p=0) # Placeholder value
+        self.source_rng = ss.random() # Only used by attribute_sources(), so it doesn't change the run
+        self.last = {} # What each disease's last transmission step used, for attribute_sources()
+        self.sub_steps = None # With a schedule, the groups and force of infection of each sub-step, for attribute_sources()
+        return
+
+    def validate_pars(self):
+        """ Read the contact matrix (CSV or xlsx) if needed, and check it matches the groups """
+        p = self.pars
+        p.diseases = sc.tolist(p.diseases)
+        p.age_bins = np.asarray(p.age_bins, dtype=float)
+        p.codes = np.arange(len(p.locations)) if p.codes is None else np.asarray(p.codes)
+        if isinstance(p.contacts, (str, Path)):
+            p.contacts = read_matrix(p.contacts) # Parsed once, then mapped from the cache
+        p.contacts = np.asarray(p.contacts, dtype=float)
+        self.names = group_names(p.age_bins, p.locations)
+        n_groups = len(self.names)
+        if p.contacts.shape != (n_groups, n_groups):
+            errormsg = f'The contact matrix must have one row and column per group, but {p.contacts.shape} != {(n_groups, n_groups)}'
+            raise ValueError(errormsg)
+
+        # The relative beta is per age band or per group, going by its shape
+        n_bands = len(p.age_bins) - 1
+        bands = [f'{lo:n}-{hi:n}' for lo, hi in zip(p.age_bins[:-1], p.age_bins[1:])]
+        sizes = {n_bands: bands, n_groups: self.names}
+        if p.beta_matrix is not None:
+            p.beta_matrix = np.array(p.beta_matrix, dtype=float)
+            n = p.beta_matrix.shape[0]
+            if p.beta_matrix.shape != (n, n) or n not in sizes:
+                raise ValueError(f'The beta matrix must be ({n_bands} x {n_bands}) or ({n_groups} x {n_groups}), not {p.beta_matrix.shape}')
+            self.beta_labels = sizes[n]
+        if p.beta_factors is not None:
+            if len(p.beta_factors) != 2:
+                raise ValueError('The beta factors must be a pair (src, dst)')
+            src, dst = [np.array(f, dtype=float).reshape(len(f), -1) for f in p.beta_factors]
+            if src.shape != dst.shape or src.shape[0] not in sizes:
+                errormsg = f'The beta factors must both be ({n_bands} x rank) or ({n_groups} x rank), not {src.shape} and {dst.shape}'
+                raise ValueError(errormsg)
+            p.beta_factors = (src, dst)
+            self.factor_labels = sizes[src.shape[0]]
+        return
+
+    def rel_beta(self):
+        """ The relative transmission between every pair of groups, or None if it is the same for all """
+        p = self.pars
+        if p.beta_matrix is None and p.beta_factors is None:
+            return None
+        n_groups = len(self)
+        rel = np.ones((n_groups, n_groups))
+        for mat in [p.beta_matrix, None if p.beta_factors is None else p.beta_factors[0] @ p.beta_factors[1].T]:
+            if mat is not None:
+                reps = n_groups // len(mat) # Per age band, so the same for every pair of locations
+                rel *= np.tile(mat, (reps, reps))
+        return rel
+
+    def transmission_matrix(self):
+        """ The contact matrix times the relative beta of each pair of groups """
+        rel = self.rel_beta()
+        return self.pars.contacts if rel is None else self.pars.contacts * rel
+
+    def set_beta(self, name, value):
+        """
+        Set one entry of the beta matrix or its factors, named as in beta_pars()
+
+        Names are 'beta[src->dst]' for an entry of beta_matrix, and
+        'beta_src[label,k]' or 'beta_dst[label,k]' for column k of beta_factors,
+        where the labels are age bands (e.g. '0-20') or group names, matching
+        the shape of the matrix.
+        """
+        p = self.pars
+        kind, _, label = name.rstrip(']').partition('[')
+        try:
+            if kind == 'beta' and p.beta_matrix is not None:
+                src, dst = label.split('->')
+                p.beta_matrix[self.beta_labels.index(src), self.beta_labels.index(dst)] = value
+                return
+            elif kind in ('beta_src', 'beta_dst') and p.beta_factors is not None:
+                label, k = label.rsplit(',', 1)
+                p.beta_factors[kind == 'beta_dst'][self.factor_labels.index(label), int(k)] = value
+                return
+        except (ValueError, IndexError):
+            pass
+        raise ValueError(f'"{name}" is not an entry of the beta matrix or beta factors of {self.name}')
+
+    def beta_pars(self, low=0.1, high=10.0, log=True, entries=None):
+        """
+        Calibration parameters for every entry of the beta matrix and/or its factors
+
+        The guess of each is its current value, and each name can be passed
+        to set_beta(), e.g. in build_sim:
+
+            for k, pars in calib_pars.items():
+                if '[' in k:
+                    sim.networks.contact_matrix_mixing.set_beta(k, pars['value'])
+
+        Args:
+            low (float): the lower bound of each
+            high (float): the upper bound of each
+            log (bool): whether to search each on a log scale
+            entries (list): if given, only these (src, dst) entries of the beta matrix, e.g. [('0-20', '20-100')]
+        """
+        p = self.pars
+        vals = {}
+        if p.beta_matrix is not None:
+            labels = self.beta_labels
+            pairs = entries if entries is not None else [(s, d) for s in labels for d in labels]
+            for s, d in pairs:
+                vals[f'beta[{s}->{d}]'] = p.beta_matrix[labels.index(s), labels.index(d)]
+        if p.beta_factors is not None:
+            for kind, factor in zip(['beta_src', 'beta_dst'], p.beta_factors):
+                for i, label in enumerate(self.factor_labels):
+                    for k in range(factor.shape[1]):
+                        vals[f'{kind}[{label},{k}]'] = factor[i, k]
+        return {name: dict(low=low, high=high, guess=float(np.clip(v, low, high)), suggest_type='suggest_float', log=log)
+                for name, v in vals.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def init_post(self):
+        super().init_post()
+        if len(self.pars.diseases) == 0:
+            self.diseases = [d for d in self.sim.diseases.values() if isinstance(d, ss.Infection)]
+        else:
+            self.diseases = [self.sim.diseases[d] for d in self.pars.diseases]
+        if self.pars.replicates is not None:
+            if self.pars.schedule is not None:
+                raise NotImplementedError('Replicates are not supported with an activity schedule')
+            self.n_reps = self.sim.connectors[self.pars.replicates].n_reps
+        return
+
+    def remove_uids(self, uids):
+        """ Nothing to do: dead agents drop out of the groups in step() """
+        return
+
+    def compute_keys(self):
+        """ Compute the group of every agent in one vectorized pass """
+        p = self.pars
+        ppl = self.sim.people
+        loc = getattr(ppl, p.state).raw
+        return group_keys(ppl.age.raw, loc, p.age_bins, p.codes, alive=ppl.alive.raw)
+
+    def step(self):
+        """ Update the group of every agent """
+        p = self.pars
+        if p.grp_index is not None:
+            self.key = self.sim.connectors[p.grp_index].key
+        else:
+            self.key = self.compute_keys()
+        if p.replicates is not None:
+            self.key = self.sim.connectors[p.replicates].offset_keys(self.key, len(self))
+        self.weights = self.transmission_matrix() # Small (n_groups x n_groups), so cheap to redo, and picks up set_beta()
+        return
+
+    def compute_prevalence(self, key, rel_trans):
+        """ Mean rel_trans of each group (in each replicate), with a single bincount """
+        valid = np.nonzero(key >= 0)[0]
+        n_groups = len(self) * self.n_reps
+        size = np.bincount(key[valid], minlength=n_groups)
+        trans = np.bincount(key[valid], weights=rel_trans.raw[valid], minlength=n_groups)
+        prev = np.divide(trans, size, out=np.zeros(n_groups), where=size > 0)
+        return prev
+
+    def compute_transmission(self, rel_sus, rel_trans, disease_beta, disease=None):
+        """ Compute the force of infection on every group and draw new infections in bulk """
+        if (disease_beta == 0) or (disease not in self.diseases):
+            return []
+
+        beta = self.pars.beta
+        if isinstance(beta, ss.Rate):
+            beta = beta.to_prob(self.t.dt)
+        if beta == 0:
+            return []
+
+        hazard = self.compute_hazard(rel_trans)
+        sus = rel_sus.raw
+        uids = ss.uids(np.nonzero((hazard > 0) & (sus > 0))[0])
+        if len(uids) == 0:
+            return []
+        p = -np.expm1(-beta * disease_beta * hazard[uids] * sus[uids])
+        self.p_acquire.set(p=p)
+        new = self.p_acquire.filter(uids)
+        self.last[disease.name] = (new, self.key, rel_trans, self.sub_steps) # References only, so this costs nothing
+        return new
+
+    def attribute_sources(self, disease, targets, return_locations=False):
+        """
+        Pick a plausible source for each of the targets infected on this step
+
+        Transmission here is from whole groups, not individuals, so the
+        source is drawn from the force of infection: the source group i of a
+        target in group j with probability proportional to contacts[i,j] * prev_i,
+        and then an infectious agent of group i (of the same replicate) in
+        proportion to their rel_trans. With an activity schedule, the sub-step
+        of each infection is drawn first, in proportion to its duration times
+        the force of infection on the target in it, and the groups (and so the
+        locations) are those of that sub-step. The draws come from their own
+        random stream, so attributing sources doesn't change the run.
+
+        Args:
+            disease (ss.Disease): the disease
+            targets (ss.uids): agents this route infected on this step
+            return_locations (bool): also return where each target and source was when infected
+
+        Returns:
+            The uid of the source of each target, or -1 if it can't be attributed;
+            with return_locations, also the location state value of each target
+            and of its source when infected (-1 if unknown)
+        """
+        p = self.pars
+        n = len(self)
+        n_bands = len(p.age_bins) - 1
+        sources = np.full(len(targets), -1, dtype=np.int64)
+        tloc = np.full(len(targets), -1, dtype=np.int64)
+        sloc = np.full(len(targets), -1, dtype=np.int64)
+        result = (sources, tloc, sloc) if return_locations else sources
+        if disease.name not in self.last or len(targets) == 0:
+            return result
+        _, key, rel_trans, sub = self.last[disease.name]
+        rands = self.source_rng.rvs(3*len(targets), reset=True).reshape(3, -1) # reset, so another disease can draw too
+
+        if sub is None:
+            # The groups of this step, keyed by replicate x group
+            trans = rel_trans.raw
+            inf = np.nonzero((key >= 0) & (trans > 0))[0]
+            inf_key, inf_trans = key[inf], trans[inf]
+            n_keys = n*self.n_reps
+            size = np.bincount(key[key >= 0], minlength=n_keys)
+            group_trans = np.bincount(inf_key, weights=inf_trans, minlength=n_keys)
+            prev = np.divide(group_trans, size, out=np.zeros(n_keys), where=size > 0).reshape(self.n_reps, n)
+            tkey = key[targets]
+            state = getattr(self.sim.people, p.state).raw
+            tloc[:] = state[targets]
+        else:
+            # Draw the sub-step of each infection, then key the groups by sub-step x group
+            n_sub = len(sub['durations'])
+            tgroups = sub['groups'][sub['combo'][targets]] # (n_targets x n_sub)
+            w = sub['durations'] * sub['foi'][np.arange(n_sub), tgroups]
+            cumw = np.cumsum(w, axis=1)
+            si = (rands[2][:, None] * cumw[:, -1:] >= cumw).sum(axis=1)
+            drawn = np.nonzero(si < n_sub)[0]
+            j = tgroups[drawn, si[drawn]]
+            tkey = np.full(len(targets), -1, dtype=np.int64)
+            tkey[drawn] = si[drawn]*n + j
+            tloc[drawn] = p.codes[j // n_bands]
+            inf_groups = sub['groups'][sub['inf_combo']].T # (n_sub x n_inf)
+            inf_key = (np.arange(n_sub)[:, None]*n + inf_groups).ravel()
+            ok = (inf_groups < n).ravel() # Not in a location at that sub-step
+            inf = np.tile(sub['infectious'], n_sub)[ok]
+            inf_key, inf_trans = inf_key[ok], np.tile(sub['inf_trans'], n_sub)[ok]
+            n_keys = n*n_sub
+            prev = sub['prev']
+
+        # Infectious agents sorted by key, with the running total of their rel_trans
+        order = np.argsort(inf_key, kind='stable')
+        inf, inf_key = inf[order], inf_key[order]
+        cum = np.cumsum(inf_trans[order])
+        bounds = np.searchsorted(inf_key, np.arange(n_keys + 1)) # Each key's range in inf
+
+        # The source group, in proportion to contacts[i,j] * prev_i (of the same replicate or sub-step)
+        ok = np.nonzero(tkey >= 0)[0]
+        rep, j = np.divmod(tkey[ok], n)
+        weight = prev[rep] * self.weights[:, j].T # (n_targets x n_groups)
+        cumw = np.cumsum(weight, axis=1)
+        i = (rands[0][ok][:, None] * cumw[:, -1:] >= cumw).sum(axis=1)
+        found = i < n # Otherwise there was no infectious agent to attribute to
+        ok, i, src_key = ok[found], i[found], rep[found]*n + i[found]
+
+        # Then an agent in the source group, in proportion to rel_trans
+        lo, hi = bounds[src_key], bounds[src_key+1]
+        start = np.where(lo > 0, cum[np.maximum(lo-1, 0)], 0.0)
+        pick = start + rands[1][ok] * (cum[hi-1] - start)
+        idx = np.clip(np.searchsorted(cum, pick, side='right'), lo, hi-1)
+        sources[ok] = inf[idx]
+        if sub is None:
+            sloc[ok] = state[sources[ok]]
+        else:
+            sloc[ok] = p.codes[i // n_bands]
+        return result
+
+    def compute_hazard(self, rel_trans):
+        """ Force of infection on each agent (before beta), summed over the sub-steps of the schedule if any """
+        if self.pars.schedule is None:
+            return self.agent_foi(self.key, rel_trans)
+        else:
+            return self.schedule_hazard(rel_trans)
+
+    def schedule_hazard(self, rel_trans):
+        """
+        Sum the force of infection over the sub-steps of an activity_schedule
+
+        Within a step, an agent's group only depends on their (pattern, age band),
+        so the population is binned by (pattern, age band) once, and each sub-step
+        only works on that small table plus the infectious agents. The location
+        state is left at the last sub-step; the force of infection and
+        prevalence of every group at each sub-step are kept in self.sub_steps,
+        so attribute_sources() can tell where each infection happened.
+        """
+        p = self.pars
+        sched = self.sim.connectors[p.schedule]
+        ppl = self.sim.people
+        n_bands = len(p.age_bins) - 1
+        n_groups = len(self)
+        n_combos = sched.n_patterns * n_bands
+
+        # Location index of each pattern at each sub-step, and the group of each (pattern, age band) per sub-step
+        li = np.searchsorted(p.codes, sched.pars.patterns)
+        li[li >= len(p.codes)] = 0
+        li = np.where(p.codes[li] == sched.pars.patterns, li, -1)
+        band = np.arange(n_bands)
+        groups = np.where(li[:, None, :] >= 0, li[:, None, :]*n_bands + band[None, :, None], n_groups) # (pattern, band, sub)
+        groups = groups.reshape(n_combos, sched.n_sub)
+
+        # Bin the population once; agents outside the age bins or not alive are in the trailing bin
+        age_band = np.searchsorted(p.age_bins, ppl.age.raw, side='right') - 1
+        valid = ppl.alive.raw & (age_band >= 0) & (age_band < n_bands)
+        combo = np.where(valid, sched.pattern.raw*n_bands + age_band, n_combos)
+        combo_size = np.bincount(combo, minlength=n_combos+1)[:n_combos]
+        infectious = np.nonzero(valid & (rel_trans.raw > 0))[0]
+        inf_combo = combo[infectious]
+        inf_trans = rel_trans.raw[infectious]
+
+        # Accumulate the force of infection on each (pattern, age band) over the sub-steps
+        combo_foi = np.zeros(n_combos+1)
+        sub_prev = np.zeros((sched.n_sub, n_groups))
+        sub_foi = np.zeros((sched.n_sub, n_groups+1)) # Agents in no location get the trailing 0
+        for sub, dur in enumerate(sched.pars.durations):
+            grp = groups[:, sub]
+            size = np.bincount(grp, weights=combo_size, minlength=n_groups+1)[:n_groups]
+            trans = np.bincount(grp[inf_combo], weights=inf_trans, minlength=n_groups+1)[:n_groups]
+            sub_prev[sub] = np.divide(trans, size, out=np.zeros(n_groups), where=size > 0)
+            sub_foi[sub, :n_groups] = self.weights.T @ sub_prev[sub]
+            combo_foi[:n_combos] += dur * sub_foi[sub][grp]
+
+        groups = np.vstack([groups, np.full(sched.n_sub, n_groups)]) # The trailing bin is in no group
+        self.sub_steps = dict(combo=combo, groups=groups, durations=sched.pars.durations, prev=sub_prev, foi=sub_foi,
+                              infectious=infectious, inf_combo=inf_combo, inf_trans=inf_trans)
+        sched.apply(sched.n_sub-1)
+        self.key = self.compute_keys()
+        return combo_foi[combo]
+
+    def agent_foi(self, key, rel_trans):
+        """ Compute the force of infection on every group with one matrix product, and give it to its members """
+        prev = self.compute_prevalence(key, rel_trans).reshape(self.n_reps, len(self))
+        foi = np.append((prev @ self.weights).ravel(), 0.0) # Agents in no group (key -1) get the trailing 0
+        return foi[key]
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# VENUE MIXING
+#
+# Households, classrooms and workplaces are hundreds of thousands of small
+# venues, which ss.MixingPools (one pool per group, with its own uid lookups)
+# can't express. Instead, keep who belongs to which venue as a sparse
+# (agents x venues) membership matrix in CSR form: the infectious pressure in
+# every venue is then one sparse transposed mat-vec over the memberships, and
+# the force of infection on every agent one sparse mat-vec back. Each step is
+# O(memberships), so 1e6 households cost about as much as a handful of pools.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class venue_mixing(ss.Route):
+    """
+    Transmission within venues (households, schools, workplaces, communities), each well mixed
+
+    Each step, the probability that a susceptible agent is infected is
+
+        1 - exp(-beta * disease_beta * rel_sus * sum_v(contacts_v * prev_v))
+
+    summed over the agent's venues v, where prev_v is the mean rel_trans of
+    the living members of v, and contacts_v is the number of contacts per
+    step in venues of that type. Agents added during the run (e.g. births)
+    belong to no venue.
+
+    Args:
+        diseases (str): the diseases that transmit via this route
+        beta (float): overall transmission via this route
+        contacts (dict): the contacts in each type of venue, e.g. dict(house=3, school=10, work=5, community=1);
+            types that aren't given aren't used
+        venues (str): the name of the venues connector to take the memberships from
+        membership (sparse): instead of venues, an (n_agents x n_venues) sparse matrix of memberships, with
+            the contacts in each venue as its values
+
+    **Example**:
+
+        vm = venue_mixing(diseases='sir', beta=0.1, contacts=dict(house=3, school=10, work=5, community=1))
+        sim = ss.Sim(diseases='sir', connectors=venues(), networks=vm, people=ppl)
+    """
+    def __init__(self, pars=None, diseases=_, beta=_, contacts=_, venues=_, membership=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            diseases = None,
+            beta = 1.0,
+            contacts = dict(house=3.0, school=10.0, work=5.0, community=1.0),
+            venues = 'venues',
+            membership = None,
+        )
+        self.update_pars(pars, **kwargs)
+        self.pars.diseases = sc.tolist(self.pars.diseases)
+        self.diseases = None
+        self.M = None # (agents x venues) memberships, CSR
+        self.weight = None # Contacts in each venue
+        self.size = None # Living members of each venue
+        self.n_alive = None # Living members in total, to know when to recount the sizes
+        self.prenatal = False # Does not make sense for well-mixed venues
+        self.postnatal = False
+        self.p_acquire = ss.bernoulli(p=0) # Placeholder value
+        return
+
+    def __len__(self):
+        return 0 if self.M is None else self.M.shape[1]
+
+    def init_post(self):
+        super().init_post()
+        p = self.pars
+        if len(p.diseases) == 0:
+            self.diseases = [d for d in self.sim.diseases.values() if isinstance(d, ss.Infection)]
+        else:
+            self.diseases = [self.sim.diseases[d] for d in p.diseases]
+
+        if p.membership is not None:
+            M = sp.csr_array(p.membership, dtype=float)
+            self.weight = M.max(axis=0).toarray().ravel()
+            M.data[:] = 1.0
+        else:
+            M = self.make_membership(self.sim.connectors[p.venues], p.contacts)
+        self.M = M
+        return
+
+    def make_membership(self, venues, contacts):
+        """ Build the membership matrix from the venue IDs, one block of columns per venue type """
+        n = len(venues.sim.people.uid.raw)
+        rows, cols, weights = [], [], []
+        offset = 0
+        for key, n_contacts in contacts.items():
+            ids = getattr(venues, key).raw[:n]
+            member = np.nonzero(ids >= 0)[0]
+            n_venues = venues.n_venues[key]
+            rows.append(member)
+            cols.append(ids[member].astype(np.int64) + offset)
+            weights.append(np.full(n_venues, n_contacts, dtype=float))
+            offset += n_venues
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        self.weight = np.concatenate(weights)
+        return sp.csr_array((np.ones(len(rows)), (rows, cols)), shape=(n, offset))
+
+    def remove_uids(self, uids):
+        """ Nothing to do: dead agents drop out of the venue sizes in compute_hazard() """
+        return
+
+    def step(self):
+        return
+
+    def compute_hazard(self, rel_trans):
+        """ The force of infection on each agent (before beta): two sparse mat-vecs """
+        n = self.M.shape[0]
+        alive = self.sim.people.alive.raw[:n]
+        n_alive = np.count_nonzero(alive)
+        if n_alive != self.n_alive: # Only recount the venue sizes when someone has died
+            self.size = self.M.T @ alive.astype(float)
+            self.n_alive = n_alive
+
+        # Only the rows of the infectious agents contribute to the pressure in each venue
+        trans = rel_trans.raw[:n]
+        inf = np.nonzero(trans)[0]
+        pressure = self.M[inf].T @ trans[inf]
+        prev = np.divide(pressure, self.size, out=np.zeros(len(self.size)), where=self.size > 0)
+        hazard = np.zeros(len(rel_trans.raw))
+        hazard[:n] = self.M @ (self.weight * prev)
+        return hazard
+
+    def compute_transmission(self, rel_sus, rel_trans, disease_beta, disease=None):
+        """ Compute the force of infection on every agent from their venues and draw new infections in bulk """
+        if (disease_beta == 0) or (disease not in self.diseases):
+            return []
+
+        beta = self.pars.beta
+        if isinstance(beta, ss.Rate):
+            beta = beta.to_prob(self.t.dt)
+        if beta == 0:
+            return []
+
+        hazard = self.compute_hazard(rel_trans)
+        sus = rel_sus.raw
+        uids = ss.uids(np.nonzero((hazard > 0) & (sus > 0))[0])
+        if len(uids) == 0:
+            return []
+        p = -np.expm1(-beta * disease_beta * hazard[uids] * sus[uids])
+        self.p_acquire.set(p=p)
+        return self.p_acquire.filter(uids)
@@ -0,0 +1,239 @@
+"""
+Deterministic metapopulation SIR/SEIR over the age band x location groups
+"""
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from pathlib import Path
+from scipy.integrate import odeint
+from rsv_groups import group_names
+from rsv_contacts import read_matrix
+
+__all__ = ['metapop_ode']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# METAPOPULATION ODE
+#
+# The agent-based runs are too slow to try thousands of parameter sets. The
+# same groups, contact matrix and beta also define a compartmental model: each
+# group is well mixed, and the force of infection on group j is
+#
+#     beta * sum_i(contacts[i,j] * I_i/N_i)
+#
+# as in contact_matrix_mixing. Integrating this over ten years takes
+# milliseconds, so it can screen parameter sets before the agent-based
+# calibration (see rsv_calibration.screen).
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class metapop_ode:
+    """
+    A deterministic SIR (or SEIR, if dur_exp is given) model over groups
+
+    Time is in days. Like contact_matrix_mixing, the row of the contact
+    matrix is the source and the column is the destination. The infectious
+    period can be split into n_stages stages (an Erlang distribution), since
+    agent-based durations are often much less variable than an exponential,
+    which changes how fast the epidemic grows for the same R0.
+
+    Args:
+        contacts (array/str): the (n_groups x n_groups) contact matrix, or a CSV file to read it from
+        sizes (array): the number of people in each group
+        beta (float): the transmission rate per contact per day
+        dur_inf (float): the mean number of days infectious
+        dur_exp (float): the mean number of days exposed; if None, the model is SIR
+        init_prev (float/array): the fraction of each group infectious at the start
+        n_stages (int): the number of stages of the infectious period
+        names (list): the group names (default: group_names(age_bins, locations) if both are given)
+
+    **Example**:
+
+        ode = metapop_ode.from_sim(sim) # Same groups, contacts and beta as the sim
+        res = ode.run(days=3650)
+        res = ode.run(days=3650, beta=0.02) # Try another beta
+    """
+    def __init__(self, contacts, sizes, beta=0.1, dur_inf=7.0, dur_exp=None, init_prev=0.01, n_stages=1,
+                 names=None, age_bins=None, locations=None):
+        if isinstance(contacts, (str, Path)):
+            contacts = read_matrix(contacts)
+        self.contacts = np.asarray(contacts, dtype=float)
+        self.sizes = np.asarray(sizes, dtype=float)
+        self.n_groups = len(self.sizes)
+        if self.contacts.shape != (self.n_groups, self.n_groups):
+            errormsg = f'The contact matrix must have one row and column per group, but {self.contacts.shape} != {(self.n_groups, self.n_groups)}'
+            raise ValueError(errormsg)
+        if names is None and age_bins is not None and locations is not None:
+            names = group_names(age_bins, locations)
+        self.names = names if names is not None else [f'group {g}' for g in range(self.n_groups)]
+        self.beta = beta
+        self.dur_inf = dur_inf
+        self.dur_exp = dur_exp
+        self.init_prev = init_prev
+        self.n_stages = int(n_stages)
+        self.results = None
+        return
+
+    @property
+    def seir(self):
+        return self.dur_exp is not None
+
+    @property
+    def n_comps(self):
+        """ S, (E,) the infectious stages, R, and the cumulative infections """
+        return self.n_stages + (4 if self.seir else 3)
+
+    @classmethod
+    def from_sim(cls, sim, route=None, disease=None, max_stages=4):
+        """
+        Make the ODE from a sim's contact_matrix_mixing or ss.MixingPools route
+
+        The group sizes are taken from the sim as it is (e.g. just after
+        sim.init()), and beta is converted to a rate per day from the
+        per-step probabilities the agent-based model uses. The number of
+        infectious stages matches the variability of the disease's dur_inf.
+
+        Args:
+            sim (ss.Sim): an initialized sim
+            route (str): the name of the route (default: the first one)
+            disease (str): the name of the disease (default: the first one)
+            max_stages (int): the most infectious stages to use
+        """
+        route = sim.networks[route] if route is not None else sim.networks[0]
+        disease = sim.diseases[disease] if disease is not None else sim.diseases[0]
+        dt = sim.t.dt.days
+
+        if isinstance(route, ss.MixingPools):
+            src = route.pars.src
+            sizes = [len(select(sim)) for select in src.values()]
+            contacts = route.pars.n_contacts
+            contacts = np.full((len(sizes), len(sizes)), contacts) if np.isscalar(contacts) else contacts
+            names = list(src.keys())
+        else:
+            key = route.compute_keys()
+            sizes = np.bincount(key[key >= 0], minlength=len(route))
+            contacts = route.transmission_matrix() # Including any relative beta between groups
+            names = route.names
+
+        def to_prob(beta):
+            return beta.to_prob(sim.t.dt) if isinstance(beta, ss.Rate) else beta
+
+        disease_beta = disease.pars.beta
+        if isinstance(disease_beta, dict):
+            disease_beta = disease_beta[route.name]
+        if isinstance(disease_beta, (list, tuple)):
+            disease_beta = disease_beta[0] # Routes are unidirectional, so only the first is used
+        disease_beta = to_prob(disease_beta)
+        beta = to_prob(route.pars.beta) * disease_beta / dt
+
+        def mean_days(dist):
+            mean = dist.pars.mean
+            return mean.days if isinstance(mean, ss.dur) else float(mean)
+
+        vals = sc.dcp(disease.pars.dur_inf).rvs(10_000) # A copy, so the sim's random streams are untouched
+        cv = vals.std() / vals.mean()
+        n_stages = int(np.clip(np.round(1/max(cv, 1e-6)**2), 1, max_stages)) # An Erlang with k stages has a CV of 1/sqrt(k)
+
+        dur_exp = mean_days(disease.pars.dur_exp) if 'dur_exp' in disease.pars else None
+        init_prev = disease.pars.init_prev.pars.p
+        return cls(contacts=contacts, sizes=sizes, beta=beta, dur_inf=mean_days(disease.pars.dur_inf),
+                   dur_exp=dur_exp, init_prev=init_prev, n_stages=n_stages, names=names)
+
+    def initial_state(self):
+        """ The compartments of each group, flattened, with everyone infectious in the first stage """
+        n = self.sizes
+        I = np.broadcast_to(self.init_prev, n.shape) * n
+        y = np.zeros((self.n_comps, self.n_groups))
+        first = 2 if self.seir else 1
+        y[0] = n - I
+        y[first] = I
+        y[-1] = I
+        return y.ravel()
+
+    def derivative(self, y, t, beta, contacts, inv_sizes):
+        """ The right-hand side, for all groups at once """
+        y = y.reshape(self.n_comps, self.n_groups)
+        first = 2 if self.seir else 1
+        stages = y[first:first+self.n_stages]
+        new = beta * ((stages.sum(axis=0)*inv_sizes) @ contacts) * y[0]
+        rate = self.n_stages / self.dur_inf
+        flow = rate * stages # Out of each stage
+        dy = np.empty_like(y)
+        dy[0] = -new
+        if self.seir:
+            onset = y[1] / self.dur_exp
+            dy[1] = new - onset
+            dy[first] = onset - flow[0]
+        else:
+            dy[first] = new - flow[0]
+        dy[first+1:first+self.n_stages] = flow[:-1] - flow[1:]
+        dy[-2] = flow[-1]
+        dy[-1] = new
+        return dy.ravel()
+
+    def jacobian(self, y, t, beta, contacts, inv_sizes):
+        """ The Jacobian of derivative(), so the stiff solver doesn't estimate it by finite differences """
+        n = self.n_groups
+        y = y.reshape(self.n_comps, n)
+        first = 2 if self.seir else 1
+        I = y[first:first+self.n_stages].sum(axis=0)
+        F = np.diag(beta * ((I*inv_sizes) @ contacts)) # d(new)/dS
+        M = beta * y[0][:, None] * (contacts.T * inv_sizes[None, :]) # d(new)/d(each stage)
+        eye = np.eye(n)
+        rate = eye * self.n_stages / self.dur_inf
+
+        J = np.zeros((self.n_comps, self.n_comps, n, n))
+        stages = range(first, first+self.n_stages)
+        for row, sign in [(0, -1), (1 if self.seir else first, 1), (self.n_comps-1, 1)]: # The rows that include new infections
+            J[row, 0] += sign*F
+            for si in stages:
+                J[row, si] += sign*M
+        if self.seir:
+            J[1, 1] -= eye / self.dur_exp
+            J[first, 1] += eye / self.dur_exp
+        for si in stages:
+            J[si, si] -= rate
+            J[si+1, si] += rate # The next stage, or R after the last
+        return J.transpose(0, 2, 1, 3).reshape(self.n_comps*n, self.n_comps*n)
+
+    def run(self, days=3650, dt=1.0, beta=None, contacts=None, rtol=1e-6):
+        """
+        Integrate the model, and return the results
+
+        Args:
+            days (float): the number of days to run for
+            dt (float): the spacing of the output times, in days
+            beta (float): if given, use this beta instead of self.beta (e.g. to screen parameters)
+            contacts (array): likewise for the contact matrix
+            rtol (float): the relative tolerance of the solver
+
+        Returns:
+            An sc.objdict with the output times (t) and each compartment (S, E, I, R) and the
+            cumulative infections (cum_infections), each with shape (n_times, n_groups)
+        """
+        beta = self.beta if beta is None else beta
+        contacts = self.contacts if contacts is None else np.asarray(contacts, dtype=float)
+        inv_sizes = np.divide(1, self.sizes, out=np.zeros(self.n_groups), where=self.sizes > 0)
+        t = np.arange(0, days + dt/2, dt)
+        y, info = odeint(self.derivative, self.initial_state(), t, args=(beta, contacts, inv_sizes), Dfun=self.jacobian,
+                         rtol=rtol, atol=1e-6, full_output=True)
+        if info['message'] != 'Integration successful.':
+            raise RuntimeError(f'The ODE solver failed: {info["message"]}')
+        y = y.reshape(len(t), self.n_comps, self.n_groups)
+        first = 2 if self.seir else 1
+        self.results = sc.objdict(t=t, S=y[:, 0])
+        if self.seir:
+            self.results.E = y[:, 1]
+        self.results.I = y[:, first:first+self.n_stages].sum(axis=1)
+        self.results.R = y[:, -2]
+        self.results.cum_infections = y[:, -1]
+        return self.results
+
+    def to_df(self):
+        """ The number infected (exposed or infectious) in each group, one row per output time, like infections_by_stratum """
+        res = self.results
+        infected = res.I + res.E if self.seir else res.I
+        df = pd.DataFrame(infected, columns=self.names)
+        df.insert(0, 'day', res.t)
+        return df
@@ -0,0 +1,201 @@
+"""
+Synthetic population: household, school, work and community IDs for every agent
+"""
+import json
+import numpy as np
+import sciris as sc
+import starsim as ss
+
+_ = None
+
+__all__ = ['partition', 'make_population', 'save_population', 'load_population', 'venues']
+
+venue_types = ['house', 'school', 'work', 'community']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# VENUE IDS
+#
+# From NewDirections.md, each person has a house id, a school id, a community id
+# and a work id, with venue sizes from Poisson distributions. Rather than fill
+# venues one person at a time, draw all the venue sizes at once, and cut the
+# (shuffled) eligible agents into consecutive runs of those sizes: the venue of
+# each agent is then one np.repeat over the sizes. Households are seeded with
+# one adult each first, so that no household is only children.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def partition(n, mu, rng, min_size=1):
+    """
+    Cut n agents into venues with Poisson(mu) sizes (at least min_size)
+
+    Returns the venue of each of the n agents (in order, as int32), and the sizes
+    of the venues.
+    """
+    if n == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+    sizes = np.empty(0, dtype=np.int64)
+    total = 0
+    while total < n: # Almost always a single pass
+        more = np.maximum(rng.poisson(mu, size=int(1.1*(n - total)/max(mu, 1)) + 10), min_size)
+        sizes = np.concatenate([sizes, more])
+        total = sizes.sum()
+    ends = np.cumsum(sizes)
+    n_venues = np.searchsorted(ends, n) + 1
+    sizes = sizes[:n_venues]
+    sizes[-1] -= ends[n_venues-1] - n # Trim the last venue to fit
+    ids = np.repeat(np.arange(n_venues, dtype=np.int32), sizes)
+    return ids, sizes
+
+
+def make_population(age, mu_house=2.5, mu_school=400, mu_work=15, mu_community=2000,
+                    school_ages=(5, 19), work_ages=(19, 65), adult_age=18, seed=None):
+    """
+    Assign every agent to a household, community, and (by age) a school or workplace
+
+    Each household gets one adult (a random one), and the rest of its places
+    are filled with the other agents, adults and children, at random; if there
+    are fewer adults than households, the extra households are merged into
+    the others. Beyond that, households have no age structure (e.g. parents
+    are not matched to their children's ages). Communities are consecutive
+    runs of households, so members of a household share a community. Schools
+    and workplaces are drawn from the shuffled agents of the right ages; other
+    agents have a school/work ID of -1.
+
+    Args:
+        age (array): the age of each agent
+        mu_house, mu_school, mu_work, mu_community (float): the mean venue sizes
+        school_ages (tuple): [min, max) age of school attendance
+        work_ages (tuple): [min, max) age of work
+        adult_age (float): the age from which an agent can head a household
+        seed (int/np.random.Generator): random seed, or the generator to draw from
+
+    Returns:
+        A dict of arrays: age (float32), and the venue of each agent for each of
+        venue_types (int32)
+    """
+    rng = np.random.default_rng(seed)
+    age = np.asarray(age)
+    n = len(age)
+    pop = sc.objdict(age=age.astype(np.float32))
+
+    # One adult per household, then everyone else in the remaining places
+    _, house_sizes = partition(n, mu_house, rng)
+    adults = np.flatnonzero(age >= adult_age)
+    if len(adults) == 0: # No one to head the households, so anyone will do
+        adults = np.arange(n)
+    n_houses = min(len(house_sizes), len(adults))
+    if n_houses < len(house_sizes): # Fold the households without an adult into the others
+        extra = house_sizes[n_houses:]
+        house_sizes = house_sizes[:n_houses] + np.bincount(np.arange(len(extra)) % n_houses, weights=extra,
+                                                           minlength=n_houses).astype(np.int64)
+    heads = rng.permutation(adults)[:n_houses]
+    others = np.ones(n, dtype=bool)
+    others[heads] = False
+    house_start = np.cumsum(house_sizes) - house_sizes
+    head_slot = np.zeros(n, dtype=bool)
+    head_slot[house_start] = True
+    order = np.empty(n, dtype=np.int64) # The agent in each place, household by household
+    order[head_slot] = heads
+    order[~head_slot] = rng.permutation(np.flatnonzero(others))
+    pop.house = np.empty(n, dtype=np.int32)
+    pop.house[order] = np.repeat(np.arange(n_houses, dtype=np.int32), house_sizes)
+    _, comm_sizes = partition(n, mu_community, rng)
+    comm_of_house = np.searchsorted(np.cumsum(comm_sizes), house_start, side='right').astype(np.int32)
+    pop.community = comm_of_house[pop.house]
+
+    for key, mu, (lo, hi) in [['school', mu_school, school_ages], ['work', mu_work, work_ages]]:
+        members = rng.permutation(np.flatnonzero((age >= lo) & (age < hi)))
+        ids = np.full(n, -1, dtype=np.int32)
+        ids[members] = partition(len(members), mu, rng)[0]
+        pop[key] = ids
+    return pop
+
+
+def save_population(folder, pop):
+    """ Save a population as one .npy file per array, so it can be memory-mapped by load_population() """
+    folder = sc.path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for key, arr in pop.items():
+        np.save(folder / f'{key}.npy', np.asarray(arr))
+    meta = dict(n_agents=len(pop['age']), keys=list(pop.keys()))
+    (folder / 'meta.json').write_text(json.dumps(meta))
+    return folder
+
+
+def load_population(folder, mmap_mode='r'):
+    """ Load a population saved by save_population(), memory-mapped (read-only) by default """
+    folder = sc.path(folder)
+    meta = json.loads((folder / 'meta.json').read_text())
+    pop = sc.objdict({key: np.load(folder / f'{key}.npy', mmap_mode=mmap_mode) for key in meta['keys']})
+    return pop
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# VENUES CONNECTOR
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class venues(ss.Connector):
+    """
+    Give every agent a house, school, work and community ID, as int32 states
+
+    The IDs are made with make_population() from the ages of the sim's people,
+    drawing from the connector's own random stream (seeded from the sim's
+    rand_seed like every other distribution), or taken from a population made (or saved and loaded) beforehand, in which
+    case the people's ages are set to those of the population too.
+
+    Args:
+        population (dict/str): a population from make_population()/load_population(), or a folder to load one from
+        mu_house, mu_school, mu_work, mu_community (float): the mean venue sizes
+        school_ages (tuple): [min, max) age of school attendance
+        work_ages (tuple): [min, max) age of work
+
+    **Example**:
+
+        pop = make_population(age, seed=1)
+        save_population('pop_1e6', pop)
+        sim = ss.Sim(n_agents=len(pop.age), connectors=venues(population='pop_1e6'), ...)
+    """
+    def __init__(self, pars=None, population=_, mu_house=_, mu_school=_, mu_work=_, mu_community=_,
+                 school_ages=_, work_ages=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            population = None,
+            mu_house = 2.5,
+            mu_school = 400,
+            mu_work = 15,
+            mu_community = 2000,
+            school_ages = [5, 19],
+            work_ages = [19, 65],
+        )
+        self.update_pars(pars, **kwargs)
+        self.define_states(*[ss.Arr(key, dtype=np.int32, nan=-1, default=-1, label=f'{key.title()} ID') for key in venue_types])
+        self.n_venues = sc.objdict()
+        self.draws = ss.random() # Only its generator is used, to make the population
+        return
+
+    def init_post(self):
+        super().init_post()
+        p = self.pars
+        ppl = self.sim.people
+        uids = ppl.auids
+        pop = p.population
+        if isinstance(pop, str) or hasattr(pop, 'is_dir'): # A folder
+            pop = load_population(pop)
+        if pop is None:
+            pop = make_population(ppl.age.raw[uids], mu_house=p.mu_house, mu_school=p.mu_school,
+                                  mu_work=p.mu_work, mu_community=p.mu_community, school_ages=p.school_ages,
+                                  work_ages=p.work_ages, seed=self.draws.rng)
+        else:
+            if len(pop['age']) != len(uids):
+                raise ValueError(f'The population has {len(pop["age"])} agents, but the sim has {len(uids)}')
+            ppl.age[uids] = pop['age']
+        for key in venue_types:
+            getattr(self, key)[uids] = pop[key]
+            self.n_venues[key] = int(pop[key].max()) + 1 if len(uids) else 0
+        return
+
+    def step(self):
+        """ The venues are fixed once made; new agents have no venues (-1) """
+        return
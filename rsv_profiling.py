@@ -0,0 +1,191 @@
+"""
+Per-module step timing, with an optional line profiler, for finding where a run's time goes
+"""
+import io
+import time
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+
+__all__ = ['step_timing']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# STEP TIMING
+#
+# When a run is slow, we want to know whether the time goes to the mixing pool
+# lambdas, the disease step or an analyzer. The step_timing analyzer swaps
+# each module's step() (and each disease's step_state()) for a timed version
+# before the sim's loop collects them: two perf_counter() calls and an add
+# into a preallocated (n_steps x n_funcs) array. Without the analyzer, nothing
+# is wrapped, so there is no cost at all.
+#
+# The timed versions are plain functions bound to the module, rather than
+# closures, so a copied sim (e.g. in calibration) times into its own analyzer.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def step(self):
+    """ A module's step(), timed by the step_timing analyzer """
+    t0 = time.perf_counter()
+    type(self).step(self)
+    self.sim.analyzers[self._timer].add(self.name, 'step', time.perf_counter() - t0)
+    return
+
+
+def step_state(self):
+    """ A disease's step_state(), timed by the step_timing analyzer """
+    t0 = time.perf_counter()
+    type(self).step_state(self)
+    self.sim.analyzers[self._timer].add(self.name, 'step_state', time.perf_counter() - t0)
+    return
+
+
+class step_timing(ss.Analyzer):
+    """
+    Time the step of every module in the sim, and optionally line profile the hot functions
+
+    The times of each step are in self.times, with shape (n_steps, n_funcs),
+    and to_df() summarizes them per function (or per module) with the total,
+    mean and percentiles of the time per step.
+
+    Args:
+        line_profile (bool/list): if True, line profile every module's step (and
+            each network's compute_transmission and each disease's infect); or
+            a list of functions or 'module.method' names to profile, e.g.
+            ['sir.infect', 'contact_matrix_mixing.compute_transmission']
+
+    **Example**:
+
+        sim = ss.Sim(..., analyzers=[grp_counts, step_timing()])
+        sim.run()
+        print(sim.analyzers.step_timing.to_df())
+        sim.analyzers.step_timing.save('timing.txt')
+    """
+    def __init__(self, line_profile=False, **kwargs):
+        super().__init__(**kwargs)
+        self.line_profile = line_profile
+        self.funcs = [] # (module, func) of each column of self.times
+        self.cols = {}
+        self.times = None
+        self.n_done = 0 # The number of steps run so far
+        self.line_stats = None
+        self._lp = None
+        return
+
+    def __getstate__(self):
+        """ The line profiler can't be copied; copies don't profile """
+        state = self.__dict__.copy()
+        state['_lp'] = None
+        return state
+
+    def init_post(self):
+        """ Swap in the timed steps before the sim's loop collects them """
+        super().init_post()
+        for mod in self.sim.module_list:
+            if mod is self:
+                continue
+            names = ['step_state', 'step'] if isinstance(mod, ss.Disease) else ['step']
+            for name in names:
+                self.cols[(mod.name, name)] = len(self.funcs)
+                self.funcs.append((mod.name, name))
+            mod._timer = self.name
+            mod.step = step.__get__(mod)
+            if isinstance(mod, ss.Disease):
+                mod.step_state = step_state.__get__(mod)
+        self.times = np.zeros((self.t.npts, len(self.funcs)))
+
+        if self.line_profile:
+            from line_profiler import LineProfiler
+            self._lp = LineProfiler()
+            for func in self.hot_functions():
+                self._lp.add_function(func)
+            self._lp.enable_by_count()
+        return
+
+    def hot_functions(self):
+        """ The functions to line profile """
+        if self.line_profile is True:
+            funcs = []
+            for mod in self.sim.module_list:
+                if mod is self:
+                    continue
+                funcs.append(type(mod).step)
+                for name in ['compute_transmission', 'infect']:
+                    if isinstance(mod, (ss.Route, ss.Infection)) and hasattr(type(mod), name):
+                        funcs.append(getattr(type(mod), name))
+        else:
+            funcs = []
+            for func in sc.tolist(self.line_profile):
+                if isinstance(func, str):
+                    modname, attr = func.rsplit('.', 1)
+                    func = getattr(type(self.sim.module_dict[modname]), attr)
+                funcs.append(func)
+        return list({id(f): f for f in funcs}.values()) # Each function once
+
+    def add(self, module, func, elapsed):
+        """ Add the time of one call to the current step """
+        self.times[self.sim.ti, self.cols[(module, func)]] += elapsed
+        return
+
+    def step(self):
+        """ Nothing to time: that is done by the timed steps """
+        self.n_done = self.ti + 1
+        return
+
+    def finalize(self):
+        super().finalize()
+        if self._lp is not None:
+            self._lp.disable_by_count()
+            stream = io.StringIO()
+            self._lp.print_stats(stream=stream, output_unit=1e-3, stripzeros=True)
+            self.line_stats = stream.getvalue()
+        return
+
+    def to_df(self, by='func'):
+        """
+        Summarize the step times
+
+        Args:
+            by (str): 'func' for one row per module function, or 'module' for one row per module
+
+        Returns:
+            A dataframe of the total seconds, and the mean, median, 95th percentile and
+            max milliseconds per step, sorted by total
+        """
+        times = self.times[:self.n_done]
+        labels = pd.MultiIndex.from_tuples(self.funcs, names=['module', 'func'])
+        df = pd.DataFrame(times, columns=labels)
+        if by == 'module':
+            df = df.T.groupby(level='module').sum().T
+        elif by != 'func':
+            raise ValueError(f'by must be "func" or "module", not "{by}"')
+        out = pd.DataFrame(dict(
+            total_s = df.sum(),
+            mean_ms = df.mean()*1e3,
+            p50_ms = df.median()*1e3,
+            p95_ms = df.quantile(0.95)*1e3,
+            max_ms = df.max()*1e3,
+        ))
+        out['percent'] = out.total_s / out.total_s.sum() * 100
+        return out.sort_values('total_s', ascending=False).reset_index()
+
+    def report(self):
+        """ The per-module and per-function summaries, and the line profile if any, as text """
+        lines = ['Step time by module:', self.to_df(by='module').to_string(index=False), '',
+                 'Step time by function:', self.to_df().to_string(index=False)]
+        if self.line_stats:
+            lines += ['', 'Line profile:', self.line_stats]
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        """ Save the summary to a .csv file, or the full report (with any line profile) to a .txt file """
+        filename = sc.path(filename)
+        if filename.suffix == '.csv':
+            self.to_df().to_csv(filename, index=False)
+        elif filename.suffix == '.txt':
+            filename.write_text(self.report())
+        else:
+            raise ValueError(f'Can only save to .csv or .txt, not "{filename.suffix}"')
+        return filename
@@ -0,0 +1,105 @@
+"""
+Stochastic replicates run as blocks of one population
+"""
+import numpy as np
+import starsim as ss
+
+_ = None
+
+__all__ = ['replicates']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# REPLICATE AXIS
+#
+# build_sim in 05_demo returns a MultiSim of n_reps whole sims, each paying the
+# per-step Python overhead (module dispatch, lambdas, analyzer bookkeeping) on
+# its own People. Instead, stack the replicates as consecutive blocks of agents
+# in one sim: agent i of every block has the same age and location, so all
+# replicates share one population structure, and the transmission and analyzer
+# keys get the replicate as an extra leading dimension so that the blocks never
+# mix. Every step then does one pass over n_reps x n_agents for all replicates.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class replicates(ss.Connector):
+    """
+    Treat the population as n_reps equal blocks, one per stochastic replicate
+
+    On init, the states in `tile` are copied from the first block to the
+    others. Random draws in starsim are made per agent slot, so each block gets
+    its own, independent part of every random stream (e.g. its own initial
+    infections). Modules that support replicates (contact_matrix_mixing,
+    infections_by_stratum) take the name of this connector and keep the blocks
+    apart; ss.MixingPools and other networks don't, so use them with n_reps=1.
+
+    Sim-wide results such as sim.results.sir.n_infected are totals over all
+    the replicates. Agents added during the run (e.g. births) are in no replicate.
+
+    Args:
+        n_reps (int): the number of replicates; the number of agents must be a multiple of this
+        tile (list): the people states to copy from the first replicate to the others
+
+    **Example**:
+
+        ppl = ss.People(n_agents=n_agents*n_reps, age_data=age_data, extra_states=location)
+        reps = replicates(n_reps=n_reps)
+        cmm = contact_matrix_mixing(diseases='sir', beta=0.1, replicates='replicates')
+        sim = ss.Sim(people=ppl, connectors=reps, networks=cmm, diseases='sir')
+    """
+    def __init__(self, pars=None, n_reps=_, tile=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            n_reps = 1,
+            tile = ['age', 'location'],
+        )
+        self.update_pars(pars, **kwargs)
+        self.define_states(
+            ss.Arr('replicate', dtype=np.int16, nan=-1, default=-1),
+        )
+        self.n_per = None # Agents per replicate
+        return
+
+    @property
+    def n_reps(self):
+        return self.pars.n_reps
+
+    def init_post(self):
+        """ Assign the blocks, and give every replicate the first one's population """
+        super().init_post()
+        n_agents = len(self.sim.people.uid.raw)
+        if n_agents % self.n_reps:
+            errormsg = f'The number of agents ({n_agents}) must be a multiple of n_reps ({self.n_reps})'
+            raise ValueError(errormsg)
+        self.n_per = n_agents // self.n_reps
+        self.replicate.raw[:n_agents] = np.arange(n_agents) // self.n_per
+
+        ppl = self.sim.people
+        for name in self.pars.tile:
+            raw = ppl.states[name].raw
+            block = raw[:self.n_per]
+            raw[:n_agents] = np.tile(block, self.n_reps) if block.ndim == 1 else np.concatenate([block]*self.n_reps)
+        return
+
+    def step(self):
+        """ Nothing to do: the blocks are fixed """
+        return
+
+    def offset_keys(self, key, n_keys):
+        """
+        Give each replicate its own range of keys
+
+        Args:
+            key (array): a key per agent slot in 0..n_keys-1, or -1 for none
+            n_keys (int): the number of keys per replicate
+
+        Returns:
+            The key plus replicate*n_keys, or -1 where key is -1 or the agent is in no replicate
+        """
+        rep = self.replicate.raw[:len(key)]
+        return np.where((key >= 0) & (rep >= 0), rep.astype(np.int64)*n_keys + key, -1)
+
+    def count(self, uids):
+        """ The number of the given agents in each replicate """
+        rep = self.replicate.raw[uids]
+        return np.bincount(rep[rep >= 0], minlength=self.n_reps)
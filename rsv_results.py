@@ -0,0 +1,341 @@
+"""
+Chunked, zstandard-compressed columnar results files, written during a run
+"""
+import json
+import struct
+import numpy as np
+import pandas as pd
+import sciris as sc
+import zstandard as zstd
+
+__all__ = ['column_store', 'column_writer', 'read_results', 'chunk_index']
+
+MAGIC = b'RSVCOLS1'
+HEADER = struct.Struct('<I')   # Length of the JSON header
+CHUNK = struct.Struct('<II')   # Rows and compressed bytes of a chunk
+key_read_size = 4096           # Compressed bytes read at a time when chunk_index() looks for a key
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CHUNKED COLUMNAR FILES
+#
+# Analyzers that keep their whole history in memory grow with the horizon and
+# the number of replicates, and their results can only be seen once sim.run()
+# has finished. Instead, rows go into a fixed-size buffer per column, and each
+# time it fills, the columns are compressed together as one zstd frame and
+# appended to the file (or, for column_store, kept as an in-memory chunk).
+# The file is
+#
+#     MAGIC | header length | JSON header (columns, dtypes, meta) | chunk | chunk | ...
+#
+# where each chunk is (n_rows, n_bytes) followed by the compressed columns, one
+# after the other. Chunks are only ever appended whole, so a reader can open
+# the file at any point during the run and get every complete chunk.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class column_store:
+    """
+    Append rows to typed columns, kept in memory as a list of chunks
+
+    Rows go into a preallocated buffer per column, and each time it fills,
+    the buffers are flushed as one chunk, so appending never reallocates.
+    column_writer flushes to a compressed file instead.
+
+    Args:
+        columns (dict): the dtype of each column, e.g. dict(ti=np.int32, count=np.int64)
+        chunk_size (int): the number of rows per chunk
+    """
+    def __init__(self, columns, chunk_size=1000):
+        self.columns = {name: np.dtype(dtype) for name, dtype in columns.items()}
+        self.chunk_size = int(chunk_size)
+        self.buffers = {name: np.zeros(self.chunk_size, dtype=dtype) for name, dtype in self.columns.items()}
+        self.chunks = {name: [] for name in self.columns}
+        self.n_buffered = 0
+        self.n_written = 0 # Rows flushed so far
+        return
+
+    def __len__(self):
+        return self.n_written + self.n_buffered
+
+    def append(self, **cols):
+        """
+        Add rows: each column is a scalar or an array, broadcast to the same number of rows
+
+        Every column must be given.
+        """
+        n = max(np.size(v) for v in cols.values())
+        start = 0
+        while start < n:
+            k = min(n - start, self.chunk_size - self.n_buffered)
+            for name, buf in self.buffers.items():
+                val = cols[name]
+                buf[self.n_buffered:self.n_buffered+k] = val[start:start+k] if np.ndim(val) else val
+            self.n_buffered += k
+            start += k
+            if self.n_buffered == self.chunk_size:
+                self.flush()
+        return
+
+    def append_chunk(self, **cols):
+        """
+        Add rows as a chunk of their own, whatever the chunk size
+
+        Any buffered rows are flushed first, so e.g. each run of a sweep can be
+        exactly one chunk.
+        """
+        self.flush()
+        n = max(np.size(v) for v in cols.values())
+        if n:
+            self.write_chunk({name: np.broadcast_to(np.asarray(cols[name], dtype=dtype), (n,))
+                              for name, dtype in self.columns.items()})
+            self.n_written += n
+        return
+
+    def flush(self):
+        """ Move the buffered rows into a new chunk """
+        n = self.n_buffered
+        if n:
+            self.write_chunk({name: buf[:n] for name, buf in self.buffers.items()})
+            self.n_written += n
+            self.n_buffered = 0
+        return
+
+    def write_chunk(self, cols):
+        for name, col in cols.items():
+            self.chunks[name].append(col.copy())
+        return
+
+    def arrays(self):
+        """ Every row so far, as one array per column """
+        self.flush()
+        return {name: np.concatenate(parts) if parts else np.zeros(0, dtype=self.columns[name])
+                for name, parts in self.chunks.items()}
+
+
+class column_writer(column_store):
+    """
+    Append rows to a compressed columnar file, one chunk at a time
+
+    Memory use is one chunk of each column, whatever the number of rows
+    written. The file is created on the first write (not when the writer is
+    made), so a writer can be copied or pickled before then, e.g. in a sim
+    that is cloned for calibration trials.
+
+    Args:
+        filename (str/path): the file to write (any existing file is replaced)
+        columns (dict): the dtype of each column, e.g. dict(ti=np.int32, count=np.int64)
+        chunk_size (int): the number of rows per chunk
+        level (int): the zstd compression level
+        meta (dict): anything JSON-serializable to store in the header, e.g. the strata
+
+    **Example**:
+
+        with column_writer('out.rsvc', dict(ti=np.int32, n=np.int64)) as w:
+            for ti in range(100):
+                w.append(ti=ti, n=ti**2)
+        df = read_results('out.rsvc')
+    """
+    def __init__(self, filename, columns, chunk_size=1000, level=3, meta=None):
+        super().__init__(columns, chunk_size=chunk_size)
+        self.filename = sc.path(filename)
+        self.level = level
+        self.meta = meta or {}
+        self.chunks = None # Chunks go to the file
+        self.n_bytes = 0 # The length of the file so far
+        self._file = None
+        return
+
+    @classmethod
+    def reopen(cls, filename, level=3):
+        """
+        Carry on writing to an existing file, e.g. after the process writing it was killed
+
+        Any chunk that was only partly written is cut off the end of the file.
+        """
+        header, chunks = chunk_index(filename, header=True)
+        columns = {name: np.dtype(dtype) for name, dtype in header['columns']}
+        writer = cls(filename, columns, chunk_size=header['chunk_size'], level=level, meta=header['meta'])
+        writer.n_written = int(chunks.n_rows.sum())
+        writer.n_bytes = header['end'] if len(chunks) == 0 else int(chunks.offset.iloc[-1] + CHUNK.size + chunks.n_bytes.iloc[-1])
+        with open(filename, 'r+b') as f:
+            f.truncate(writer.n_bytes)
+        if writer.n_written == 0: # Nothing to keep, so flush() writes the header again
+            writer.n_bytes = 0
+        return writer
+
+    def __getstate__(self):
+        """ The open file can't be copied """
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+    def open(self):
+        """ Create the file and write the header """
+        header = json.dumps(dict(columns=[[name, dtype.str] for name, dtype in self.columns.items()],
+                                 chunk_size=self.chunk_size, meta=self.meta)).encode()
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.filename, 'wb')
+        self._file.write(MAGIC + HEADER.pack(len(header)) + header)
+        self._file.flush()
+        self.n_bytes = self._file.tell()
+        return
+
+    def flush(self):
+        """ Compress the buffered rows as one chunk and append it to the file """
+        if self._file is None:
+            if self.n_written: # Reopened after a copy, so add to what's there
+                self._file = open(self.filename, 'ab')
+            else:
+                self.open()
+        return super().flush()
+
+    def write_chunk(self, cols):
+        n = len(next(iter(cols.values())))
+        raw = b''.join(np.ascontiguousarray(col).tobytes() for col in cols.values())
+        data = zstd.ZstdCompressor(level=self.level).compress(raw)
+        self._file.write(CHUNK.pack(n, len(data)) + data) # One write, so readers see whole chunks
+        self._file.flush()
+        self.n_bytes += CHUNK.size + len(data)
+        return
+
+    def fork(self, filename):
+        """
+        Carry on writing to a new file, starting with a copy of what this writer had written
+
+        For a copy of a sim part way through its run (e.g. a branch of a
+        sim_snapshot checkpoint): only the rows this copy knows about are
+        copied, even if the original has written more since.
+        """
+        filename = sc.path(filename)
+        if self.n_written:
+            with open(self.filename, 'rb') as src:
+                data = src.read(self.n_bytes)
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            filename.write_bytes(data)
+        if self._file is not None:
+            self._file.close()
+        self.filename = filename
+        self._file = None # Reopened for appending on the next flush
+        return
+
+    def arrays(self):
+        """ Every row so far, read back from the file """
+        self.flush()
+        df = read_results(self.filename)
+        return {name: df[name].values for name in df.columns}
+
+    def close(self):
+        """ Write any buffered rows and close the file """
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
+
+
+def _read_header(f):
+    """ Read the header of an open results file, leaving the file at the first chunk """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'{f.name} is not a results file written by column_writer')
+    n_header, = HEADER.unpack(f.read(HEADER.size))
+    header = json.loads(f.read(n_header))
+    header['end'] = f.tell()
+    return header
+
+
+def chunk_index(filename, key=None, header=False):
+    """
+    Find the complete chunks of a results file, without reading their data
+
+    Args:
+        filename (str/path): the file
+        key (str): if given, also the first value of this column in each chunk,
+            e.g. the run of each chunk of a sweep (only the start of each chunk
+            is read and decompressed, a few KB at a time, so put the key column first)
+        header (bool): also return the header
+
+    Returns:
+        A dataframe with the offset, n_rows and n_bytes of each chunk (and the
+        key), or (header, dataframe) if header is True
+    """
+    rows = []
+    dctx = zstd.ZstdDecompressor()
+    with open(filename, 'rb') as f:
+        head = _read_header(f)
+        dtypes = {name: np.dtype(dtype) for name, dtype in head['columns']}
+        size = f.seek(0, 2)
+        pos = head['end']
+        while pos + CHUNK.size <= size:
+            f.seek(pos)
+            n_rows, n_bytes = CHUNK.unpack(f.read(CHUNK.size))
+            if pos + CHUNK.size + n_bytes > size: # A chunk still being written
+                break
+            row = dict(offset=pos, n_rows=n_rows, n_bytes=n_bytes)
+            if key is not None:
+                start = 0
+                for name, dtype in dtypes.items():
+                    if name == key:
+                        break
+                    start += n_rows * dtype.itemsize
+                want = start + dtypes[key].itemsize
+                raw = bytearray()
+                with dctx.stream_reader(f, read_size=key_read_size, closefd=False) as reader: # Reads from f only as far as it needs to
+                    while len(raw) < want:
+                        more = reader.read(want - len(raw))
+                        if not more:
+                            break
+                        raw += more
+                row[key] = np.frombuffer(raw, dtype=dtypes[key], count=1, offset=start)[0]
+            rows.append(row)
+            pos += CHUNK.size + n_bytes
+    df = pd.DataFrame(rows, columns=['offset', 'n_rows', 'n_bytes'] + ([key] if key is not None else []))
+    return (head, df) if header else df
+
+
+def read_results(filename, columns=None, meta=False, chunks=None):
+    """
+    Read a file written by column_writer, e.g. while the run is still going
+
+    Only whole chunks are read, so during a run this returns everything up to
+    the most recent flush.
+
+    Args:
+        filename (str/path): the file
+        columns (list): the columns to return (default: all)
+        meta (bool): also return the meta dict from the header
+        chunks (dataframe): if given, only read these chunks, as returned by chunk_index()
+
+    Returns:
+        A dataframe, or (dataframe, meta) if meta is True
+    """
+    if chunks is None:
+        header, chunks = chunk_index(filename, header=True)
+    else:
+        with open(filename, 'rb') as f:
+            header = _read_header(f)
+    dtypes = {name: np.dtype(dtype) for name, dtype in header['columns']}
+    names = columns if columns is not None else list(dtypes)
+
+    parts = {name: [] for name in names}
+    dctx = zstd.ZstdDecompressor()
+    with open(filename, 'rb') as f:
+        for offset, n_rows, n_bytes in zip(chunks.offset, chunks.n_rows, chunks.n_bytes):
+            f.seek(offset + CHUNK.size)
+            raw = dctx.decompress(f.read(n_bytes), max_output_size=n_rows*sum(d.itemsize for d in dtypes.values()))
+            start = 0
+            for name, dtype in dtypes.items():
+                if name in parts:
+                    parts[name].append(np.frombuffer(raw, dtype=dtype, count=n_rows, offset=start))
+                start += n_rows * dtype.itemsize
+
+    df = pd.DataFrame({name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dtypes[name])
+                       for name in names})
+    return (df, header['meta']) if meta else df
@@ -0,0 +1,269 @@
+"""
+Time-of-day activity schedules and Markov location transitions, so location can change during the run
+"""
+import numpy as np
+import sciris as sc
+import starsim as ss
+from rsv_states import age_choice
+from rsv_groups import group_index
+
+_ = None
+
+__all__ = ['activity_schedule', 'location_markov']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# ACTIVITY SCHEDULE
+#
+# Each agent gets a time-activity pattern (e.g. "home all day" or
+# "home -> school -> school -> home"), and the location of every agent at each
+# sub-step of the day is looked up from a small (n_patterns x n_substeps)
+# table with one gather. With a daily timestep, contact_matrix_mixing runs the
+# sub-steps itself inside the transmission step (see its schedule argument).
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class activity_schedule(ss.Connector):
+    """
+    Move every agent between locations over the sub-steps of a day
+
+    Args:
+        patterns (array): (n_patterns x n_substeps) table of location codes
+        durations (array): fraction of the day spent in each sub-step (default: equal)
+        pattern_probs (array): (n_age_bands x n_patterns) probability of each pattern by age band
+        age_bins (array): age band edges for pattern_probs
+        state (str): the name of the people state holding the location
+        sim_substeps (bool): if True, the sim timestep is itself one sub-step, and the
+            schedule advances one sub-step per sim step; otherwise, a transmission route
+            (e.g. contact_matrix_mixing) runs the sub-steps within each step
+
+    The default has 4 sub-steps (night, morning, afternoon, evening), locations
+    0 - household, 1 - school, 2 - community, and the NewDirections.md age groups.
+    Any group_index on the same state is told which agents each sub-step moved.
+    """
+    def __init__(self, pars=None, patterns=_, durations=_, pattern_probs=_, age_bins=_,
+                 state=_, sim_substeps=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            patterns = [[0, 0, 0, 0],  # home all day
+                        [0, 1, 1, 0],  # school
+                        [0, 2, 2, 0],  # community (work)
+                        [0, 1, 2, 0]], # school then community
+            durations = None,
+            pattern_probs = [[.80, .00, .20, .00],  # <5
+                             [.05, .60, .05, .30],  # 5-18
+                             [.20, .00, .80, .00],  # 19-64
+                             [.60, .00, .40, .00]], # 65+
+            age_bins = [0, 5, 19, 65, 100],
+            state = 'location',
+            sim_substeps = False,
+        )
+        self.update_pars(pars, **kwargs)
+        p = self.pars
+        p.patterns = np.asarray(p.patterns)
+        self.n_patterns, self.n_sub = p.patterns.shape
+        if p.durations is None:
+            p.durations = np.full(self.n_sub, 1/self.n_sub)
+        p.durations = np.asarray(p.durations, dtype=float)
+        if len(p.durations) != self.n_sub or not np.isclose(p.durations.sum(), 1):
+            raise ValueError(f'durations must have one entry per sub-step ({self.n_sub}) and sum to 1, not {p.durations}')
+
+        self.define_states(
+            ss.IntArr('pattern', default=age_choice(p=p.pattern_probs, age_bins=p.age_bins), label='Time-activity pattern'),
+        )
+        self.columns = None # The patterns table by sub-step, as contiguous columns
+        self.sub = 0 # The current sub-step
+        self.grp_index = [] # The names of the group_index connectors to keep in sync
+        return
+
+    def init_post(self):
+        super().init_post()
+        self.grp_index = [name for name, conn in self.sim.connectors.items()
+                          if isinstance(conn, group_index) and conn.state == self.pars.state]
+        loc = getattr(self.sim.people, self.pars.state)
+        self.columns = np.ascontiguousarray(self.pars.patterns.T, dtype=loc.dtype)
+        self.apply(0)
+        return
+
+    def apply(self, sub):
+        """ Set the location of every agent to where their pattern puts them at this sub-step """
+        n = self.sim.people.n_uids
+        loc = getattr(self.sim.people, self.pars.state)
+        if self.grp_index:
+            old = loc.raw[:n].copy()
+        np.take(self.columns[sub], self.pattern.raw[:n], out=loc.raw[:n])
+        if self.grp_index:
+            moved = np.nonzero(loc.raw[:n] != old)[0]
+            for name in self.grp_index:
+                self.sim.connectors[name].moved(moved)
+        self.sub = sub
+        return
+
+    def step(self):
+        if self.pars.sim_substeps:
+            self.apply(self.ti % self.n_sub)
+        return
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# MARKOV LOCATION TRANSITIONS
+#
+# From the 12.15 notes, location should be updated at every timestep, not
+# assigned once after sim.init(). Each step, every agent moves from their
+# location to the next with the probabilities of one row of their age band's
+# transition matrix: one uniform draw per agent, and the new location is the
+# number of cumulative probabilities of their row that the draw passes. With a
+# handful of locations that is a few gathers and compares over the population,
+# done a column of the cumulative table at a time, so there is no
+# (n_agents x n_locations) temporary. Only the agents who moved are then passed
+# on to the group indices that depend on location.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class location_markov(ss.Connector):
+    """
+    Move every agent between locations each step, with an age-band-specific Markov chain
+
+    transitions[b, i, k] is the probability that an agent in age band b at
+    location i is at location k after one step. If transitions is not given,
+    it is made from probs and stay: each step, an agent stays put with
+    probability stay, and otherwise is at each location with the probability
+    for their age band in probs (so probs is also the long-run distribution).
+
+    Agents whose location isn't one of the codes are left where they are.
+    Name any group_index that depends on the location in grp_index, and the
+    agents who moved are moved in their indices straight away (a group_index
+    only re-keys the agents it is told about, unless it has rescan=True).
+
+    Args:
+        transitions (array): (n_age_bands x n_locations x n_locations) transition probabilities per step,
+            or one (n_locations x n_locations) matrix for all ages; each row must sum to 1
+        probs (array): (n_age_bands x n_locations) probability of each location, if transitions is None
+        stay (float): the probability of not moving each step, if transitions is None
+        age_bins (array): age band edges; ages outside them are put into the first/last band
+        codes (array): the value of the location state for each location (default 0, 1, 2, ...)
+        state (str): the name of the people state holding the location
+        grp_index (str/list): the names of group_index connectors to keep in sync
+        bands (str): if given, the name of an age_bands connector with the same age_bins, to use
+            its cached bands rather than binning the ages each step
+
+    **Example**:
+
+        markov = location_markov(probs=[[.33, .33, .34], [.20, .10, .70]], stay=0.9, age_bins=[0, 19, 100])
+        gi = group_index(age_bins=[0, 20, 100], locations=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'])
+        sim = ss.Sim(connectors=[markov, gi], ...)
+    """
+    def __init__(self, pars=None, transitions=_, probs=_, stay=_, age_bins=_, codes=_, state=_, grp_index=_,
+                 bands=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            transitions = None,
+            probs = [[.33, .33, .34],  # age < 19
+                     [.20, .10, .70]], # age 19+
+            stay = 0.9,
+            age_bins = [0, 19, 100],
+            codes = None,
+            state = 'location',
+            grp_index = None,
+            bands = None,
+        )
+        self.update_pars(pars, **kwargs)
+        self.validate_pars()
+        self.draw = ss.random() # One uniform draw per agent per step
+        self.n_moved = 0 # Agents who moved on the last step
+        return
+
+    def validate_pars(self):
+        """ Make the transition matrices if needed, check them, and tabulate their cumulative probabilities """
+        p = self.pars
+        edges = np.asarray(p.age_bins, dtype=float)
+        n_bands = len(edges) - 1
+        if p.transitions is None:
+            probs = np.atleast_2d(np.asarray(p.probs, dtype=float))
+            n_locs = probs.shape[1]
+            T = p.stay*np.eye(n_locs)[None, :, :] + (1 - p.stay)*probs[:, None, :]
+        else:
+            T = np.asarray(p.transitions, dtype=float)
+            if T.ndim == 2:
+                T = np.broadcast_to(T, (n_bands,) + T.shape)
+        n_locs = T.shape[-1]
+        if T.shape != (n_bands, n_locs, n_locs):
+            errormsg = f'The transitions must have shape (n_age_bands, n_locations, n_locations) = {(n_bands, n_locs, n_locs)}, not {T.shape}'
+            raise ValueError(errormsg)
+        if not np.allclose(T.sum(axis=2), 1) or (T < 0).any():
+            raise ValueError(f'Each row of the transition matrices must be probabilities that sum to 1, not {T.sum(axis=2)}')
+        p.transitions = T
+        p.codes = np.arange(n_locs) if p.codes is None else np.asarray(p.codes)
+        p.grp_index = sc.tolist(p.grp_index)
+        self.n_locs = n_locs
+        self.edges = edges
+
+        # For one-byte location states (e.g. a categorical), the index of every possible byte
+        self.lut = np.full(256, -1, dtype=np.int16)
+        if np.all((p.codes >= -128) & (p.codes < 256) & (p.codes == np.round(p.codes))):
+            self.lut[p.codes.astype(np.int64) % 256] = np.arange(n_locs)
+
+        # Cumulative probabilities by (band x location) row, one contiguous column per location
+        # boundary; the extra last row is for agents at no known location, who never pass any
+        cum = np.cumsum(T, axis=2)[:, :, :-1].reshape(n_bands*n_locs, n_locs-1)
+        self.cum_cols = np.ascontiguousarray(np.vstack([cum, np.full((1, n_locs-1), np.inf)]).T)
+        return
+
+    def init_post(self):
+        super().init_post()
+        if self.pars.bands is not None and not np.array_equal(self.sim.connectors[self.pars.bands].edges, self.edges):
+            raise ValueError(f'The age bins of {self.pars.bands} must be the same as those of {self.name}, {self.edges}')
+        return
+
+    def location_index(self, loc):
+        """ The index of each location code, or -1 if it isn't one """
+        if loc.dtype.itemsize == 1: # One lookup per agent
+            return self.lut[loc.view(np.uint8)]
+        codes = self.pars.codes
+        li = np.searchsorted(codes, loc)
+        li[li >= len(codes)] = 0
+        return np.where(codes[li] == loc, li, -1)
+
+    def age_band(self, inds):
+        """ The age band of each agent, with ages outside the bins in the first/last band """
+        if self.pars.bands is not None:
+            band = self.sim.connectors[self.pars.bands].band.raw[inds].astype(np.int16)
+            outside = np.nonzero(band > len(self.edges)-2)[0] # Outside the bins (255): first or last band, by age
+            if len(outside):
+                age = self.sim.people.age.raw[inds][outside]
+                band[outside] = np.where(age < self.edges[0], 0, len(self.edges)-2)
+            return band
+        age = self.sim.people.age.raw[inds]
+        band = np.zeros(len(age), dtype=np.int16)
+        for edge in self.edges[1:-1]: # Only a few bands, so comparisons are faster than a search
+            band += age >= edge
+        return band
+
+    def step(self):
+        """ Draw everyone's next location, and move those who changed in the group indices """
+        p = self.pars
+        ppl = self.sim.people
+        uids = ppl.auids
+        inds = slice(0, len(uids)) if len(uids) and uids[-1] == len(uids)-1 else uids # No one has died: use views, not copies
+        loc = ppl.states[p.state]
+        li = self.location_index(loc.raw[inds])
+        row = np.where(li >= 0, self.age_band(inds)*self.n_locs + li, len(self.cum_cols[0])-1)
+
+        u = self.draw.rvs(uids)
+        new = np.zeros(len(uids), dtype=np.int8)
+        for col in self.cum_cols:
+            new += u >= np.take(col, row)
+
+        moved = np.nonzero((new != li) & (li >= 0))[0]
+        self.n_moved = len(moved)
+        if len(moved):
+            moved_uids = uids[moved]
+            loc.raw[moved_uids] = p.codes[new[moved]]
+            for name in p.grp_index:
+                self.sync(self.sim.connectors[name], moved_uids)
+        return
+
+    def sync(self, gi, uids):
+        """ Move these agents to their new groups in a group_index, without recomputing everyone's key """
+        gi.moved(uids)
+        return
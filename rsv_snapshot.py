@@ -0,0 +1,327 @@
+"""
+Build-once sim snapshots, so calibration trials start from a cheap clone, and
+burn-in checkpoints to branch scenarios from
+"""
+import io
+import os
+import gc
+import pickle
+import math
+import mmap
+import json
+import struct
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import sciris as sc
+import starsim as ss
+import dill
+from rsv_results import column_writer
+
+__all__ = ['sim_snapshot', 'reseed', 'run_branches']
+
+magic = b'RSVSNAP1'
+align = 64
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# SIM SNAPSHOT
+#
+# Every trial in 05_demo starts from a deep copy of the base sim (and before
+# that, make_sim() re-read age.csv and rebuilt the people). Instead, build and
+# initialize the sim once, and write it to one file: the object structure is
+# pickled with dill (which handles the group lambdas), except that every array
+# the size of the population is written out raw. A clone maps the file
+# copy-on-write and unpickles the structure with those arrays as views of the
+# map, so nothing is copied until a trial writes to it.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+def reseed(sim, seed):
+    """
+    Give an already-initialized sim new random number streams
+
+    Setting sim.pars.rand_seed after sim.init() has no effect, since every
+    distribution has already made its generator; this remakes them from the
+    new seed, in the same way as sim.init() would. Part way through a run,
+    the remaining steps then draw from the new streams.
+    """
+    sim.pars.rand_seed = seed
+    if not ss.options.single_rng:
+        for dist in sim.dists.dists.values():
+            dist.seed = dist.offset + seed
+            dist.rng = np.random.default_rng(seed=dist.seed)
+            dist.make_history(reset=True)
+    return sim
+
+
+class _Pickler(dill.Pickler):
+    """ Pickle everything except large numeric arrays, which are collected in self.arrays """
+    def __init__(self, file, min_size):
+        super().__init__(file, protocol=5)
+        self.min_size = min_size
+        self.arrays = []
+        self.index = {}
+        return
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray) and obj.size >= self.min_size and obj.dtype.kind in 'biuf':
+            key = id(obj)
+            if key not in self.index:
+                self.index[key] = len(self.arrays)
+                self.arrays.append(obj)
+            cls = np.ndarray if isinstance(obj, np.memmap) else type(obj)
+            return (self.index[key], cls)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    """ Unpickle, with the large arrays as views of the mapped file (dill's objects only need dill imported) """
+    def __init__(self, file, load_array):
+        super().__init__(file)
+        self.load_array = load_array
+        self.cache = {}
+        return
+
+    def persistent_load(self, pid):
+        i, cls = pid
+        if i not in self.cache:
+            self.cache[i] = self.load_array(i).view(cls)
+        return self.cache[i]
+
+
+class sim_snapshot:
+    """
+    A built (and usually initialized) sim saved to a file, to make cheap clones from
+
+    The arrays of a clone are copy-on-write views of the file: they read from
+    the (shared) page cache, and only the pages a trial changes are copied.
+
+    Args:
+        filename (str): the snapshot file, as written by sim_snapshot.save()
+
+    **Example**:
+
+        sim = make_sim() # Build and init once
+        snap = sim_snapshot.save(sim, 'base.snap')
+        ...
+        sim = snap.clone() # In each trial, instead of make_sim() or sc.dcp(sim)
+        sim.run()
+
+        # Or run the burn-in once, and branch scenarios from where it stopped
+        snap = sim_snapshot.checkpoint(make_sim(), until=2005, filename='burnin.snap')
+        sim = snap.branch(label='school_closure', build_fn=close_schools)
+        sim.run() # From 2005 to the end
+    """
+    def __init__(self, filename):
+        self.filename = sc.path(filename)
+        with open(self.filename, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f'{self.filename} is not a sim snapshot')
+            n_header = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(n_header))
+            f.seek(self.header['data_start'] + self.header['pickle_offset'])
+            self.skeleton = f.read(self.header['pickle_len']) # The pickled structure is small, so keep it
+        self.n_arrays = len(self.header['arrays'])
+        return
+
+    def __repr__(self):
+        return f'<sim_snapshot "{self.filename}", {self.n_arrays} arrays, {self.nbytes/1e6:.1f} MB>'
+
+    @property
+    def nbytes(self):
+        return self.filename.stat().st_size
+
+    @classmethod
+    def save(cls, sim, filename, min_size=None):
+        """
+        Write a sim to a snapshot file, and return the snapshot
+
+        Args:
+            sim (ss.Sim): the sim, e.g. after sim.init()
+            filename (str): where to write it
+            min_size (int): arrays at least this big are stored raw (default: the number of agents)
+        """
+        if min_size is None:
+            min_size = max(len(sim.people.uid.raw) if sim.initialized else int(sim.pars.n_agents), 1)
+
+        # Pickle the structure, collecting the big arrays
+        buf = io.BytesIO()
+        pickler = _Pickler(buf, min_size)
+        pickler.dump(sim)
+        skeleton = buf.getvalue()
+
+        # Lay out the arrays, then the pickle
+        arrays = []
+        offset = 0
+        for arr in pickler.arrays:
+            arrays.append(dict(offset=offset, dtype=arr.dtype.str, shape=arr.shape))
+            offset += -(-arr.nbytes // align) * align
+        header = dict(arrays=arrays, pickle_offset=offset, pickle_len=len(skeleton), data_start=0,
+                      ti=int(sim.ti) if sim.initialized else 0)
+        n_header = len(json.dumps(header)) + 32 # Room for the data_start digits
+        header['data_start'] = -(-(len(magic) + 8 + n_header) // align) * align
+        header_bytes = json.dumps(header).encode().ljust(n_header)
+
+        filename = sc.path(filename)
+        with open(filename, 'wb') as f:
+            f.write(magic)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for arr, info in zip(pickler.arrays, arrays):
+                f.seek(header['data_start'] + info['offset'])
+                np.ascontiguousarray(arr).tofile(f)
+            f.seek(header['data_start'] + offset)
+            f.write(skeleton)
+        return cls(filename)
+
+    @classmethod
+    def checkpoint(cls, sim, until, filename, min_size=None):
+        """
+        Run a sim up to a point (e.g. the end of its burn-in), and save it there
+
+        Everything is saved as it stands part way through the run: the agents'
+        states, the position of every random number stream and the analyzers'
+        buffers, so a clone continues exactly as the sim would have (until it
+        is changed, e.g. by branch()).
+
+        Args:
+            sim (ss.Sim): the sim; initialized first if it isn't already
+            until (float/ss.date): the time to run to, as for sim.run(until=...)
+            filename (str): where to write the checkpoint
+            min_size (int): as for save()
+        """
+        if not sim.initialized:
+            sim.init()
+        sim.run(until=until)
+        return cls.save(sim, filename, min_size=min_size)
+
+    @property
+    def ti(self):
+        """ The time index the sims cloned from this snapshot start on """
+        return self.header.get('ti', 0)
+
+    def clone(self):
+        """ Make a new sim from the snapshot, with copy-on-write arrays """
+        with open(self.filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) # Private: writes are not seen by the file or other clones
+        start = self.header['data_start']
+
+        def load_array(i):
+            info = self.header['arrays'][i]
+            shape = tuple(info['shape'])
+            arr = np.frombuffer(mm, dtype=info['dtype'], count=math.prod(shape), offset=start + info['offset'])
+            return arr.reshape(shape)
+
+        gc_on = gc.isenabled()
+        gc.disable() # Unpickling makes many small objects, so skip the collections it would trigger
+        try:
+            sim = _Unpickler(io.BytesIO(self.skeleton), load_array).load()
+        finally:
+            if gc_on:
+                gc.enable()
+        return sim
+
+    def branch(self, label=None, rand_seed=None, build_fn=None, **kwargs):
+        """
+        Clone a sim to run one scenario on from this snapshot
+
+        Any analyzer writing to a file (e.g. streamed_infections) carries on in
+        a file of its own for this branch, named with the label, starting with
+        the rows written before the checkpoint.
+
+        Args:
+            label (str): the label of the branch's sim; needed if an analyzer writes to a file
+            rand_seed (int): if given, the rest of the run draws from the streams of this seed
+            build_fn (func): if given, called as build_fn(sim, **kwargs) to change the sim, e.g. its parameters
+            kwargs (dict): passed to build_fn
+        """
+        sim = self.clone()
+        if label is not None:
+            sim.label = label
+        if rand_seed is not None:
+            reseed(sim, rand_seed)
+        for writer in _writers(sim):
+            if label is None:
+                raise ValueError(f'Please give the branch a label, so that it writes its own copy of {writer.filename}')
+            writer.fork(writer.filename.with_name(f'{writer.filename.stem}_{label}{writer.filename.suffix}'))
+        if build_fn is not None:
+            sim = build_fn(sim, **kwargs)
+        return sim
+
+
+def _writers(sim):
+    """ The column_writers of a sim's analyzers """
+    return [val for mod in sim.analyzers.values() for val in vars(mod).values() if isinstance(val, column_writer)]
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# BRANCHES IN WORKER PROCESSES
+#
+# Each worker maps the checkpoint once and clones a sim per branch, so the
+# burn-in is paid for once, and only the branch's parameters and its result go
+# between processes.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+_worker_branch = None # (snapshot, build_fn, eval_fn), in each worker process
+
+
+def _init_worker(snapshot, build_fn, eval_fn):
+    global _worker_branch
+    _worker_branch = (snapshot, build_fn, eval_fn)
+    return
+
+
+def _run_branch(label, pars):
+    """ Run one branch in a worker, and return its result """
+    snapshot, build_fn, eval_fn = _worker_branch
+    return _branch_result(snapshot, label, pars, build_fn, eval_fn)
+
+
+def _branch_result(snapshot, label, pars, build_fn, eval_fn):
+    pars = dict(pars)
+    rand_seed = pars.pop('rand_seed', None)
+    sim = snapshot.branch(label=label, rand_seed=rand_seed, build_fn=build_fn, **pars)
+    sim.run()
+    return eval_fn(sim)
+
+
+def run_branches(snapshot, branches, build_fn=None, eval_fn=None, n_workers=None):
+    """
+    Run scenarios from a checkpoint, across a process pool
+
+    Args:
+        snapshot (sim_snapshot/str): the checkpoint (or its filename)
+        branches (dict): the keyword arguments of each branch's build_fn, by label; a
+            'rand_seed' in them reseeds the branch instead (see sim_snapshot.branch())
+        build_fn (func): called as build_fn(sim, **pars) to set up each branch
+        eval_fn (func): called as eval_fn(sim) at the end of each branch; its result is returned (default: sim.to_df())
+        n_workers (int): the number of processes (default: one per CPU); 1 runs them in this process
+
+    Returns:
+        A dict of the result of each branch, by label
+
+    **Example**:
+
+        def build(sim, beta):
+            sim.networks.contact_matrix_mixing.pars.beta = beta
+            return sim
+
+        snap = sim_snapshot.checkpoint(make_sim(), until=2005, filename='burnin.snap')
+        out = run_branches(snap, {f'beta_{b}': dict(beta=b) for b in [0.05, 0.1, 0.2]}, build_fn=build)
+    """
+    if not isinstance(snapshot, sim_snapshot):
+        snapshot = sim_snapshot(snapshot)
+    if eval_fn is None:
+        eval_fn = lambda sim: sim.to_df()
+    n_workers = min(n_workers or os.cpu_count() or 1, len(branches))
+    if n_workers <= 1:
+        return {label: _branch_result(snapshot, label, pars, build_fn, eval_fn) for label, pars in branches.items()}
+
+    methods = mp.get_all_start_methods()
+    ctx = mp.get_context('fork' if 'fork' in methods else None) # Fork, so the build and eval functions don't need to be importable
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(snapshot, build_fn, eval_fn)) as pool:
+        futures = {label: pool.submit(_run_branch, label, pars) for label, pars in branches.items()}
+        return {label: future.result() for label, future in futures.items()}
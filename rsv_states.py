@@ -0,0 +1,310 @@
+"""
+Reusable agent states and state initializers for the RSV demos
+"""
+import numpy as np
+import starsim as ss
+
+_ = None
+
+__all__ = ['age_choice', 'categorical', 'age_bands', 'dose_window']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# AGE-CONDITIONAL CATEGORICAL DRAWS
+#
+# Replaces the per-agent random.choices() loop that used to run after sim.init().
+# Used as the default of a state, the whole population is filled in a single
+# vectorized pass during sim.init(), and the draws come from the sim's own
+# seeded random number streams, so calibration trials are reproducible.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class age_choice(ss.Dist):
+    """
+    Choose a category for each agent, with probabilities that depend on age
+
+    Args:
+        a (array): the categories to choose from (e.g. location codes)
+        p (array): probability table of shape (n_age_bands, len(a)); each row must sum to 1
+        age_bins (array): age band edges, e.g. (0, 19, 100); ages outside the
+            edges are put into the first/last band
+
+    **Example**:
+
+        location = ss.FloatArr('location', default=age_choice(
+            a = [0, 1, 2],
+            p = [[.33, .33, .33],  # age 0-19
+                 [.20, .10, .70]], # age 19+
+            age_bins = (0, 19, 100),
+        ))
+    """
+    valid_pars = ['a', 'p', 'age_bins']
+    scaling = ss.distributions.scale_types.false
+
+    def __init__(self, a=None, p=None, age_bins=None, **kwargs):
+        p = np.atleast_2d(np.asarray(p, dtype=float))
+        a = np.arange(p.shape[1]) if a is None else np.asarray(a)
+        age_bins = np.asarray(age_bins, dtype=float)
+        if p.shape != (len(age_bins)-1, len(a)):
+            errormsg = f'The probability table must have one row per age band and one column per choice, but {p.shape} != {(len(age_bins)-1, len(a))}'
+            raise ValueError(errormsg)
+        if not np.allclose(p.sum(axis=1), 1):
+            raise ValueError(f'Each row of the probability table must sum to 1, not {p.sum(axis=1)}')
+        super().__init__(distname='age_choice', a=a, p=p, age_bins=age_bins, **kwargs)
+        return
+
+    def make_rvs(self):
+        errormsg = 'age_choice() needs UIDs to look up ages, not a size; use e.g. dist.rvs(sim.people.auids)'
+        raise ValueError(errormsg)
+
+    def ppf(self, rands):
+        """ Map uniform draws to categories using the cumulative probabilities of each agent's age band """
+        pars = self._pars
+        age = self.sim.people.age.raw[self._uids]
+        band = np.searchsorted(pars.age_bins[1:-1], age, side='right') # Interior edges only, so out-of-range ages are clipped
+        pcum = np.cumsum(pars.p, axis=1)
+        pcum[:, -1] = 1.0 # Guard against rounding in the last column
+        inds = (rands[:, None] >= pcum[band]).sum(axis=1)
+        return pars.a[inds]
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# COMPACT CATEGORICAL STATES
+#
+# location only ever holds a handful of codes, but as an ss.FloatArr it takes
+# 4 bytes per agent (8 as float64), and every mask (location == 1) reads them
+# all. Stored as int8 (or uint8) it takes 1, so at 1e7 agents each such state
+# is 30-70 MB smaller and every comparison reads a quarter of the memory or
+# less. Unlike a BoolState (e.g. urban), it also doesn't add a result that is
+# counted every step. Naming the levels
+# also lets the selectors say what they mean, e.g. location == 'SCHOOL'.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class categorical(ss.Arr):
+    """
+    A state holding one of a few named levels, stored as one byte per agent
+
+    Comparisons with a level name are made against its code, so selectors can
+    compare directly, e.g. (sim.people.location == 'SCHOOL').uids. Comparisons
+    with numbers (location == 1) work as for a FloatArr. The NaN value is -1
+    for int8, or 255 for uint8.
+
+    Args:
+        name (str): the name of the state
+        levels (list): the names of the levels, e.g. ['HOUSEHOLD', 'SCHOOL', 'COMMUNITY']
+        codes (array): the code stored for each level (default 0, 1, 2, ...)
+        default: as for ss.Arr (e.g. an age_choice() of the codes), or the name of a level
+        dtype (dtype): np.int8 or np.uint8
+
+    **Example**:
+
+        location = categorical('location', levels=['HOUSEHOLD', 'SCHOOL', 'COMMUNITY'], default=age_choice(
+            a = [0, 1, 2],
+            p = [[.33, .33, .34], [.20, .10, .70]],
+            age_bins = (0, 19, 100),
+        ))
+        ppl = ss.People(n_agents=n_agents, age_data=age_data, extra_states=location)
+        in_school = lambda sim: ((sim.people.age < 20) & (sim.people.location == 'SCHOOL')).uids
+    """
+    def __init__(self, name=None, levels=None, codes=None, default=None, dtype=np.int8, **kwargs):
+        dtype = np.dtype(dtype)
+        if dtype not in (np.int8, np.uint8):
+            raise ValueError(f'The dtype must be int8 or uint8, not {dtype}')
+        self.levels = list(levels)
+        self.codes = np.arange(len(self.levels)) if codes is None else np.asarray(codes)
+        if len(self.codes) != len(self.levels):
+            raise ValueError(f'There must be one code per level, not {len(self.codes)} codes for {len(self.levels)} levels')
+        nan = -1 if dtype == np.int8 else 255
+        info = np.iinfo(dtype)
+        if self.codes.min() < info.min or self.codes.max() > info.max or nan in self.codes:
+            raise ValueError(f'The codes must fit in {dtype} and can\'t be the NaN value {nan}, not {self.codes}')
+        self.code_of = {level: dtype.type(code) for level, code in zip(self.levels, self.codes)}
+        if isinstance(default, str):
+            default = self.code(default)
+        super().__init__(name=name, dtype=dtype, nan=dtype.type(nan), default=default, **kwargs)
+        return
+
+    def code(self, level):
+        """ The code of a level, by name """
+        try:
+            return self.code_of[level]
+        except KeyError:
+            raise ValueError(f'"{level}" is not one of the levels of {self.name}: {self.levels}') from None
+
+    def _boolmath(self, op, other=None):
+        if isinstance(other, str):
+            other = self.code(other)
+        return super()._boolmath(op, other)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, str):
+            value = self.code(value)
+        return super().__setitem__(key, value)
+
+    def isin(self, levels):
+        """ Whether each agent is in any of these levels (names or codes), as a BoolArr """
+        codes = [self.code(lv) if isinstance(lv, str) else lv for lv in levels]
+        return self.asnew(np.isin(self.raw, codes), cls=ss.BoolArr, copy=False)
+
+    def counts(self):
+        """ The number of active agents in each level """
+        vals = self.values
+        return {level: np.count_nonzero(vals == code) for level, code in self.code_of.items()}
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# CACHED AGE BANDS
+#
+# Selectors such as (sim.people.age < 20) recompute the band from the float
+# ages for every pool on every step. Ages only go up, so instead keep the band
+# of each agent as a one-byte categorical, and each step only look for the
+# agents who have passed the upper edge of their band: one comparison against
+# a per-band lookup, and a search over just those agents.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class age_bands(ss.Connector):
+    """
+    Keep each agent's age band as a categorical state, named by its edges
+
+    The levels are named like the groups of group_index (e.g. '0-20', '20-100'),
+    so selectors can compare the state directly. Agents outside the age bins
+    have the NaN value (255). The band is only updated as agents age, so if
+    ages are ever set lower, call recompute().
+
+    Args:
+        age_bins (array): the age band edges, e.g. (0, 20, 100)
+
+    **Example**:
+
+        bands = age_bands(age_bins=[0, 20, 100])
+        young = lambda sim: (sim.connectors.age_bands.band == '0-20').uids
+        sim = ss.Sim(connectors=bands, ...)
+    """
+    def __init__(self, pars=None, age_bins=_, **kwargs):
+        super().__init__()
+        self.define_pars(
+            age_bins = [0, 20, 100],
+        )
+        self.update_pars(pars, **kwargs)
+        edges = np.asarray(self.pars.age_bins, dtype=float)
+        if len(edges) > 256:
+            raise ValueError(f'There can be at most 255 age bands, not {len(edges)-1}')
+        self.edges = edges
+        self.define_states(
+            categorical('band', levels=[f'{lo:n}-{hi:n}' for lo, hi in zip(edges[:-1], edges[1:])], dtype=np.uint8),
+        )
+        # The upper edge of each band, by code; agents in no band (255) are always checked
+        self.upper = np.full(256, -np.inf)
+        self.upper[:len(edges)-1] = edges[1:]
+        return
+
+    def compute(self, age):
+        """ The band code of each age, or 255 if outside the age bins """
+        band = np.searchsorted(self.edges, age, side='right') - 1
+        return np.where((band >= 0) & (band < len(self.edges)-1), band, 255).astype(np.uint8)
+
+    def recompute(self):
+        """ Recompute every agent's band from their age """
+        self.band.raw[:] = self.compute(self.sim.people.age.raw[:len(self.band.raw)])
+        return
+
+    def init_post(self):
+        super().init_post()
+        self.recompute()
+        return
+
+    def step(self):
+        """ Move the agents who have aged past the upper edge of their band """
+        age = self.sim.people.age.raw
+        band = self.band.raw
+        moved = np.nonzero(age[:len(band)] >= self.upper[band])[0]
+        if len(moved):
+            band[moved] = self.compute(age[moved])
+        return
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# ROLLING INHALED DOSE
+#
+# "What has your inhaled been in the last few hours" needs each agent's recent
+# history. Instead of a growing list per agent, keep a fixed window of sub-steps
+# in a ring buffer, plus the running sum: each sub-step subtracts the oldest
+# row, overwrites it with the new doses and adds them, so the update is O(N)
+# and writes into the existing arrays.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+class dose_window:
+    """
+    The dose of every agent summed over the last `window` sub-steps
+
+    The buffer is stored as (window x N), so that each sub-step writes one
+    contiguous row. The running sum is float64 to avoid drift from float32
+    buffers, and is recomputed exactly every `resync` passes through the window.
+
+    Args:
+        n (int): the number of agents (i.e. the length of the raw state arrays)
+        window (int): the number of sub-steps to remember
+        dtype (dtype): the dtype of the buffer
+        resync (int): recompute the sum from the buffer every this many passes
+
+    **Example**:
+
+        print(dose_window.estimate_memory(n=1e7, window=24)/1e9, 'GB')
+        dw = dose_window(n=1000, window=24)
+        dw.add(inhaled) # Each sub-step
+        dw.sum # The dose over the last 24 sub-steps
+    """
+    def __init__(self, n, window=24, dtype=np.float32, resync=100):
+        self.window = int(window)
+        self.dtype = np.dtype(dtype)
+        self.resync = resync
+        self.buf = np.zeros((self.window, int(n)), dtype=self.dtype)
+        self.sum = np.zeros(int(n))
+        self.pos = 0 # The row to overwrite next
+        self.n_passes = 0
+        return
+
+    def __len__(self):
+        return self.buf.shape[1]
+
+    @staticmethod
+    def estimate_memory(n, window=24, dtype=np.float32):
+        """ The memory needed for n agents, in bytes """
+        return int(n) * (int(window)*np.dtype(dtype).itemsize + 8)
+
+    @property
+    def nbytes(self):
+        return self.buf.nbytes + self.sum.nbytes
+
+    def add(self, dose):
+        """ Add this sub-step's dose (one value per agent), dropping the oldest """
+        row = self.buf[self.pos]
+        self.sum -= row
+        row[:] = dose
+        self.sum += row
+        self.pos += 1
+        if self.pos == self.window:
+            self.pos = 0
+            self.n_passes += 1
+            if self.n_passes % self.resync == 0:
+                self.buf.sum(axis=0, dtype=np.float64, out=self.sum)
+        return self.sum
+
+    def reset(self, uids):
+        """ Clear the history of these agents """
+        self.buf[:, uids] = 0
+        self.sum[uids] = 0
+        return
+
+    def grow(self, n):
+        """ Make room for new agents, who start with no history """
+        n_old = len(self)
+        if n > n_old:
+            buf = np.zeros((self.window, n), dtype=self.dtype)
+            buf[:, :n_old] = self.buf
+            self.buf = buf
+            self.sum = np.concatenate([self.sum, np.zeros(n - n_old)])
+        return
@@ -0,0 +1,237 @@
+"""
+Resumable parameter sweeps, with every run's results in one chunked file
+"""
+import json
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import sciris as sc
+from rsv_results import column_writer, read_results, chunk_index
+from rsv_snapshot import reseed
+
+__all__ = ['sweep', 'read_sweep']
+
+
+# ===============================================================================
+# ///////////////////////////////////////////////////////////////////////////////
+# PARAMETER SWEEPS
+#
+# Trying a grid of beta, contact scalings and location probabilities meant
+# editing make_sim() in 05_demo by hand for each. Here every parameter set (and
+# replicate) is a run, the runs are spread over a process pool, and the main
+# process appends each finished run to one column_writer file as a chunk of its
+# own: one compressed write, so a killed sweep leaves only whole runs (plus at
+# most a partial chunk, cut off when it is reopened). Running the sweep again
+# skips the runs already in the file.
+#
+# The parameter sets are kept in the file's header, and the run is the first
+# column of every chunk, so chunk_index() can find the chunks of any subset of
+# runs without decompressing the rest, and read_sweep() only reads those.
+# ///////////////////////////////////////////////////////////////////////////////
+# ===============================================================================
+_worker_sweep = None # The sweep, in each worker process
+
+
+def _init_worker(sw):
+    global _worker_sweep
+    _worker_sweep = sw
+    return
+
+
+def _run_task(run):
+    """ Run one run of the sweep in a worker, and return its columns """
+    return _worker_sweep.run_one(run)
+
+
+def default_outputs(sim):
+    """
+    The counts of every analyzer with get_counts() (e.g. infections_by_stratum),
+    one column per stratum, and the number infected with each disease, per step
+    """
+    cols = dict(ti=np.arange(sim.t.npts, dtype=np.int32), year=np.asarray(sim.t.yearvec, dtype=float))
+    for analyzer in sim.analyzers.values():
+        if hasattr(analyzer, 'get_counts') and hasattr(analyzer, 'strata'):
+            counts = analyzer.get_counts()
+            for si, stratum in enumerate(analyzer.strata):
+                cols[stratum] = counts[:, si]
+    for disease in sim.diseases.values():
+        if 'n_infected' in disease.results:
+            cols[f'{disease.name}.n_infected'] = disease.results.n_infected.values
+    return cols
+
+
+class sweep:
+    """
+    Run a sim for every combination of parameter values, skipping those already done
+
+    Each run calls make_sim(**pars) with one parameter set, sets its rand_seed,
+    runs it, and appends outputs(sim) (one row per step) to the file, along with
+    the run number. The file can be read with read_sweep() at any point, also
+    while the sweep is running.
+
+    Args:
+        make_sim (func): called as make_sim(**pars) to make the (unrun) sim of a parameter set
+        grid (dict/list): the values of each parameter, e.g. dict(beta=[0.05, 0.1]), run as every
+            combination; or a list of parameter sets (dicts), run as they are
+        filename (str/path): the file to write; if it exists, the sweep carries on from it
+        n_reps (int): the number of replicates of each parameter set, with rand_seed 0, 1, ...
+        outputs (func): called as outputs(sim) after each run, returning a dict of equal-length
+            numeric arrays (default: see default_outputs())
+        n_workers (int): the number of processes (default: one per CPU); 1 runs them in this process
+        level (int): the zstd compression level
+
+    **Example**:
+
+        def make_sim(beta, p_young):
+            location = categorical('location', levels=locations, default=age_choice(
+                a=[0, 1, 2], p=[p_young, [.20, .10, .70]], age_bins=(0, 19, 100)))
+            ...
+            return ss.Sim(..., analyzers=infections_by_stratum(...))
+
+        sw = sweep(make_sim, dict(beta=[0.05, 0.1, 0.2], p_young=[[.33, .33, .34], [.20, .10, .70]]),
+                   filename='sweep.rsvc', n_reps=10)
+        sw.run() # Run again after a crash to do just the missing runs
+        df = read_sweep('sweep.rsvc', columns=['0-20 - SCHOOL'], beta=0.1)
+    """
+    def __init__(self, make_sim, grid, filename='sweep.rsvc', n_reps=1, outputs=None, n_workers=None, level=3):
+        self.make_sim = make_sim
+        if isinstance(grid, dict):
+            keys = list(grid.keys())
+            grid = [dict(zip(keys, vals)) for vals in itertools.product(*grid.values())]
+        self.par_sets = [dict(pars) for pars in grid]
+        self.runs = [dict(pars, rand_seed=rep) for pars in self.par_sets for rep in range(n_reps)]
+        self.filename = sc.path(filename)
+        self.n_reps = n_reps
+        self.outputs = outputs if outputs is not None else default_outputs
+        self.n_workers = n_workers
+        self.level = level
+        self.writer = None
+        return
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __getstate__(self):
+        """ The workers only run sims; the main process writes the file """
+        state = self.__dict__.copy()
+        state['writer'] = None
+        return state
+
+    def done(self):
+        """ The runs already in the file """
+        if not self.filename.exists():
+            return set()
+        return set(chunk_index(self.filename, key='run').run.tolist())
+
+    def run_one(self, run):
+        """ Make, run and summarize one run, returning its columns """
+        pars = dict(self.runs[run])
+        rand_seed = pars.pop('rand_seed')
+        sim = self.make_sim(**pars)
+        if sim.initialized:
+            reseed(sim, rand_seed)
+        else:
+            sim.pars.rand_seed = rand_seed
+        sim.run()
+        cols = {name: np.asarray(col) for name, col in self.outputs(sim).items()}
+        return cols
+
+    def reopen(self):
+        """ Carry on writing to the file of an earlier run of this sweep """
+        self.writer = column_writer.reopen(self.filename, level=self.level)
+        if self.writer.meta.get('runs') != json.loads(json.dumps(self.runs)): # As it comes back from the header
+            self.writer = None
+            raise ValueError(f'{self.filename} is from a sweep over different parameter sets; use another filename')
+        return
+
+    def write(self, run, cols):
+        """ Append one finished run to the file, as one chunk """
+        if self.writer is None: # The first run, now that the columns are known
+            columns = dict(run=np.int32, **{name: col.dtype for name, col in cols.items()})
+            self.writer = column_writer(self.filename, columns, chunk_size=1, level=self.level, meta=dict(runs=self.runs))
+        self.writer.append_chunk(run=run, **cols)
+        return
+
+    def run(self, verbose=True):
+        """ Run every run not already in the file """
+        if self.filename.exists():
+            self.reopen()
+        done = self.done()
+        todo = [run for run in range(len(self)) if run not in done]
+        if verbose: print(f'{len(self) - len(todo)} of {len(self)} runs already done')
+        T = sc.timer()
+        try:
+            n_workers = min(self.n_workers or mp.cpu_count(), max(len(todo), 1))
+            if n_workers == 1:
+                for i, run in enumerate(todo):
+                    self.write(run, self.run_one(run))
+                    if verbose: print(f'Run {i+1} of {len(todo)} done ({T.toc(output=True):.1f} s)')
+                return self
+
+            methods = mp.get_all_start_methods()
+            ctx = mp.get_context('fork' if 'fork' in methods else None) # Fork, so make_sim doesn't need to be importable
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_worker, initargs=(self,)) as pool:
+                queue = iter(todo)
+                pending = {}
+                n_done = 0
+                while True:
+                    for run in itertools.islice(queue, 2*n_workers - len(pending)): # Keep the workers busy
+                        pending[pool.submit(_run_task, run)] = run
+                    if not pending:
+                        break
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.write(pending.pop(future), future.result())
+                        n_done += 1
+                        if verbose: print(f'Run {n_done} of {len(todo)} done ({T.toc(output=True):.1f} s)')
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+        return self
+
+    def to_df(self, columns=None, **where):
+        """ Read the results, as read_sweep() """
+        return read_sweep(self.filename, columns=columns, **where)
+
+
+def read_sweep(filename, columns=None, runs=None, **where):
+    """
+    Read the results of a sweep, or of just some of its runs
+
+    Only the chunks of the selected runs are decompressed, and only the
+    requested columns are kept, so aggregating over thousands of runs reads
+    just what it needs.
+
+    Args:
+        filename (str/path): the file written by a sweep
+        columns (list): the result columns to return (default: all)
+        runs (list): the runs to read (default: all those matching where)
+        where (dict): parameter values to select runs by, e.g. beta=0.1 or rand_seed=0
+
+    Returns:
+        A dataframe with one row per step of each selected run: the run, its
+        parameters, and the result columns
+
+    **Example**:
+
+        df = read_sweep('sweep.rsvc', columns=['sir.n_infected'])
+        peak = df.groupby(['beta', 'run'])['sir.n_infected'].max().groupby('beta').mean()
+    """
+    header, chunks = chunk_index(filename, key='run', header=True)
+    pars = pd.DataFrame(header['meta']['runs'])
+    pars.index.name = 'run'
+    keep = np.ones(len(pars), dtype=bool)
+    if runs is not None:
+        keep &= np.isin(pars.index, runs)
+    for name, value in where.items():
+        keep &= pars[name].apply(lambda v: v == value).values
+    chunks = chunks[np.isin(chunks.run, pars.index[keep])]
+
+    names = [name for name, _ in header['columns'] if name != 'run']
+    cols = ['run'] + (names if columns is None else list(columns))
+    df = read_results(filename, columns=cols, chunks=chunks)
+    flat = pars.apply(lambda col: col.map(lambda v: json.dumps(v) if isinstance(v, (list, dict)) else v)) # Lists can't be merged on
+    return flat.reset_index().merge(df, on='run', how='right')[['run'] + list(pars.columns) + cols[1:]]